@@ -1,16 +1,51 @@
 import sys
 
-from common.core import *
-from common.gfxutil import *
 from common.audio import *
-from common.synth import *
 from common.clock import *
 from common.mixer import *
 from common.wavegen import *
 from common.wavesrc import *
+from common.prefetch import *
+from common.resample import set_default_quality
+from common.speedvariants import *
+from common.filters import *
+from common.profiler import profile_into, set_label
+from common.samplebank import SampleBank, have_samples
+from common.metro import Metronome
+from transition import AUDIO_FILES, BEATS_FILES
 
 import numpy as np
 import math
+import os.path
+
+# filter effects (bass / vocals boost) run the song through live biquad filters.
+# Set this to use pre-rendered <song>_high.wav / <song>_low.wav stems instead,
+# for songs that have them.
+kUseFilterStems = False
+
+# live filter settings (f_type, freq, q, gain_db) for each filter effect
+kFilterSettings = {"low": ("lowpass", 300., 0.7071, 0.),
+                   "high": ("highpass", 1200., 0.7071, 0.)}
+
+# how long filter effects last, and how long reg_to_high takes to fade in
+kFilterRampFrames = 8 * Audio.sample_rate
+
+# reg_to_high sweeps a highpass cutoff up between these frequencies
+kSweepStartFreq = 20.
+kSweepEndFreq = 1200.
+
+# sound effects come from this soundfont, but are played from notes pre-rendered
+# into kSfxDir (by render_sfx.py), so the soundfont doesn't have to be loaded.
+# kSfxNotes is every (bank, preset, key) AudioManager plays.
+kSoundFont = "data/FluidR3_GM.sf2"
+kSfxDir = "data/sfx"
+kSfxNotes = [(0, 116, 60), (0, 98, 69), (0, 98, 75), (0, 114, 60), (0, 126, 69), (128, 0, 60)]
+
+# the metronome (a beat-locked click, for checking the beat grids) plays on this channel
+kMetronomeChannel = 5
+
+# snap sampler loops to a whole number of beats
+kSnapLoops = True
 
 ###############################################
 # DESIGN:
@@ -25,16 +60,25 @@ class AudioManager(object):
         super(AudioManager, self).__init__()
         self.audio = audio
         self.mixer = Mixer()
-        self.sfx = Synth("data/FluidR3_GM.sf2")
-        self.mixer.add(self.sfx)
-        
-        self.mixer.set_gain(1)
+        self.sfx = make_sfx()
+        self.bpms = [120, 90, 140]
+        self.transitions = 0
 
         # setup audio files
         self.first_file = first_file
         self.second_file = second_file
         self.primary_song = Song(first_file)
-        self.secondary_song = Song(second_file)
+
+        # sound effects play through a scheduler that follows the song's beats.
+        # It goes before the song in the mixer, to see the song's position
+        # before the song renders.
+        self.sched = self.make_scheduler(self.primary_song)
+        self.metronome = None
+        self.mixer.add(self.sched)
+        self.mixer.set_gain(1)
+
+        self.stem_prefetch = Prefetcher(preload_stems, first_file)
+        self.prefetch_song(second_file)
 
         # effects notes
         self.powerup_note = 69
@@ -49,9 +93,6 @@ class AudioManager(object):
         self.sfx.program(3, 0, 114) # soundtrack
         self.sfx.program(4, 0, 126) # applause
 
-        self.bpms = [120, 90, 140]
-        self.transitions = 0
-
         # hook everything up
         self.mixer.add(self.primary_song)
         
@@ -67,86 +108,139 @@ class AudioManager(object):
 
     def restart(self):
         self.primary_song = Song(self.first_file)
-        self.secondary_song = Song(self.second_file)
+        self.prefetch_song(self.second_file)
         self.transitions = 0
-        self.mixer = Mixer()
-        self.mixer.add(self.sfx)
-        self.mixer.set_gain(1)
-        self.mixer.add(self.primary_song)
-        self.audio.set_generator(self.mixer)
         self.active = False
+        # the metronome goes with the old scheduler. Stopping it touches that
+        # scheduler's commands, so it's done on the audio thread.
+        if self.metronome:
+            self.post(self.metronome.stop)
+            self.metronome = None
+
+        # build the new mixer before swapping it in: the audio thread may be playing the old one
+        mixer = Mixer()
+        self.sched = self.make_scheduler(self.primary_song)
+        mixer.add(self.sched)
+        mixer.set_gain(1)
+        mixer.add(self.primary_song)
+        self.mixer = mixer
+        self.audio.set_generator(self)
     
     def set_as_audio(self, audio):
-        audio.set_generator(self.mixer)
+        audio.set_generator(self)
+
+    # a scheduler for the sound effects, on song's beats
+    def make_scheduler(self, song):
+        sched = set_label(AudioScheduler(self.get_tempo_map(song), song), 'sfx')
+        sched.set_generator(self.sfx)
+        return sched
+
+    # the beat grid of song, if its level has one. Otherwise a steady tempo at
+    # the level's bpm.
+    def get_tempo_map(self, song):
+        if song.audio_file in AUDIO_FILES:
+            beats_file = BEATS_FILES[AUDIO_FILES.index(song.audio_file)]
+            if beats_file and os.path.exists(beats_file):
+                return make_beats_tempo_map(beats_file)
+        return SimpleTempoMap(self.bpms[min(self.transitions, len(self.bpms) - 1)])
+
+    def get_scheduler(self):
+        return self.sched
+
+    # a click on every beat of the song
+    def toggle_metronome(self):
+        if self.metronome is None:
+            self.metronome = Metronome(self.sched, self.sfx, kMetronomeChannel)
+        self.post(self.metronome.toggle)
         
     def toggle(self):
         self.active = not self.active
 
+    # Everything that changes the audio graph goes through here, so it happens on
+    # the audio thread (see Audio.post). Commands are bound to the objects they
+    # act on when they are posted.
+    def post(self, func, *args):
+        self.audio.post(func, *args)
+
+    # the manager is the generator Audio plays: the mixer while active, silence otherwise
+    def generate(self, num_frames, num_channels):
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
+        if not self.active:
+            out.fill(0)
+            return True
+        return self.mixer.generate_into(out, num_frames, num_channels)
+
+    def advance(self, num_frames, num_channels):
+        if not self.active:
+            return True
+        return self.mixer.advance(num_frames, num_channels)
+
     # OVERALL VOLUME EFFECTS
     def lower_volume(self):
         # reduce volume by half
-        self.mixer.set_gain(self.mixer.get_gain() * 0.5)
+        self.post(self.scale_volume, self.mixer, 0.5)
 
     def raise_volume(self):
         # raise volume by 2x, up to 100
-        self.mixer.set_gain(min(self.mixer.get_gain() * 2, 1))
+        self.post(self.scale_volume, self.mixer, 2)
+
+    def scale_volume(self, mixer, factor):
+        mixer.set_gain(min(mixer.get_gain() * factor, 1))
 
     # SOUND EFFECTS
     def play_error_effect(self):
-        self.sfx.noteon(0, self.error_note, self.effect_volume)
+        self.post(self.sfx.noteon, 0, self.error_note, self.effect_volume)
 
     def stop_error_effect(self):
-        self.sfx.noteoff(0, self.error_note)
+        self.post(self.sfx.noteoff, 0, self.error_note)
 
     def play_powerup_effect(self):
-        self.sfx.noteon(1, self.powerup_note, self.effect_volume)
+        self.post(self.sfx.noteon, 1, self.powerup_note, self.effect_volume)
 
     def stop_powerup_effect(self):
-        self.sfx.noteoff(1, self.powerup_note)
+        self.post(self.sfx.noteoff, 1, self.powerup_note)
 
     def play_jump_effect(self):
-        self.sfx.noteon(1, self.jump_note, self.effect_volume)
+        self.post(self.sfx.noteon, 1, self.jump_note, self.effect_volume)
 
     def stop_jump_effect(self):
-        self.sfx.noteoff(2, self.jump_note)
+        self.post(self.sfx.noteoff, 1, self.jump_note)
 
     def play_lose_effect(self):
-        self.sfx.noteon(3, self.error_note, self.effect_volume)
+        self.post(self.sfx.noteon, 3, self.error_note, self.effect_volume)
 
     def stop_lose_effect(self):
-        self.sfx.noteoff(3, self.error_note)
+        self.post(self.sfx.noteoff, 3, self.error_note)
 
     def play_win_effect(self):
-        self.sfx.noteon(4, self.powerup_note, self.effect_volume)
+        self.post(self.sfx.noteon, 4, self.powerup_note, self.effect_volume)
     
     def stop_win_effect(self):
-        self.sfx.noteoff(4, self.powerup_note)
+        self.post(self.sfx.noteoff, 4, self.powerup_note)
 
     # MAIN TRACK EFFECTS
     def bass_boost(self, add_bar=None):
         # self.primary_filter.change_pass("low")
-        self.primary_song.set_filter("low")
+        self.post(self.primary_song.set_filter, "low")
         self.transition_lasthit_dict["filter"] = self.get_current_frame()
         if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
 
-    def reset_filter(self):
-        # self.primary_filter.change_pass("reset")
-        self.primary_song.change_pass("reset")
-
     def vocals_boost(self, add_bar=None):
         # self.primary_filter.change_pass("high")
-        self.primary_song.set_filter("high")
+        self.post(self.primary_song.set_filter, "high")
         self.transition_lasthit_dict["filter"] = self.get_current_frame()
         if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
 
     def reg_to_high_boost(self, add_bar=None):
         # self.primary_filter.change_pass("band")
-        self.primary_song.set_filter("reg_to_high")
+        self.post(self.primary_song.set_filter, "reg_to_high")
         if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
 
     def riser(self, add_bar=None):
-        riser = WaveGenerator(WaveFile("data/riser1.wav"))
-        self.mixer.add(riser)
+        riser = set_label(WaveGenerator(WaveBuffer("data/riser1.wav")), 'riser')
+        self.post(self.mixer.add, riser)
         self.transition_lasthit_dict["riser"] = self.get_current_frame()
         if add_bar: add_bar(riser.get_length(), "RISER")
 
@@ -164,63 +258,91 @@ class AudioManager(object):
 
     def get_secondary_bpm(self):
         if self.transitions < len(self.bpms) - 1:
-            return self.bpms[self.transitions + 1] * self.secondary_song.get_speed()
+            return self.bpms[self.transitions + 1] * self.get_secondary_speed()
         else:
             return self.bpms[self.transitions]
 
     # speedup the song and/or sampler
     def speedup(self):
-        self.primary_song.set_speed(self.primary_song.get_speed() * 2**(1/12))
+        self.post(self.primary_song.step_speed, 2**(1/12))
         self.transition_lasthit_dict["speed"] = self.get_current_frame()
 
     # slow down the song and /or sampler
     def slowdown(self):
-        self.primary_song.set_speed(self.primary_song.get_speed() / 2**(1/12))   
+        self.post(self.primary_song.step_speed, 2**(-1/12))
         self.transition_lasthit_dict["speed"] = self.get_current_frame()     
 
+    # change the resampler used for speed effects ('linear', 'cubic' or 'sinc'),
+    # both for what is playing now and for everything made from here on
+    def set_resample_quality(self, quality):
+        set_default_quality(quality)
+        self.post(self.primary_song.set_resample_quality, quality)
+        if self.secondary_song: self.post(self.secondary_song.set_resample_quality, quality)
+
     ###### SAMPLE EFFECTS #########
     # start the sample by retaining current frame
     def sample_on(self, frame):
-        self.primary_song.set_sampling_on_frame(frame)
+        self.post(self.primary_song.set_sampling_on_frame, frame)
     # end the sample by loading in an audio snippet from [sample_on to sample off]
     # add it to the mixer, and set the primary song gain to 0 (but keep it playing)
     def sample_off(self, frame):
-        self.primary_song.set_sampling_off_frame(frame)
+        beat_frames = None
+        if kSnapLoops:
+            beat_secs = self.sched.tempo_map.get_beat_length(frame / float(Audio.sample_rate))
+            beat_frames = beat_secs * Audio.sample_rate
+        self.post(self.primary_song.set_sampling_off_frame, frame, beat_frames)
         self.transition_lasthit_dict["sample"] = self.get_current_frame()
 
 
+    # start building the song for the next level (audio and filter stems) on a
+    # worker thread, so the transition itself only has to swap references.
+    def prefetch_song(self, audio_file):
+        self.secondary_song = None
+        self.song_prefetch = Prefetcher(load_song, audio_file)
+
+    # the prefetched next song. Waits for the worker if it isn't done yet.
+    def get_secondary_song(self):
+        if self.secondary_song is None:
+            self.secondary_song = self.song_prefetch.get()
+        return self.secondary_song
+
     # start the song transition. Here, init the new song as a WaveGenerator and add it to the mixer.
     def add_transition_song(self, audio_file):
         # self.secondary_song = Song(audio_file, gain=0.25)
-        self.mixer.add(self.secondary_song)
+        self.post(self.mixer.add, self.get_secondary_song())
 
     # end the song transition by putting all the secondary song refs as the primary song refs.
     # remove the primary song from the mixer.
     # remove any samples that may be playing.
+    # then start preparing the song after this one.
     def end_transition_song(self, next_song):
-        self.mixer.remove(self.primary_song)
-        self.primary_song.reset_sample()
-        self.primary_song = self.secondary_song
-        self.secondary_song = Song(next_song)
-        self.mixer.set_gain(1)
+        self.post(self.retire_song, self.mixer, self.primary_song)
+        self.primary_song = self.get_secondary_song()
+        self.prefetch_song(next_song)
         self.transitions += 1
+        self.post(self.sched.set_song, self.primary_song, self.get_tempo_map(self.primary_song))
+
+    def retire_song(self, mixer, song):
+        mixer.remove(song)
+        song.reset_sample()
+        mixer.set_gain(1)
         
     # reset the sampling and reinstate the normal playing song
     def reset_sample(self):
-        self.primary_song.reset_sample()
+        self.post(self.primary_song.reset_sample)
 
     def reset_speed(self):
-        self.primary_song.set_speed(1)
+        self.post(self.primary_song.set_speed, 1)
 
     def reset_filter(self, remove_bar=None):
-        self.primary_song.reset_filter()
+        self.post(self.primary_song.reset_filter)
         if remove_bar: remove_bar("FILTER")
 
     def reset(self, remove_bar=None):
         self.reset_speed()
         self.reset_sample()
         self.reset_filter(remove_bar)
-        self.mixer.set_gain(1)
+        self.post(self.mixer.set_gain, 1)
         
     def add_transition_token(self):
         pass
@@ -247,66 +369,69 @@ class AudioManager(object):
             self.audio.on_update()
 
 
-# Decided to include SpeedModulator for speedup/slowdown and key change effect
-class SpeedModulator(object):
-    def __init__(self, generator, speed = 1.0, gain=1.0):
-        super(SpeedModulator, self).__init__()
-        self.generator = generator
-        self.speed = speed
-        self.continue_flag = True
-
-        self.set_gain(gain)
-
-    def set_gain(self, new_gain):
-        self.generator.set_gain(new_gain)
-
-    def get_gain(self):
-        return self.generator.get_gain()
-
-    def set_speed(self, speed) :
-        self.speed = speed
-
-    def get_speed(self):
-        return self.speed
-
-    def release(self):
-        self.continue_flag = False
-
-    def generate(self, num_frames, num_channels) :
-        # this is the fun part lol
-        if num_channels == 2:
-            frames_to_make = int(num_frames * num_channels * self.speed)
-            frames_to_make = frames_to_make + frames_to_make % num_channels # to round it out
-            # we have the number of frames we need to extract from the generator
-            frames = self.generator.generate(int(frames_to_make / num_channels), num_channels)[0]
-            # we have the frames. Now we need to interpolate
-            lframes = frames[::2]
-            rframes = frames[1::2]
-            lneeds = np.linspace(0, len(lframes), num_frames)
-            lhaves = np.arange(0, len(lframes))
-            rneeds = np.linspace(0, len(rframes), num_frames)
-            rhaves = np.arange(0, len(rframes))
-            lframes = np.interp(lneeds, lhaves, lframes)
-            rframes = np.interp(rneeds, rhaves, rframes)
-            output = np.empty(num_channels * num_frames, dtype=lframes.dtype)
-            output[0::2] = lframes
-            output[1::2] = rframes
-        else:
-            frames, self.continue_flag = self.generator.generate(int(num_frames * self.speed))
-            needs = np.linspace(0, len(frames), num_frames)
-            output = np.interp(needs, np.arange(0, len(frames), num_frames), frames)
-        return (output, self.continue_flag)
+# the sound effect player: a SampleBank of the pre-rendered notes if they are
+# there, otherwise a fluidsynth Synth playing the soundfont
+def make_sfx():
+    if not have_samples(kSoundFont, kSfxNotes, kSfxDir):
+        try:
+            from common.synth import Synth
+            # five programs on five channels, a few notes at a time: the
+            # smallest channel count fluidsynth takes, and modest polyphony
+            return Synth(kSoundFont, channels=16, polyphony=32)
+        except ImportError as e:
+            print('no sound effects (run render_sfx.py):', e)
+
+    bank = SampleBank(kSfxDir)
+    bank.load(kSfxNotes)
+    return bank
+
+
+# Stand-in for Audio when something other than a sound card pulls the audio
+# (an offline render, the audio process): AudioManager only needs post() and
+# set_generator(). There is no other thread, so commands run right away.
+class DirectAudio(object):
+    def __init__(self):
+        super(DirectAudio, self).__init__()
+        self.generator = None
+
+    def set_generator(self, gen):
+        self.generator = gen
+
+    def post(self, func, *args):
+        func(*args)
+
+
+# the _high / _low filter stems of a song, if filter effects use them and they exist
+def get_stem_files(audio_file):
+    if not kUseFilterStems:
+        return []
+    stems = [audio_file[:-4] + "_high.wav", audio_file[:-4] + "_low.wav"]
+    return [f for f in stems if os.path.exists(f)]
+
+# load the filter stems of a song through the WaveCache (reading their pages
+# in), so that filter powerups don't wait on the disk. Songs without stems are fine.
+def preload_stems(audio_file):
+    stems = get_stem_files(audio_file)
+    get_wave_cache().preload(stems)
+    for stem in stems:
+        get_variants(stem)
+
+# build a Song with everything it needs already loaded. Safe to run on a worker thread.
+def load_song(audio_file):
+    song = Song(audio_file)
+    preload_stems(audio_file)
+    return song
 
 
 class Song(object):
     def __init__(self, audiofile, speed = 1.0, gain = 0.9):
         super(Song, self).__init__()
         self.audio_file = audiofile
-        self.wave_gen = WaveGenerator(WaveFile(self.audio_file))
-        self.speed_mod = SpeedModulator(self.wave_gen)
+        self.wave_gen = WaveGenerator(WaveBuffer(self.audio_file))
+        self.speed_mod = VariantSpeedModulator(self.wave_gen, get_variants(self.audio_file))
         self.song_filter = FilterMixer(self.audio_file, self.speed_mod, self.get_gain, self.get_frame)
         self.gain = gain
-        self.wave_gen.set_gain(self.gain)
+        self.speed_mod.set_gain(self.gain)
 
         self.sampler_filter = None
         self.sampler_on_frame, self.sampler_off_frame = 0,0
@@ -326,6 +451,14 @@ class Song(object):
     def get_speed(self):
         return self.speed_mod.get_speed()
 
+    # multiply the speed by factor (like a semitone up: 2**(1/12))
+    def step_speed(self, factor):
+        self.set_speed(self.get_speed() * factor)
+
+    def set_resample_quality(self, quality):
+        self.song_filter.set_resample_quality(quality)
+        if self.sampler_filter: self.sampler_filter.set_resample_quality(quality)
+
     def set_filter(self, filter_type):
         self.song_filter.set_filter(filter_type)
         if self.sampler_filter: self.sampler_filter.set_filter(filter_type)
@@ -334,21 +467,29 @@ class Song(object):
         self.song_filter.reset_filter()
         if self.sampler_filter: self.sampler_filter.reset_filter()
 
+    # in frames of the original file, whichever speed variant is playing
     def get_frame(self):
-        return self.wave_gen.frame
+        return self.speed_mod.get_frame()
 
     def get_length(self):
-        return self.wave_gen.get_length()
+        return self.speed_mod.get_length()
 
     def set_sampling_on_frame(self, frame):
         self.sampler_on_frame = frame
 
-    def set_sampling_off_frame(self, frame):
+    # start looping from the sampling on frame to here. With beat_frames (the
+    # length of a beat, in frames of the original), the loop is a whole number
+    # of beats long. The loop plays straight out of the song's data in memory.
+    def set_sampling_off_frame(self, frame, beat_frames=None):
         if self.sampler_on_frame and not self.sampler_off_frame:
             self.sampler_off_frame = frame
-            self.sampler_filter = FilterMixer(self.audio_file, SpeedModulator(WaveGenerator(
-                WaveBuffer(self.audio_file, self.sampler_on_frame,self.get_frame() - self.sampler_on_frame), loop=True)
-                ,speed=self.get_speed()), self.get_gain, self.get_frame)
+            loop_length = self.get_frame() - self.sampler_on_frame
+            if beat_frames:
+                loop_length = int(round(max(round(loop_length / beat_frames), 1) * beat_frames))
+            self.sampler_filter = FilterMixer(self.audio_file, VariantSpeedModulator(WaveGenerator(
+                WaveSlice(self.wave_gen.source, self.sampler_on_frame, loop_length), loop=True),
+                slice_variants(get_variants(self.audio_file), self.sampler_on_frame, loop_length),
+                speed=self.get_speed()), self.get_gain, self.get_frame)
             self.sampler_filter.set_gain(self.get_gain())
             # if self.song_filter.f_type:
             #     self.sampler_filter.set_filter(self.song_filter.f_type, filter_length=self.song_filter.filter_length - (self.get_frame() - self.song_filter.filter_frame_on))
@@ -360,11 +501,20 @@ class Song(object):
         self.sampler_on_frame, self.sampler_off_frame = 0, 0
 
     def generate(self, num_frames, num_channels):
-        # if sampling on, you still want to generate from main song, to keep it playing. just don't return it.
-        returned_frames = self.song_filter.generate(num_frames, num_channels)
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
+        # if sampling on, the main song still has to keep playing, but nobody hears it. just advance it.
+        if self.sampler_filter:
+            self.song_filter.advance(num_frames, num_channels)
+            return profile_into(self.sampler_filter, out, num_frames, num_channels, 'sampler')
+        return profile_into(self.song_filter, out, num_frames, num_channels, 'song')
+
+    def advance(self, num_frames, num_channels):
+        continue_flag = self.song_filter.advance(num_frames, num_channels)
         if self.sampler_filter:
-            returned_frames = self.sampler_filter.generate(num_frames, num_channels)
-        return returned_frames
+            continue_flag = self.sampler_filter.advance(num_frames, num_channels)
+        return continue_flag
 
 
 class FilterMixer(object):
@@ -377,23 +527,20 @@ class FilterMixer(object):
         self.get_gain = get_gain
         self.get_frame = get_frame
         self.mixer = Mixer()
-        self.mixer.add(self.regular)
+        self.mixer.add(set_label(self.regular, 'regular'))
+        self.use_stems = len(get_stem_files(name)) == 2
+        self.filter = FilterGenerator(self.mixer)
         self.frame, self.filter_frame_on = 0, 0
         self.f_type = None
         self.filter_length = None
 
-        self.reg_to_anim = KFAnim((0,0),(8,1))
-
     def update(self):
-        local_frame_secs = (self.frame - self.filter_frame_on) / Audio.sample_rate
-        if self.f_type == "reg_to_high":
-            # TODO(clhsu): gain setting here for dynamic filtering. Call self.frame
-            self.high.set_gain(self.reg_to_anim.eval(local_frame_secs))
-            self.regular.set_gain(1 - self.reg_to_anim.eval(local_frame_secs))
-        elif self.f_type == "reg_to_low":
-            self.low.set_gain(self.reg_to_anim.eval(local_frame_secs))
-            self.regular.set_gain(1 - self.reg_to_anim.eval(local_frame_secs))
-        if self.filter_frame_on and self.frame - self.filter_frame_on > 8 * Audio.sample_rate:
+        # the live filter sweep. (with stems, reg_to_high is a crossfade that the
+        # mixer ramps sample by sample.)
+        if self.f_type == "reg_to_high" and not self.use_stems:
+            t = min((self.frame - self.filter_frame_on) / float(kFilterRampFrames), 1)
+            self.filter.set_filter("highpass", kSweepStartFreq * (kSweepEndFreq / kSweepStartFreq) ** t)
+        if self.filter_frame_on and self.frame - self.filter_frame_on > kFilterRampFrames:
             self.reset_filter()
 
     def set_speed(self, new_speed):
@@ -401,43 +548,55 @@ class FilterMixer(object):
         if self.high: self.high.set_speed(new_speed)
         if self.low: self.low.set_speed(new_speed)
 
+    def set_resample_quality(self, quality):
+        self.regular.set_quality(quality)
+        if self.high: self.high.set_quality(quality)
+        if self.low: self.low.set_quality(quality)
+
     def set_filter(self, f_type, filter_length=4*Audio.sample_rate):
         self.reset_filter()
         self.f_type = f_type
         self.filter_length = filter_length
-        if f_type == "high":
-            self.high = SpeedModulator(WaveGenerator(
-                WaveBuffer(self.audiofile_name[:-4] + "_high.wav", self.get_frame(), 
-                self.get_frame() + 4*Audio.sample_rate)), speed=self.regular.get_speed()
-            )
-            self.mixer.add(self.high)
+        if not self.use_stems:
+            if f_type in kFilterSettings:
+                self.filter.set_filter(*kFilterSettings[f_type])
+        elif f_type == "high":
+            self.high = self.make_stem("_high.wav", self.get_frame() + 4*Audio.sample_rate)
             self.high.set_gain(self.get_gain())
-            self.regular.set_gain(0)
+            self.mixer.add(self.high)
+            self.mixer.ramp(self.regular, 0, kMixFadeFrames)
         elif f_type == "low":
-            self.low = SpeedModulator(WaveGenerator(
-                WaveBuffer(self.audiofile_name[:-4] + "_low.wav", self.get_frame(), 
-                self.get_frame() + filter_length)),speed=self.regular.get_speed()
-            )
-            self.mixer.add(self.low)
+            self.low = self.make_stem("_low.wav", self.get_frame() + filter_length)
             self.low.set_gain(self.get_gain())
-            self.regular.set_gain(0)
+            self.mixer.add(self.low)
+            self.mixer.ramp(self.regular, 0, kMixFadeFrames)
 
         elif f_type == "reg_to_high":
-            self.high = SpeedModulator(WaveGenerator(
-                WaveBuffer(self.audiofile_name[:-4] + "_high.wav", self.get_frame(), 
-                self.get_frame() + 4*Audio.sample_rate)), gain=0.0,speed=self.regular.get_speed()
-            )
-            self.mixer.add(self.high)
+            self.high = self.make_stem("_high.wav", self.get_frame() + 4*Audio.sample_rate, gain=self.get_gain())
+            self.mixer.add(self.high, kFilterRampFrames)
+            self.mixer.ramp(self.regular, 0, kFilterRampFrames)
 
         self.filter_frame_on = self.frame
+
+    # play one of the song's filter stems from where the song is now, using its
+    # speed variants if they were rendered
+    def make_stem(self, suffix, num_frames, gain=None):
+        stem_file = self.audiofile_name[:-4] + suffix
+        start_frame = self.get_frame()
+        stem = VariantSpeedModulator(WaveGenerator(WaveBuffer(stem_file, start_frame, num_frames)),
+            slice_variants(get_variants(stem_file), start_frame, num_frames),
+            speed=self.regular.get_speed(), gain=gain)
+        return set_label(stem, suffix[1:-4])
     
     def reset_filter(self):
+        self.filter.set_filter(None)
+        self.mixer.ramp(self.regular, 1, kMixFadeFrames)
         if self.high:
-            self.regular.set_gain(self.high.get_gain())
             self.mixer.remove(self.high)
+            self.high = None
         if self.low:
-            self.regular.set_gain(self.low.get_gain())
             self.mixer.remove(self.low)
+            self.low = None
         self.filter_frame_on = 0
         self.f_type, self.filter_length = None, None
 
@@ -447,9 +606,17 @@ class FilterMixer(object):
         if self.low: self.low.set_gain(new_gain)
 
     def generate(self, num_frames, num_channels):
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
+        self.frame += num_frames
+        self.update()
+        return profile_into(self.filter, out, num_frames, num_channels, 'filter')
+
+    def advance(self, num_frames, num_channels):
         self.frame += num_frames
         self.update()
-        return self.mixer.generate(num_frames, num_channels)
+        return self.filter.advance(num_frames, num_channels)
 
 
 def running_mean(x, windowsize):
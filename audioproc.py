@@ -0,0 +1,327 @@
+import time
+import traceback
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from common.audio import Audio, generate_into
+from common.wavesrc import WaveFile
+from common.shmring import SharedRing
+from audio import AudioManager, DirectAudio
+
+###############################################
+# Out-of-process audio rendering.
+#
+# RemoteAudioManager stands in for AudioManager, but the real AudioManager (and
+# its whole graph) runs in a child process, so rendering doesn't compete with
+# the UI for the GIL. The child renders blocks into a SharedRing; the parent's
+# Audio only copies them out of the ring (see RingReader). Game events go to the
+# child over a pipe as (seq, method name, args), and the child publishes what
+# the game needs to read back (frame, speeds, ...) in the ring's status slots.
+
+# ring size, in blocks. The child keeps it as full as it can, so this is also
+# the added latency.
+kRingBlocks = 4
+
+# status slots published by the child
+kStatusSlots = ['frame', 'length', 'primary_speed', 'secondary_speed',
+                'primary_bpm', 'secondary_bpm', 'enough_past_powerups']
+kStatus = dict((name, i) for i, name in enumerate(kStatusSlots))
+
+
+# the child process: build an AudioManager, then apply commands and keep the ring
+# full. It renders a quantum at a time, so commands take effect at quantum
+# boundaries, as they do in Audio.
+def render_process(conn, ring_name, num_channels, block_frames, quantum, sample_rate, first_file, second_file):
+    Audio.sample_rate = sample_rate
+    Audio.quantum = quantum
+    ring = SharedRing(kRingBlocks * block_frames, num_channels, len(kStatusSlots), name=ring_name)
+    audio = DirectAudio()
+    manager = AudioManager(audio, first_file, second_file)
+    manager.set_as_audio(audio)
+
+    buf = np.zeros(quantum * num_channels, dtype=np.float32)
+    block_secs = block_frames / float(sample_rate)
+    while True:
+        while conn.poll():
+            msg = conn.recv()
+            if msg is None:
+                ring.close()
+                return
+            seq, name, args = msg
+            try:
+                getattr(manager, name)(*args)
+            except Exception:
+                traceback.print_exc()
+            # tell the parent where in the stream this command took effect
+            conn.send((seq, ring.get_write_pos()))
+
+        if ring.get_space() >= quantum:
+            generate_into(audio.generator, buf, quantum, num_channels)
+            ring.write(buf, quantum)
+            publish_status(ring, manager)
+        else:
+            # wait for room in the ring, or for a command
+            conn.poll(block_secs / 4)
+
+def publish_status(ring, manager):
+    status = ring.status
+    status[kStatus['frame']] = manager.get_current_frame()
+    status[kStatus['length']] = manager.get_current_length()
+    status[kStatus['primary_speed']] = manager.get_primary_speed()
+    status[kStatus['secondary_speed']] = manager.get_secondary_speed()
+    status[kStatus['primary_bpm']] = manager.get_primary_bpm()
+    status[kStatus['secondary_bpm']] = manager.get_secondary_bpm()
+    status[kStatus['enough_past_powerups']] = manager.enough_past_powerups()
+
+
+# generator for the parent's Audio: plays whatever the child has rendered.
+# Plays silence (and counts an underrun) when the child falls behind.
+class RingReader(object):
+    def __init__(self, ring):
+        super(RingReader, self).__init__()
+        self.ring = ring
+        self.underruns = 0
+        self.missing_frames = 0
+        self.history = deque(maxlen=256)   # (read position, time) after each block
+
+    def generate(self, num_frames, num_channels):
+        output = np.zeros(num_frames * num_channels, dtype=np.float32)
+        return (output, self.generate_into(output, num_frames, num_channels))
+
+    def generate_into(self, out, num_frames, num_channels):
+        got = self.ring.read_into(out, num_frames)
+        if got < num_frames:
+            out[got * num_channels:] = 0
+            self.underruns += 1
+            self.missing_frames += num_frames - got
+        self.history.append((self.ring.get_read_pos(), time.time()))
+        return True
+
+    # when the frame at ring position pos was handed to the device, or None if
+    # it hasn't been yet
+    def get_time_played(self, pos):
+        for read_pos, t in self.history:
+            if read_pos > pos:
+                return t
+        return None
+
+
+# Drop-in replacement for AudioManager (for what the game uses) that renders in
+# a child process. Methods that change audio are sent to the child; getters read
+# the child's published status. Callbacks into the UI (add_bar, remove_bar)
+# stay here in the parent.
+class RemoteAudioManager(object):
+    def __init__(self, audio, first_file, second_file):
+        super(RemoteAudioManager, self).__init__()
+        self.audio = audio
+        self.num_channels = audio.num_channels
+        self.block_frames = getattr(audio, 'buffer_size', 512)
+        self.ring = SharedRing(kRingBlocks * self.block_frames, self.num_channels, len(kStatusSlots))
+        self.reader = RingReader(self.ring)
+        self.active = False
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=render_process, name='audio',
+            args=(child_conn, self.ring.get_name(), self.num_channels, self.block_frames,
+                  Audio.quantum, Audio.sample_rate, first_file, second_file))
+        self.process.daemon = True
+        self.process.start()
+
+        # wait for the child's first block, so the getters have a status to read
+        while self.ring.get_write_pos() == 0 and self.process.is_alive():
+            time.sleep(0.01)
+
+        # for latency: commands not acknowledged yet, and acknowledged ones not played yet
+        self.seq = 0
+        self.post_times = {}
+        self.acks = deque()
+        self.latencies = deque(maxlen=1000)
+
+        self.riser_length = WaveFile("data/riser1.wav").get_length()
+
+        from common import core
+        core.register_terminate_func(self.close)
+
+    # send a method call to the child's AudioManager
+    def post(self, name, *args):
+        self.seq += 1
+        self.post_times[self.seq] = time.time()
+        self.conn.send((self.seq, name, args))
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join(1)
+        self.ring.close()
+        print(self.get_stats_text())
+
+    def restart(self):
+        self.post('restart')
+        self.active = False
+
+    def set_as_audio(self, audio):
+        audio.set_generator(self.reader)
+
+    def toggle(self):
+        self.active = not self.active
+        self.post('toggle')
+
+    def on_update(self):
+        if self.active:
+            self.audio.on_update()
+        self._update_latency()
+
+    # OVERALL VOLUME EFFECTS
+    def lower_volume(self):
+        self.post('lower_volume')
+
+    def raise_volume(self):
+        self.post('raise_volume')
+
+    # SOUND EFFECTS
+    def play_error_effect(self):
+        self.post('play_error_effect')
+
+    def stop_error_effect(self):
+        self.post('stop_error_effect')
+
+    def play_powerup_effect(self):
+        self.post('play_powerup_effect')
+
+    def stop_powerup_effect(self):
+        self.post('stop_powerup_effect')
+
+    def play_jump_effect(self):
+        self.post('play_jump_effect')
+
+    def stop_jump_effect(self):
+        self.post('stop_jump_effect')
+
+    def play_lose_effect(self):
+        self.post('play_lose_effect')
+
+    def stop_lose_effect(self):
+        self.post('stop_lose_effect')
+
+    def play_win_effect(self):
+        self.post('play_win_effect')
+
+    def stop_win_effect(self):
+        self.post('stop_win_effect')
+
+    # MAIN TRACK EFFECTS
+    def bass_boost(self, add_bar=None):
+        self.post('bass_boost')
+        if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
+
+    def vocals_boost(self, add_bar=None):
+        self.post('vocals_boost')
+        if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
+
+    def reg_to_high_boost(self, add_bar=None):
+        self.post('reg_to_high_boost')
+        if add_bar: add_bar(8*Audio.sample_rate, "FILTER")
+
+    def riser(self, add_bar=None):
+        self.post('riser')
+        if add_bar: add_bar(self.riser_length, "RISER")
+
+    def speedup(self):
+        self.post('speedup')
+
+    def slowdown(self):
+        self.post('slowdown')
+
+    def set_resample_quality(self, quality):
+        self.post('set_resample_quality', quality)
+
+    def toggle_metronome(self):
+        self.post('toggle_metronome')
+
+    def sample_on(self, frame):
+        self.post('sample_on', frame)
+
+    def sample_off(self, frame):
+        self.post('sample_off', frame)
+
+    def add_transition_song(self, audio_file):
+        self.post('add_transition_song', audio_file)
+
+    def end_transition_song(self, next_song):
+        self.post('end_transition_song', next_song)
+
+    def reset_sample(self):
+        self.post('reset_sample')
+
+    def reset_speed(self):
+        self.post('reset_speed')
+
+    def reset_filter(self, remove_bar=None):
+        self.post('reset_filter')
+        if remove_bar: remove_bar("FILTER")
+
+    def reset(self, remove_bar=None):
+        self.post('reset')
+        if remove_bar: remove_bar("FILTER")
+
+    def add_transition_token(self):
+        pass
+
+    # GETTERS, from the child's status
+    def get_status(self, name):
+        return self.ring.status[kStatus[name]]
+
+    def get_primary_speed(self):
+        return self.get_status('primary_speed')
+
+    def get_secondary_speed(self):
+        return self.get_status('secondary_speed')
+
+    def get_primary_bpm(self):
+        return self.get_status('primary_bpm')
+
+    def get_secondary_bpm(self):
+        return self.get_status('secondary_bpm')
+
+    # the child is ahead of what is playing by what is waiting in the ring
+    def get_current_frame(self):
+        frame = self.get_status('frame') - self.ring.get_fill() * self.get_primary_speed()
+        return max(int(frame), 0)
+
+    def get_current_length(self):
+        return int(self.get_status('length'))
+
+    def get_ongoing_effects(self):
+        return
+
+    def enough_past_powerups(self):
+        return bool(self.get_status('enough_past_powerups'))
+
+    # STATS
+    # match command acknowledgements with the time their audio was played
+    def _update_latency(self):
+        while self.conn.poll():
+            seq, pos = self.conn.recv()
+            self.acks.append((pos, self.post_times.pop(seq)))
+
+        while self.acks:
+            pos, t_post = self.acks[0]
+            t_played = self.reader.get_time_played(pos)
+            if t_played is None:
+                break
+            self.latencies.append(t_played - t_post)
+            self.acks.popleft()
+
+    # latency (ms) from posting a command to its audio being handed to the
+    # device, underruns, and how full the ring is
+    def get_stats(self):
+        lat = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'latency_avg_ms': float(lat.mean()), 'latency_max_ms': float(lat.max()),
+                'underruns': self.reader.underruns, 'missing_frames': self.reader.missing_frames,
+                'ring_fill': self.ring.get_fill() if self.ring.header is not None else 0}
+
+    def get_stats_text(self):
+        return 'audio process: latency avg {latency_avg_ms:.1f}ms max {latency_max_ms:.1f}ms, ' \
+               '{underruns} underruns ({missing_frames} frames)'.format(**self.get_stats())
@@ -1,23 +1,37 @@
+from common.core import *
+from common.gfxutil import *
 from audio import *
 from gamevisuals import GameDisplay, MenuDisplay, TutorialDisplay
 from transition import *
+from audioproc import RemoteAudioManager
+from common.profiler import enable_profiling, get_profiler
 
 import time
 
+# render the game's audio in a child process (see audioproc.py)
+kAudioProcess = False
+
+# profile the audio graph (see common/profiler.py). F12 prints the profile.
+kProfileAudio = False
+
 # MAINWIDGET FOR TESTING GAME VISUALS INDEPENDENTLY OF THE ENTIRE GAME
 class MainWidget(BaseWidget) :
     def __init__(self):
         super(MainWidget, self).__init__()
         self.audio = Audio(2)
+        if kProfileAudio:
+            enable_profiling()
         self.anim_group = AnimGroup()
         self.other_label = topright_label()
         self.other_label.text = ""
         self.game_data = GameData()
-        self.audio_manager = AudioManager(self.audio, self.game_data.get_song(), self.game_data.get_next_song())
-        self.tutorial_audio_manager = AudioManager(self.audio, "data/tutorial.wav","data/tutorial.wav")
+        manager_class = RemoteAudioManager if kAudioProcess else AudioManager
+        self.audio_manager = manager_class(self.audio, self.game_data.get_song(), self.game_data.get_next_song())
+        self.tutorial_audio_manager = manager_class(self.audio, "data/tutorial.wav","data/tutorial.wav")
         self.screen = "menu"
         self.song_data = SongData()
         self.song_data.read_data(*self.game_data.song_data_files)
+        self.prefetch_song_data()
         self.game_display = GameDisplay(self.song_data.blocks, self.song_data.powerups, self.audio_manager, self.other_label, self.handle_transition)
         self.menu_display = MenuDisplay()
         self.tutorial_display = TutorialDisplay(self.song_data.blocks, self.song_data.powerups, self.audio_manager,  self.other_label, self)
@@ -44,9 +58,17 @@ class MainWidget(BaseWidget) :
                     self.song_data = SongData()
                     self.game_data = GameData()
                     self.song_data.read_data(*self.game_data.song_data_files)
+                    self.prefetch_song_data()
                     self.playing = False
                     self.screen = "menu"
 
+        if keycode[1] == 'f12' and get_profiler():
+            get_profiler().dump()
+
+        # click along with the song's beat grid, to check it
+        if keycode[1] == 'f11':
+            self.audio_manager.toggle_metronome()
+
         if keycode[1] == 'p':  # PAUSE/PLAY
             if self.screen == "game":
                 self.game_display.toggle()
@@ -133,10 +155,15 @@ class MainWidget(BaseWidget) :
             if self.screen == "tutorial":
                 self.tutorial_display.on_fall()
             
+    # read the next level's chart on a worker thread while this level plays
+    def prefetch_song_data(self):
+        self.song_data_prefetch = Prefetcher(load_song_data, *self.game_data.get_next_song_data_files())
+
     def handle_transition(self):
         self.game_data.transition()
         self.audio_manager.add_transition_song(self.game_data.audio_file_name)
-        self.song_data.read_data(self.game_data.song_data_files[0], self.game_data.song_data_files[1])  ## transition
+        self.song_data = self.song_data_prefetch.get()  ## transition
+        self.prefetch_song_data()
         self.audio_manager.end_transition_song(self.game_data.get_next_song())
         self.game_display.graphics_transition(self.song_data.blocks, self.song_data.powerups, self.game_data.player_images, self.game_data.ground_image,
                                         self.game_data.bg_image, self.game_data.block_image)
@@ -166,32 +193,6 @@ class MainWidget(BaseWidget) :
             self.lifetime += self.new_time - self.prev_time
 
 
-# holds data for blocks and powerups.
-class SongData(object):
-    def __init__(self):
-        super(SongData, self).__init__()
-        self.blocks = []  # list of tuples (seconds, index), ST index is 1-5
-        self.powerups = []  # list of ints for frames to add a barline
-
-    # from lab 2
-    def lines_from_file(self, filename):
-        f = open(filename)
-        g = f.readlines()
-        f.close()
-        return g
-
-    # read the blocks and powerup data. You may want to add a secondary filepath
-    # argument if your poweruppath data is stored in a different txt file.
-    def read_data(self, blockpath, poweruppath):
-        self.blocks, self.powerups = [], []
-        blocklines = self.lines_from_file(blockpath)
-        for line in blocklines:
-            blockline = line.split()
-            self.blocks.append((float(blockline[0]), int(blockline[2]), int(blockline[3])))
-        powerups = self.lines_from_file(poweruppath)
-        for p in powerups:
-            powerup = p.split()
-            self.powerups.append((float(powerup[0]), int(powerup[2]), str(powerup[3])))
-
-
-run(MainWidget)
\ No newline at end of file
+# guarded, since the audio process may import this module
+if __name__ == "__main__":
+    run(MainWidget)
\ No newline at end of file
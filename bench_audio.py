@@ -0,0 +1,96 @@
+# Micro-benchmarks for the audio graph. Run from the repo root:
+#   python bench_audio.py [name ...]
+# with no names, every benchmark runs.
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from common.audio import Audio, generate_into
+from common.mixer import Mixer
+from common.wavegen import WaveGenerator, SpeedModulator
+from common.wavesrc import WaveBuffer
+from common.resample import kResamplers
+
+kBenchFile = "data/riser1.wav"
+kNumBlocks = 200
+
+
+# a small graph shaped like the game's: a master mixer with a song-like
+# generator, a nested mixer (like FilterMixer) holding a sped-up copy, and a riser.
+def make_graph():
+    inner = Mixer()
+    inner.set_gain(1)
+    inner.add(SpeedModulator(WaveGenerator(WaveBuffer(kBenchFile), loop=True), speed=2**(1/12)))
+
+    mixer = Mixer()
+    mixer.add(WaveGenerator(WaveBuffer(kBenchFile), loop=True))
+    mixer.add(inner)
+    mixer.add(WaveGenerator(WaveBuffer(kBenchFile), loop=True))
+    return mixer
+
+
+# render num_blocks blocks through render(num_frames) and report the average time
+# and the average peak of temporary memory allocated while rendering a block.
+# Timing and allocation tracing are separate passes, as tracing slows things down.
+def measure_blocks(render, num_frames, num_blocks = kNumBlocks):
+    render(num_frames) # warm-up: first-touch of buffers and caches
+
+    t_start = time.perf_counter()
+    for i in range(num_blocks):
+        render(num_frames)
+    elapsed = time.perf_counter() - t_start
+
+    tracemalloc.start()
+    peak_bytes = 0
+    for i in range(num_blocks):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        render(num_frames)
+        peak_bytes += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return 1000 * elapsed / num_blocks, peak_bytes / num_blocks
+
+
+# allocations per block through the generate() compatibility shim versus
+# generate_into(). Both run the current generate_into() graph, so this is the
+# cost of the shim's output buffer, not a comparison with the graph from before
+# generate_into() (check out an older revision to measure that).
+def bench_alloc():
+    print('allocations per block (generate() shim vs. generate_into())')
+    print('{:>7} {:>14} {:>12} {:>14} {:>12}'.format('frames', 'shim ms', 'bytes', 'into ms', 'bytes'))
+    for num_frames in (256, 512, 1024):
+        mixer = make_graph()
+        shim = measure_blocks(lambda n: mixer.generate(n, 2), num_frames)
+
+        mixer = make_graph()
+        buf = np.zeros(num_frames * 2, dtype=np.float32)
+        new = measure_blocks(lambda n: generate_into(mixer, buf, n, 2), num_frames)
+
+        print('{:>7} {:>14.3f} {:>12.0f} {:>14.3f} {:>12.0f}'.format(num_frames, shim[0], shim[1], new[0], new[1]))
+
+
+# CPU cost of each resampler quality, for a stereo song at +1 semitone. Also
+# shown as a percentage of the block's playing time, to help pick a tier.
+def bench_resample():
+    print('resampler cost per block (speed 2^(1/12), stereo)')
+    print('{:>8} {:>7} {:>10} {:>10}'.format('quality', 'frames', 'ms', '% of rt'))
+    for quality in kResamplers:
+        for num_frames in (256, 512, 1024):
+            mod = SpeedModulator(WaveGenerator(WaveBuffer(kBenchFile), loop=True), speed=2**(1/12), quality=quality)
+            buf = np.zeros(num_frames * 2, dtype=np.float32)
+            ms, alloc = measure_blocks(lambda n: mod.generate_into(buf, n, 2), num_frames, num_blocks=1000)
+            block_ms = 1000. * num_frames / Audio.sample_rate
+            print('{:>8} {:>7} {:>10.4f} {:>10.2f}'.format(quality, num_frames, ms, 100 * ms / block_ms))
+
+
+kBenchmarks = {'alloc': bench_alloc, 'resample': bench_resample}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(kBenchmarks.keys())
+    for name in names:
+        kBenchmarks[name]()
+        print()
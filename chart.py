@@ -0,0 +1,146 @@
+# Compiled charts. A level's text charts (blocks and powerups, see
+# SongData.read_data) are parsed once and saved as columns in an .npz file under
+# data/charts/. Later loads read the columns straight back, as long as the text
+# file hasn't changed since (the compiled file remembers its mtime and size). Entities
+# are kept sorted by time, so the game can find the ones coming on screen with
+# a binary search instead of walking the chart.
+
+import os
+import os.path
+import hashlib
+import numpy as np
+
+kChartDir = "data/charts"
+kChartVersion = 2       # bump when the compiled format changes
+
+# powerup types get these codes, in this order. Types not listed get codes
+# after them, per chart (each compiled chart stores its own table).
+kPowerupTypes = ["speedup", "slowdown", "reset_speed", "lower_volume", "raise_volume",
+                 "bass_boost", "vocals_boost", "reg_to_high", "reset_filter", "sample_on",
+                 "sample_off", "reset_sample", "riser", "danger", "trophy", "transition",
+                 "transition_token", "reset", "powerup_note", "error"]
+
+
+# A chart as columns: times (float64 seconds, ascending), lanes (int8), and
+# values (int8 block units, or uint8 powerup codes into names). Indexing gives
+# the same tuples SongData used to hold, (time, lane, units) or (time, lane,
+# type), made only for the entities asked for.
+class Chart(object):
+    def __init__(self, times, lanes, values, names = None):
+        super(Chart, self).__init__()
+        self.times = times
+        self.lanes = lanes
+        self.values = values
+        self.names = names      # powerup type of each code, or None for blocks
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        value = int(self.values[i])
+        if self.names is not None:
+            value = self.names[value]
+        return (float(self.times[i]), int(self.lanes[i]), value)
+
+    def __iter__(self):
+        for i in range(len(self.times)):
+            yield self[i]
+
+    # index range of the entities with start < time <= end, found in O(log n)
+    def get_window(self, start, end):
+        return (int(np.searchsorted(self.times, start, 'right')),
+                int(np.searchsorted(self.times, end, 'right')))
+
+
+# Walks a Chart as time goes on: take_until(time) returns the indices of the
+# entities due since the last call. Each call is a binary search, however big
+# the chart and however far time moved. If time goes back, so does the cursor.
+class ChartCursor(object):
+    def __init__(self, chart):
+        super(ChartCursor, self).__init__()
+        self.chart = chart
+        self.index = 0
+
+    def take_until(self, time):
+        end = int(np.searchsorted(self.chart.times, time, 'right'))
+        start = min(self.index, end)
+        self.index = end
+        return range(start, end)
+
+    def reset(self):
+        self.index = 0
+
+
+# parse a text chart: the time, a bar.beat (ignored), the lane, and then the
+# block's units (an int) or the powerup's type
+def parse_chart(filepath, powerups):
+    times, lanes, values = [], [], []
+    names = list(kPowerupTypes)
+    codes = dict((name, code) for code, name in enumerate(names))
+    for line in open(filepath).readlines():
+        fields = line.split()
+        if not fields:
+            continue
+        times.append(float(fields[0]))
+        lanes.append(int(fields[2]))
+        if powerups:
+            if fields[3] not in codes:
+                codes[fields[3]] = len(names)
+                names.append(fields[3])
+            values.append(codes[fields[3]])
+        else:
+            values.append(int(fields[3]))
+
+    # sorted by time. A stable sort keeps entities at the same time in file order.
+    order = np.argsort(np.array(times, dtype=np.float64), kind='stable')
+    times = np.array(times, dtype=np.float64)[order]
+    lanes = np.array(lanes, dtype=np.int8)[order]
+    values = np.array(values, dtype=np.uint8 if powerups else np.int8)[order]
+    return Chart(times, lanes, values, names if powerups else None)
+
+# where the compiled form of filepath goes. Named for the text file's full
+# path, so charts with the same name in different folders don't collide.
+def compiled_path(filepath):
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(kChartDir, '%s_%s.npz' % (name, key))
+
+# save chart, compiled from filepath, where load_chart() will look for it.
+# Writes to a temporary file first, so a half-written chart is never loaded.
+def save_chart(chart, filepath):
+    path = compiled_path(filepath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    names = np.array(chart.names if chart.names is not None else [], dtype=str)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, version=kChartVersion, path=os.path.abspath(filepath),
+                 mtime=os.path.getmtime(filepath), size=os.path.getsize(filepath),
+                 times=chart.times, lanes=chart.lanes, values=chart.values, names=names)
+    os.replace(path + '.tmp', path)
+
+# the compiled chart of filepath, or None if it's missing or out of date
+def read_compiled_chart(filepath, powerups):
+    path = compiled_path(filepath)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            if data['version'] != kChartVersion or data['path'] != os.path.abspath(filepath) or \
+               data['mtime'] != os.path.getmtime(filepath) or data['size'] != os.path.getsize(filepath):
+                return None
+            names = data['names'].tolist() if powerups else None
+            return Chart(data['times'], data['lanes'], data['values'], names)
+    except (OSError, ValueError, KeyError):
+        return None
+
+# load a text chart, from its compiled form when that's up to date. Otherwise
+# parse the text, and compile it for next time. powerups says which kind of
+# chart it is.
+def load_chart(filepath, powerups = False):
+    chart = read_compiled_chart(filepath, powerups)
+    if chart is None:
+        chart = parse_chart(filepath, powerups)
+        try:
+            save_chart(chart, filepath)
+        except OSError:
+            pass    # a read-only tree still plays, it just parses every time
+    return chart
@@ -9,125 +9,352 @@
 #####################################################################
 
 import sys
+import atexit
 sys.path.append('.')
 sys.path.append('..')
 
-import pyaudio
 import numpy as np
-from common import core
 import time
 import os.path
+import threading
+import traceback
+from collections import deque
 from configparser import ConfigParser
+from .sinks import pyaudio, make_sink, PyAudioSink
+from .audiostats import AudioStats
+from .latency import LatencyController
+
+
+# Commands for the audio thread: single producer (the game / UI thread), single
+# consumer (whoever renders audio). A deque's append and popleft are atomic, so
+# no lock is needed. Commands run in the order they were posted, between blocks,
+# so generators are only ever changed by the thread that renders them.
+class CommandQueue(object):
+    def __init__(self):
+        super(CommandQueue, self).__init__()
+        self.queue = deque()
+
+    def post(self, func, *args):
+        self.queue.append((func, args))
+
+    # run what was posted before this call. A failing command is reported and
+    # skipped, so it can't take the audio thread down with it.
+    def run(self):
+        for i in range(len(self.queue)):
+            func, args = self.queue.popleft()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def __len__(self):
+        return len(self.queue)
 
 
 class Audio(object):
     # global variable: might change when Audio driver is set up.
     sample_rate = 44100
 
-    def __init__(self, num_channels, listen_func = None, input_func = None):
+    # generators are always asked for exactly this many frames (a power of two).
+    # Also set up by the Audio driver, from the config ('quantum').
+    quantum = 256
+
+    # mode is how audio gets rendered:
+    #   'poll':     on_update() renders what the stream can take. Call it every frame.
+    #   'callback': PyAudio's callback thread renders each buffer as it is needed.
+    #   'thread':   a thread of our own renders and does blocking writes.
+    # In the threaded modes, audio keeps playing however slow the UI is. Change
+    # generators with post() so that the change happens on the audio thread.
+    # If mode is None, it comes from the audio config ('audiomode').
+    #
+    # sink is where the audio goes (see sinks.py): a sink object, or a name for
+    # make_sink(). If None, it comes from the audio config ('sink'). Without
+    # pyaudio installed, the default is a null sink paced by the real clock.
+    #
+    # With 'latencycontrol' set in the audio config, a LatencyController (see
+    # latency.py) picks how full to keep the output's buffer, from the stats.
+    # Otherwise (and in 'callback' mode, where the sound card decides) it is
+    # kept full.
+    #
+    # However many frames the output asks for, the generator renders in blocks
+    # of Audio.quantum frames, into a FIFO that the output is fed from. That way
+    # every block costs about the same, and block-based effects (like FFTs) can
+    # count on the block size. Posted commands run between quanta. The offline
+    # and out-of-process renderers (render_level.py, audioproc.py) also render a
+    # quantum at a time, so commands land on the same boundaries there.
+    def __init__(self, num_channels, listen_func = None, input_func = None, mode = None, sink = None):
         super(Audio, self).__init__()
 
         assert(num_channels == 1 or num_channels == 2)
         self.num_channels = num_channels
         self.listen_func = listen_func
         self.input_func = input_func
-        self.audio = pyaudio.PyAudio()
 
-        out_dev, in_dev, buffer_size, sr = self._get_parameters()
+        out_dev, in_dev, buffer_size, sr, config_mode, config_sink, stats_log, latency_control, quantum = self._get_parameters()
         Audio.sample_rate = sr
+        assert(quantum > 0 and quantum & (quantum - 1) == 0)
+        Audio.quantum = quantum
+        self.mode = mode or config_mode
+        assert(self.mode in ('poll', 'callback', 'thread'))
+        self.buffer_size = buffer_size
 
-        # create stream
-        self.stream = self.audio.open(format = pyaudio.paFloat32,
-                                      channels = num_channels,
-                                      frames_per_buffer = buffer_size,
-                                      rate = Audio.sample_rate,
-                                      output = True,
-                                      input = input_func != None,
-                                      output_device_index = out_dev,
-                                      input_device_index = in_dev)
+        sink = sink or config_sink
+        if sink == 'pyaudio' and pyaudio is None:
+            print('pyaudio not found: using a null audio sink')
+            sink = 'null'
+
+        # only PyAudio can call us back. Other sinks get a thread of our own.
+        if self.mode == 'callback' and sink != 'pyaudio':
+            self.mode = 'thread'
 
         self.generator = None
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.fifo = np.zeros(0, dtype=np.float32)    # rendered, but not handed to the output yet
+        self.fifo_fill = 0                             # in samples
         self.cpu_time = 0
-        core.register_terminate_func(self.close)
-
+        self.commands = CommandQueue()
+        self.stats = AudioStats(Audio.sample_rate, stats_log)
+
+        # data for listen_func / input_func, handed from the audio thread to on_update()
+        self.ui_queue = deque(maxlen=64)
+
+        # create the output
+        if sink == 'pyaudio':
+            self.sink = PyAudioSink(num_channels, Audio.sample_rate, buffer_size, out_dev, in_dev,
+                                    input = input_func != None,
+                                    callback = self._callback if self.mode == 'callback' else None)
+        elif isinstance(sink, str):
+            self.sink = make_sink(sink, num_channels, Audio.sample_rate, buffer_size)
+        else:
+            self.sink = sink
+
+        self.latency = None
+        if latency_control and self.mode != 'callback':
+            capacity = self.sink.get_capacity() or 8 * buffer_size
+            self.latency = LatencyController(Audio.sample_rate, buffer_size, 2 * buffer_size, capacity)
+
+        self.running = True
+        self.thread = None
+        if self.mode == 'thread':
+            self.thread = threading.Thread(target=self._thread_loop, name='audio')
+            self.thread.daemon = True
+            self.thread.start()
+
+        # close with kivy's app where there is kivy. Without it (rendering on a
+        # headless machine, say), close at exit instead.
+        self.closed = False
+        try:
+            from common import core
+            core.register_terminate_func(self.close)
+        except ImportError:
+            atexit.register(self.close)
+
+    # safe to call more than once
     def close(self) :
-        self.stream.stop_stream()
-        self.stream.close()
-        self.audio.terminate()
+        if self.closed:
+            return
+        self.closed = True
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.sink.close()
 
     # set a generator. The generator must support the method
     # generate(num_frames, num_channels), 
     # which returns a numpy array of length (num_frames * num_channels)
+    # If it also supports generate_into() (see below), it renders straight into
+    # a buffer owned by Audio.
     def set_generator(self, gen) :
         self.generator = gen
 
+    # run func(*args) on the thread that renders audio, before its next block.
+    # In 'poll' mode that is this thread, so it runs right away.
+    def post(self, func, *args):
+        self.stats.mark(getattr(func, '__name__', '?'))
+        if self.mode == 'poll':
+            func(*args)
+        else:
+            self.commands.post(func, *args)
+
+    # note a game event, so that underruns can be matched with it (see audiostats.py)
+    def mark(self, label):
+        self.stats.mark(label)
+
+    # underruns, block render times and sizes, frames requested and delivered,
+    # and the latency
+    def get_stats(self):
+        stats = self.stats.get_stats()
+        stats['latency_ms'] = self.get_latency_ms()
+        return stats
+
+    # how far ahead of the sound card we render, in milliseconds
+    def get_latency_ms(self):
+        if self.latency:
+            return self.latency.get_latency_ms()
+        frames = self.sink.get_capacity() or self.buffer_size
+        return 1000. * frames / Audio.sample_rate
+
+    # how many of the available frames to render now: all of them, unless the
+    # latency controller wants the output less full
+    def _get_frames_to_write(self, available):
+        capacity = self.sink.get_capacity()
+        if not self.latency or not capacity:
+            return available
+        queued = capacity - available
+        return max(min(available, self.latency.get_target() - queued), 0)
+
     # return cpu time calcuating audio time in milliseconds
     def get_cpu_load(self) :
         return 1000 * self.cpu_time
 
     # must call this every frame.
     def on_update(self):
-        t_start = time.time()
+        if self.mode != 'poll':
+            # rendering happens on the audio thread. Just pass on its data.
+            while self.ui_queue:
+                func, data = self.ui_queue.popleft()
+                func(data, self.num_channels)
+            return
 
         # get input audio if desired
         if self.input_func:
             try:
-                num_frames = self.stream.get_read_available() # number of frames to ask for
+                num_frames = self.sink.get_read_available() # number of frames to ask for
                 if num_frames:
-                    data_str = self.stream.read(num_frames, False)
-                    data_np = np.fromstring(data_str, dtype=np.float32)
-                    self.input_func(data_np, self.num_channels)
+                    self.input_func(self.sink.read(num_frames), self.num_channels)
             except IOError as e:
                 print('got error', e)
 
         # Ask the generator to generate some audio samples.
-        num_frames = self.stream.get_write_available() # number of frames to supply
+        available = self.sink.get_write_available()
+        num_frames = self._get_frames_to_write(available) # number of frames to supply
         if self.generator and num_frames != 0:
-            (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
+            data = self._render(num_frames, requested = available, available = available)
 
-            # make sure we got the correct number of frames that we requested
-            assert len(data) == num_frames * self.num_channels, \
-                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+            # write to stream
+            self.sink.write(data)
 
-            # convert type if needed and write to stream
-            if data.dtype != np.float32:
-                data = data.astype(np.float32)
-            self.stream.write(data.tostring())
-
-            # send data to listerner as well
+            # send data to listerner as well. data is our buffer, so it gets a copy
             if self.listen_func:
-                self.listen_func(data, self.num_channels)
+                self.listen_func(data.copy(), self.num_channels)
 
-            # continue flag
-            if not continue_flag:
-                self.generator = None
+    # get num_frames into our buffer, from the FIFO, rendering as many quanta as
+    # that takes. Returns the part of the buffer used. requested (what the output
+    # asked for, when that's more than num_frames), available (free frames in the
+    # output) and underrun go to the stats.
+    def _render(self, num_frames, requested = None, available = None, underrun = False):
+        t_start = time.time()
+        num_samples = num_frames * self.num_channels
+        quantum_samples = Audio.quantum * self.num_channels
+        if len(self.buffer) < num_samples:
+            self.buffer = np.zeros(num_samples, dtype=np.float32)
+        if len(self.fifo) < num_samples + quantum_samples:
+            fifo = np.zeros(num_samples + quantum_samples, dtype=np.float32)
+            fifo[:self.fifo_fill] = self.fifo[:self.fifo_fill]
+            self.fifo = fifo
+
+        delivered = 0
+        while self.fifo_fill < num_samples:
+            delivered += self._render_quantum(self.fifo[self.fifo_fill:self.fifo_fill + quantum_samples])
+            self.fifo_fill += quantum_samples
+
+        # hand out the oldest num_frames, and move what's left to the front
+        data = self.buffer[:num_samples]
+        data[:] = self.fifo[:num_samples]
+        left = self.fifo_fill - num_samples
+        self.fifo[:left] = self.fifo[num_samples:self.fifo_fill]
+        self.fifo_fill = left
 
         # how long this all took
         dt = time.time() - t_start
         a = 0.9
         self.cpu_time = a * self.cpu_time + (1-a) * dt
+        self.stats.add_block(num_frames if requested is None else requested, delivered, dt,
+                             available, self.sink.get_capacity(), underrun)
+        if self.latency:
+            self.latency.update(self.stats)
+        return data
+
+    # run pending commands and render one quantum from the generator (silence if
+    # there is none) into out. Returns the number of frames the generator made.
+    def _render_quantum(self, out):
+        self.commands.run()
+        generator = self.generator
+        if generator:
+            continue_flag = generate_into(generator, out, Audio.quantum, self.num_channels)
+            if not continue_flag:
+                self.generator = None
+            return Audio.quantum
+        else:
+            out.fill(0)
+            return 0
+
+    # 'callback' mode: PyAudio calls this on its own thread for every buffer
+    def _callback(self, in_data, frame_count, time_info, status):
+        if in_data and self.input_func:
+            self.ui_queue.append((self.input_func, np.frombuffer(in_data, dtype=np.float32)))
+
+        underrun = bool(status & pyaudio.paOutputUnderflow)
+        data = self._render(frame_count, underrun = underrun)
+        if self.listen_func:
+            self.ui_queue.append((self.listen_func, data.copy()))
+        return (data.tobytes(), pyaudio.paContinue if self.running else pyaudio.paComplete)
+
+    # 'thread' mode: blocking writes pace the loop to the sound card
+    def _thread_loop(self):
+        while self.running:
+            if self.input_func:
+                try:
+                    num_frames = self.sink.get_read_available()
+                    if num_frames:
+                        self.ui_queue.append((self.input_func, self.sink.read(num_frames)))
+                except IOError as e:
+                    print('got error', e)
+
+            # with a latency target, wait until a block fits under it
+            available = self.sink.get_write_available()
+            if self.latency and self._get_frames_to_write(available) < self.buffer_size:
+                time.sleep(0.001)
+                continue
+
+            data = self._render(self.buffer_size, available = available)
+            self.sink.write(data)
+            if self.listen_func:
+                self.ui_queue.append((self.listen_func, data.copy()))
 
 
-    # return parameter values for output device idx, input device idx, and
-    # buffer size
+    # return parameter values for output device idx, input device idx, buffer
+    # size, sample rate, mode, sink, stats log interval, latency control and
+    # render quantum
     def _get_parameters(self):
-        config = load_audio_config(self.audio)
+        # imported here: resample.py builds on this module
+        from .resample import set_default_quality
+
+        config = load_audio_config()
 
         out_dev     = config['outputdevice']
         in_dev      = config['inputdevice']
         buf_size    = config['buffersize']
         sample_rate = config['samplerate']
+        mode        = config['audiomode']
+        sink        = config['sink']
+        stats_log   = config['statslog']
+        latency     = config['latencycontrol']
+        quantum     = config['quantum']
+        set_default_quality(config['resampler'])
 
         # for Windows, we want to find the ASIO host API and associated devices
-        if out_dev == 'None':
-            cnt = self.audio.get_host_api_count()
+        if out_dev == 'None' and sink == 'pyaudio' and pyaudio:
+            py_audio = pyaudio.PyAudio()
+            cnt = py_audio.get_host_api_count()
             for i in range(cnt):
-                api = self.audio.get_host_api_info_by_index(i)
+                api = py_audio.get_host_api_info_by_index(i)
                 if api['type'] == pyaudio.paASIO:
                     host_api_idx = i
                     out_dev = api['defaultOutputDevice']
                     in_dev = api['defaultInputDevice']
                     print('Found ASIO API', host_api_idx)
+            py_audio.terminate()
 
         # string 'None' must be converted to type None for pyaudio API to work
         if out_dev == 'None':
@@ -136,9 +363,44 @@ class Audio(object):
             in_dev = None
 
         print('using audio params:')
-        print('  samplerate: {}\n  buffersize: {}\n  outputdevice: {}\n  inputdevice: {}'.format(
-            sample_rate, buf_size, out_dev, in_dev))
-        return out_dev, in_dev, buf_size, sample_rate
+        print('  samplerate: {}\n  buffersize: {}\n  outputdevice: {}\n  inputdevice: {}\n  resampler: {}\n  audiomode: {}\n  sink: {}\n  quantum: {}'.format(
+            sample_rate, buf_size, out_dev, in_dev, config['resampler'], mode, sink, quantum))
+        return out_dev, in_dev, buf_size, sample_rate, mode, sink, stats_log, latency, quantum
+
+
+# Generators may also support the allocation-free method
+# generate_into(out, num_frames, num_channels),
+# which writes exactly (num_frames * num_channels) float32 samples into the
+# numpy array out and returns continue_flag. This calls generate_into() when the
+# generator has it, and otherwise falls back to generate() and copies the result
+# (zero-padded if short) into out.
+def generate_into(gen, out, num_frames, num_channels):
+    if hasattr(gen, 'generate_into'):
+        return gen.generate_into(out, num_frames, num_channels)
+
+    (data, continue_flag) = gen.generate(num_frames, num_channels)
+    n = len(data)
+    assert n <= len(out), "asked for (%d * %d) frames but got %d" % (num_frames, num_channels, n)
+    out[:n] = data
+    out[n:] = 0
+    return continue_flag
+
+# Generators may also support advance(num_frames, num_channels), which moves
+# them forward num_frames exactly as generate_into() would, without rendering
+# anything, and returns continue_flag. It's for sources nobody can hear (say, at
+# zero gain in a Mixer) that must keep their place. This calls advance() when
+# the generator has it, and otherwise renders the frames and throws them away.
+def advance(gen, num_frames, num_channels):
+    if hasattr(gen, 'advance'):
+        return gen.advance(num_frames, num_channels)
+    return gen.generate(num_frames, num_channels)[1]
+
+# compatibility shim for the old generate() API: a generator that implements
+# generate_into() can define generate() by returning this.
+def generate_from_into(gen, num_frames, num_channels):
+    output = np.empty(num_frames * num_channels, dtype=np.float32)
+    continue_flag = gen.generate_into(output, num_frames, num_channels)
+    return (output, continue_flag)
 
 
 # location of config file (in User's home directory)
@@ -147,7 +409,6 @@ CONFIG_FILE = os.path.expanduser('~/audio_config.cfg')
 
 # load config file. If not found or missing items, will setup default values
 def load_audio_config(py_audio = None):
-    devices = get_audio_devices(py_audio)
     out = {}
 
     config = ConfigParser()
@@ -155,8 +416,12 @@ def load_audio_config(py_audio = None):
         config.read((CONFIG_FILE))
         items = config.items('audio')
 
+        # values are integers, except for 'None' and names (like resampler quality)
         for opt in items:
-            val = 'None' if opt[1] == 'None' else int(opt[1])
+            try:
+                val = int(opt[1])
+            except ValueError:
+                val = opt[1]
             out[ opt[0] ] = val
 
     except Exception as e:
@@ -176,7 +441,41 @@ def load_audio_config(py_audio = None):
     if 'samplerate' not in out:
         out['samplerate'] = 44100
 
-    # make sure input and output devices are valid:
+    # quality of the resampler used for speed changes: linear, cubic or sinc
+    if 'resampler' not in out:
+        out['resampler'] = 'linear'
+
+    # how audio is rendered: poll (from the UI loop), callback or thread. See Audio.
+    if 'audiomode' not in out:
+        out['audiomode'] = 'poll'
+
+    # where audio goes: pyaudio, null, free or a .wav / .npy file. See sinks.py.
+    if 'sink' not in out:
+        out['sink'] = 'pyaudio'
+
+    # print audio stats (see audiostats.py) every this many seconds. 0 is never.
+    if 'statslog' not in out:
+        out['statslog'] = 0
+
+    # frames the generator renders at a time (a power of two). See Audio.
+    if 'quantum' not in out:
+        out['quantum'] = 256
+
+    # so each output block is a whole number of quanta, with nothing left
+    # waiting in Audio's FIFO (or in audioproc.py's ring, sized in blocks)
+    assert out['buffersize'] % out['quantum'] == 0, \
+        'quantum (%d) must divide buffersize (%d)' % (out['quantum'], out['buffersize'])
+
+    # 1 to adapt the latency to how well the machine keeps up. See latency.py.
+    if 'latencycontrol' not in out:
+        out['latencycontrol'] = 0
+
+    # make sure input and output devices are valid. Only the sound card has
+    # devices, so other sinks don't go looking for hardware.
+    if out['sink'] != 'pyaudio' or pyaudio is None:
+        return out
+    devices = get_audio_devices(py_audio)
+
     if out['outputdevice'] != 'None' and out['outputdevice'] >= len(devices['output']):
         out['outputdevice'] = 'None'
 
@@ -215,10 +514,12 @@ def get_audio_devices(py_audio = None):
         info['channels'] = dev['max' + io_type + 'Channels']
         arr.append(info)
 
-    audio = py_audio if py_audio else pyaudio.PyAudio()
-
     out_devs = [{'index':'None', 'name':'Default', 'channels':0, 'latency':(0,0)}]
     in_devs  = [{'index':'None', 'name':'Default', 'channels':0, 'latency':(0,0)}]
+    if pyaudio is None:
+        return {'output': out_devs, 'input': in_devs}
+
+    audio = py_audio if py_audio else pyaudio.PyAudio()
 
     cnt = audio.get_device_count()
     for i in range(cnt):
@@ -0,0 +1,106 @@
+#####################################################################
+#
+# audiostats.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import time
+import numpy as np
+from collections import deque
+
+# histogram bin upper edges: block render time (ms) and block size (frames)
+kRenderBins = [0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, float('inf')]
+kSizeBins = [64, 128, 256, 512, 1024, 2048, 4096, float('inf')]
+
+# an underrun is likely if the output has this much of its buffer free when we write
+kUnderrunFraction = 0.9
+
+# underruns keep the marks made in this many seconds before them
+kMarkWindow = 2.0
+
+
+# Statistics about how Audio keeps up: block render times and sizes, frames the
+# output asked for versus frames delivered, and underruns. Game code can mark()
+# events (Audio.post() marks every command), and each underrun remembers the
+# marks just before it, so dropouts can be matched with what the game was doing.
+class AudioStats(object):
+    def __init__(self, sample_rate, log_interval = 0):
+        super(AudioStats, self).__init__()
+        self.sample_rate = sample_rate
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        self.render_hist = np.zeros(len(kRenderBins), dtype=np.int64)
+        self.size_hist = np.zeros(len(kSizeBins), dtype=np.int64)
+        self.recent_ms = deque(maxlen=1000)
+        self.blocks = 0
+        self.frames_requested = 0
+        self.frames_delivered = 0
+        self.render_time = 0.
+        self.underruns = 0
+        self.underrun_log = deque(maxlen=100)    # (time, frames delivered so far, [marks])
+        self.marks = deque(maxlen=256)           # (time, label)
+        self.start_time = time.time()
+        self.last_log = self.start_time
+
+    # note an event (like a powerup or a transition) to correlate with underruns
+    def mark(self, label):
+        self.marks.append((time.time(), label))
+
+    # one block: the output asked for requested frames, and we delivered
+    # delivered frames in render_secs. underrun is for outputs that report
+    # underruns themselves. Otherwise, if the output buffer holds capacity frames
+    # and had available of them free, a nearly empty buffer counts as an underrun.
+    def add_block(self, requested, delivered, render_secs, available = None, capacity = None, underrun = False):
+        self.blocks += 1
+        self.frames_requested += requested
+        self.frames_delivered += delivered
+        self.render_time += render_secs
+        ms = 1000 * render_secs
+        self.recent_ms.append(ms)
+        self.render_hist[np.searchsorted(kRenderBins, ms)] += 1
+        self.size_hist[np.searchsorted(kSizeBins, requested)] += 1
+
+        # the first block always finds the buffer empty
+        if available is not None and capacity and self.blocks > 1:
+            underrun = underrun or available >= kUnderrunFraction * capacity
+
+        if underrun:
+            self._add_underrun()
+
+        if self.log_interval and time.time() - self.last_log >= self.log_interval:
+            self.last_log = time.time()
+            print(self.get_log_line())
+
+    def _add_underrun(self):
+        now = time.time()
+        self.underruns += 1
+        marks = [label for (t, label) in self.marks if now - t <= kMarkWindow]
+        self.underrun_log.append((now, self.frames_delivered, marks))
+
+    # render time percentile (ms) over the recent blocks, or only the last ones
+    def get_percentile(self, p, last = None):
+        recent = list(self.recent_ms)[-last:] if last else self.recent_ms
+        return float(np.percentile(recent, p)) if len(recent) else 0.
+
+    def get_stats(self):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return {'blocks': self.blocks,
+                'frames_requested': self.frames_requested,
+                'frames_delivered': self.frames_delivered,
+                'underruns': self.underruns,
+                'underrun_log': list(self.underrun_log),
+                'render_ms_p50': self.get_percentile(50),
+                'render_ms_p99': self.get_percentile(99),
+                'render_ms_max': max(self.recent_ms) if self.recent_ms else 0.,
+                'render_hist': dict(zip(kRenderBins, self.render_hist.tolist())),
+                'size_hist': dict(zip(kSizeBins, self.size_hist.tolist())),
+                'load': self.render_time / elapsed}
+
+    def get_log_line(self):
+        return 'audio: {blocks} blocks, {frames_delivered}/{frames_requested} frames, ' \
+               '{underruns} underruns, render p50 {render_ms_p50:.2f}ms p99 {render_ms_p99:.2f}ms ' \
+               'max {render_ms_max:.2f}ms, load {load:.1%}'.format(**self.get_stats())
@@ -0,0 +1,116 @@
+#####################################################################
+#
+# automation.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+from collections import deque
+
+
+# One automatable parameter (like a gain), with linear ramps scheduled in
+# frames. The owner calls render() once per block to get the block's values,
+# one per frame, which is what makes changes sample-accurate and free of
+# zipper noise. Rendering costs the same however many ramps are scheduled:
+# only the (at most few) ramps that overlap the block are looked at.
+class Automation(object):
+    def __init__(self, value = 1.0):
+        super(Automation, self).__init__()
+        self.frame = 0          # frames rendered so far
+        self.value = value      # value at self.frame, if no ramp is running
+        self.ramps = deque()    # (start_frame, end_frame, start_value, end_value), in order
+        self.ramp = np.zeros(0, dtype=np.float32)
+
+    # jump to value right away, cancelling any ramps
+    def set_value(self, value):
+        self.ramps.clear()
+        self.value = value
+
+    # ramp linearly to value over num_frames, starting delay frames from now.
+    # Replaces any ramps that would have run after that point.
+    def ramp_to(self, value, num_frames, delay = 0):
+        start = self.frame + delay
+        while self.ramps and self.ramps[-1][0] >= start:
+            self.ramps.pop()
+        start_value = self.get_value_at(start)
+        if self.ramps and self.ramps[-1][1] > start:
+            s, e, v0, v1 = self.ramps.pop()
+            self.ramps.append((s, start, v0, start_value))
+        self.ramps.append((start, start + max(num_frames, 1), start_value, value))
+
+    # value at frame (which must not be earlier than self.frame)
+    def get_value_at(self, frame):
+        value = self.value
+        for (s, e, v0, v1) in self.ramps:
+            if frame < s:
+                break
+            if frame < e:
+                return v0 + (v1 - v0) * (frame - s) / float(e - s)
+            value = v1
+        return value
+
+    def get_value(self):
+        return self.get_value_at(self.frame)
+
+    # value once every scheduled ramp is done
+    def get_target(self):
+        return self.ramps[-1][3] if self.ramps else self.value
+
+    # true if no ramp is running or scheduled
+    def is_static(self):
+        return not self.ramps
+
+    # advance num_frames. Returns None if the value stays at self.value for the
+    # whole block (so the caller can use one number), otherwise fills env
+    # (float32, at least num_frames long) with one value per frame and returns
+    # env[:num_frames].
+    def render(self, env, num_frames):
+        start = self.frame
+        end = start + num_frames
+        self.frame = end
+        if not self.ramps or self.ramps[0][0] >= end:
+            return None
+
+        if len(self.ramp) < num_frames:
+            self.ramp = np.arange(num_frames, dtype=np.float32)
+        env = env[:num_frames]
+
+        pos = 0
+        while self.ramps and self.ramps[0][0] < end:
+            s, e, v0, v1 = self.ramps[0]
+            a = max(s, start) - start
+            b = min(e, end) - start
+            env[pos:a] = self.value
+
+            # env[a:b] = v0 + slope * (frame - s)
+            slope = (v1 - v0) / float(e - s)
+            np.multiply(self.ramp[:b - a], slope, out=env[a:b])
+            env[a:b] += v0 + slope * (start + a - s)
+            pos = b
+
+            if e > end:
+                break
+            self.ramps.popleft()
+            self.value = v1
+
+        env[pos:] = self.value
+        return env
+
+    # advance num_frames without rendering anything, like render() would
+    def advance(self, num_frames):
+        self.frame += num_frames
+        while self.ramps and self.ramps[0][1] <= self.frame:
+            self.value = self.ramps.popleft()[3]
+
+    # apply this automation as a gain to num_frames of interleaved data. env
+    # is work space, at least num_frames long.
+    def apply(self, data, env, num_frames, num_channels):
+        gains = self.render(env, num_frames)
+        if gains is None:
+            if self.value != 1.0:
+                data *= self.value
+        else:
+            frames = data.reshape(num_frames, num_channels)
+            frames *= gains[:, np.newaxis]
@@ -0,0 +1,290 @@
+#####################################################################
+#
+# beattrack.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .wavesrc import WaveFile
+
+# Offline analysis of a song, to chart a level without annotating it by hand.
+# analyze() finds the song's onsets (spectral flux of a short-time Fourier
+# transform), its tempo (autocorrelation of the onsets), and its beats and bars
+# (dynamic programming over the onsets at that tempo). make_blocks() and
+# make_powerups() turn that into charts in the format SongData.read_data()
+# reads, and the beats into a grid for read_beats_file().
+#
+# Charting is a first draft: the beats and bars are usually right, but what
+# goes where is mechanical, so a level still wants a look (and some edits)
+# before it ships.
+
+kFrameSize = 2048        # STFT frame, in samples
+kHopSize = 512           # STFT hop, in samples
+kChunkFrames = 1024      # STFT frames transformed at once (bounds the memory used)
+kCompression = 100.      # log(1 + c * magnitude) compression of the spectrum
+kLocalMeanSecs = 0.5     # the onset envelope is taken relative to its mean over this long
+kBandEdges = [250., 2000.]   # Hz: splits the spectrum into low, mid and high bands
+
+kMinBpm = 60.
+kMaxBpm = 180.
+kPreferredBpm = 110.     # tempo estimates are weighted towards this...
+kTempoOctaves = 1.0      # ...falling off over this many octaves
+kTightness = 100.        # how strictly beats keep to the tempo
+kBeatsPerBar = 4
+
+kLeadInBeats = 8         # no blocks or powerups in the first beats of a song
+kBlockSpacing = 4        # beats between blocks, at least
+kMaxUnits = 4            # widest block
+kPowerupBars = 2         # a powerup every this many bars, between the blocks
+
+# powerups, in the order they are handed out. Effects that come in pairs
+# (sample_on / sample_off) stay next to each other.
+kPowerupCycle = ["speedup", "bass_boost", "reset_filter", "sample_on", "sample_off",
+                 "slowdown", "vocals_boost", "reset_filter", "riser", "lower_volume",
+                 "raise_volume", "reset_speed"]
+
+
+# what analyze() found in a song. Times are in seconds.
+class BeatAnalysis(object):
+    def __init__(self, sample_rate, frame_rate, onsets, bands, bpm, beat_frames, phase):
+        super(BeatAnalysis, self).__init__()
+        self.sample_rate = sample_rate
+        self.frame_rate = frame_rate     # onset envelope values per second
+        self.onsets = onsets             # onset strength, one per STFT frame
+        self.bands = bands               # onset strength in the low, mid and high bands
+        self.bpm = bpm
+        self.beat_frames = beat_frames   # STFT frame of each beat
+        self.beat_times = beat_frames / frame_rate
+
+        # bar and beat (both counted from 1) of each beat. Beats before the
+        # first downbeat are a pickup, at the end of bar 1.
+        pos = np.arange(len(beat_frames)) - phase + (kBeatsPerBar if phase else 0)
+        self.bars = pos // kBeatsPerBar + 1
+        self.beats = pos % kBeatsPerBar + 1
+
+        # onset strength at each beat (the strongest frame near it), overall and
+        # in each band relative to that band's average
+        self.beat_strength = _peak_near(onsets, beat_frames, 2)
+        beat_bands = np.stack([_peak_near(b, beat_frames, 2) for b in bands.T], axis=1)
+        self.beat_bands = beat_bands / np.maximum(beat_bands.mean(axis=0), 1e-9)
+
+    def get_onset_times(self):
+        o = self.onsets
+        peaks = np.nonzero((o[1:-1] > o[:-2]) & (o[1:-1] >= o[2:]) & (o[1:-1] > o.mean()))[0] + 1
+        return peaks / self.frame_rate
+
+
+# the song in filepath as mono float32, and its sample rate
+def load_mono(filepath):
+    wave = WaveFile(filepath)
+    data = wave.get_frames(0, wave.get_length())
+    return data.reshape(-1, wave.get_num_channels()).mean(axis=1), wave.sr
+
+# onset strength (half-wave rectified spectral flux of the log spectrum) of
+# mono, one value per hop, with frame i centered on sample i * kHopSize. The
+# low, mid and high bands count the same, so the many high bins of hi-hats
+# don't drown out the kick drum. Also returns the flux of each band, as an
+# (n, 3) array.
+def onset_strength(mono, sample_rate):
+    pad = np.zeros(kFrameSize // 2, dtype=mono.dtype)
+    mono = np.concatenate([pad, mono, pad])
+    frames = sliding_window_view(mono, kFrameSize)[::kHopSize]
+    window = np.hanning(kFrameSize).astype(np.float32)
+    freqs = np.fft.rfftfreq(kFrameSize, 1. / sample_rate)
+    band_of_bin = np.searchsorted(kBandEdges, freqs)
+
+    bands = np.zeros((len(frames), len(kBandEdges) + 1), dtype=np.float32)
+    prev = None
+    for start in range(0, len(frames), kChunkFrames):
+        spec = np.abs(np.fft.rfft(frames[start:start + kChunkFrames] * window, axis=1))
+        spec = np.log1p(kCompression * spec).astype(np.float32)
+        flux = np.diff(spec, axis=0, prepend=spec[:1] if prev is None else prev)
+        np.maximum(flux, 0, out=flux)
+        for b in range(bands.shape[1]):
+            bands[start:start + len(spec), b] = flux[:, band_of_bin == b].sum(axis=1)
+        prev = spec[-1:]
+
+    frame_rate = sample_rate / float(kHopSize)
+    bands = np.stack([_normalize(_above_local_mean(b, frame_rate)) for b in bands.T], axis=1)
+    onsets = _normalize(bands.sum(axis=1))
+    return onsets, bands
+
+# beat period (in onset frames) of onsets: the strongest autocorrelation lag
+# in the tempo range, weighted towards kPreferredBpm
+def estimate_period(onsets, frame_rate):
+    n = len(onsets)
+    spec = np.fft.rfft(onsets - onsets.mean(), 2 * n)
+    ac = np.fft.irfft(spec * np.conj(spec))[:n]
+
+    lags = np.arange(max(int(60. * frame_rate / kMaxBpm), 1),
+                     min(int(60. * frame_rate / kMinBpm) + 1, n - 1))
+    if len(lags) == 0:
+        return 60. * frame_rate / kPreferredBpm
+    bpms = 60. * frame_rate / lags
+    weight = np.exp(-0.5 * (np.log2(bpms / kPreferredBpm) / kTempoOctaves) ** 2)
+    lag = lags[np.argmax(ac[lags] * weight)]
+
+    # refine between lags by fitting a parabola through the peak
+    a, b, c = ac[lag - 1], ac[lag], ac[lag + 1]
+    denom = a - 2 * b + c
+    return lag + (0.5 * (a - c) / denom if denom < 0 else 0.)
+
+# onset frames of the beats: the sequence that best lines up with the onsets
+# while keeping close to period apart (Ellis' dynamic programming tracker)
+def track_beats(onsets, period):
+    n = len(onsets)
+    offsets = np.arange(int(round(2 * period)), int(round(period / 2)) - 1, -1)
+    offsets = offsets[offsets > 0]
+    penalty = -kTightness * np.log(offsets / period) ** 2
+
+    score = onsets.astype(np.float64)
+    backlink = np.full(n, -1)
+    for t in range(int(round(period / 2)), n):
+        prev = t - offsets
+        ok = prev >= 0
+        candidates = score[prev[ok]] + penalty[ok]
+        k = np.argmax(candidates)
+        if candidates[k] > 0:
+            score[t] += candidates[k]
+            backlink[t] = prev[ok][k]
+
+    # end on the best score within the last beat, and follow the links back
+    last = n - 1 - np.argmax(score[::-1][:max(int(period), 1)])
+    beats = []
+    while last >= 0:
+        beats.append(last)
+        last = backlink[last]
+    beats = np.array(beats[::-1], dtype=np.int64)
+
+    # drop beats in the silence before and after the song
+    loud = np.nonzero(_peak_near(onsets, beats, 2) > 0.1 * np.median(onsets[onsets > 0]))[0] \
+           if np.any(onsets > 0) else []
+    return beats[loud[0]:loud[-1] + 1] if len(loud) else beats
+
+# beats (from 0) before the first downbeat: the phase whose beats are strongest.
+# Pass the low band's strength: the kick drum marks the downbeats, where the
+# snare on the backbeats would win overall.
+def find_downbeat_phase(beat_strength):
+    sums = [beat_strength[k::kBeatsPerBar].mean() if len(beat_strength[k::kBeatsPerBar]) else 0
+            for k in range(kBeatsPerBar)]
+    return int(np.argmax(sums))
+
+def analyze(filepath):
+    mono, sample_rate = load_mono(filepath)
+    onsets, bands = onset_strength(mono, sample_rate)
+    frame_rate = sample_rate / float(kHopSize)
+    period = estimate_period(onsets, frame_rate)
+    beat_frames = track_beats(onsets, period)
+    phase = find_downbeat_phase(_peak_near(bands[:, 0], beat_frames, 2))
+    return BeatAnalysis(sample_rate, frame_rate, onsets, bands, 60. * frame_rate / period,
+                        beat_frames, phase)
+
+
+# powerups on every kPowerupBars-th downbeat, cycling through kPowerupCycle
+# and the lanes, as (time, bar, beat, lane, type). The last downbeat gets end
+# (like 'trophy' or 'transition') in every lane.
+def make_powerups(analysis, end = 'trophy'):
+    downbeats = np.nonzero(analysis.beats == 1)[0]
+    if len(downbeats) == 0:
+        return []
+
+    powerups = []
+    for i in downbeats[:-1]:
+        if i < kLeadInBeats or (analysis.bars[i] - 1) % kPowerupBars:
+            continue
+        kind = kPowerupCycle[len(powerups) % len(kPowerupCycle)]
+        lane = len(powerups) % 3 + 1
+        powerups.append((analysis.beat_times[i], analysis.bars[i], analysis.beats[i], lane, kind))
+
+    # an unpaired sample_on would loop to the end of the song
+    if powerups and powerups[-1][4] == 'sample_on':
+        powerups.pop()
+
+    i = downbeats[-1]
+    for lane in (1, 2, 3):
+        powerups.append((analysis.beat_times[i], analysis.bars[i], analysis.beats[i], lane, end))
+    return powerups
+
+# blocks on strong beats, at least kBlockSpacing apart and not next to a
+# powerup, as (time, bar, beat, lane, units). The lane follows the band (low,
+# mid or high) that stands out most on the beat, and stronger beats make wider
+# blocks.
+def make_blocks(analysis, powerups = ()):
+    strength = analysis.beat_strength
+    if len(strength) == 0:
+        return []
+    threshold = np.median(strength)
+    rank = np.argsort(np.argsort(strength)) / float(len(strength))
+
+    # beats taken by powerups, and the beats on either side of them
+    taken = np.zeros(len(strength) + 2, dtype=bool)
+    idx = np.searchsorted(analysis.beat_times, [p[0] for p in powerups])
+    for k in (0, 1, 2):
+        taken[np.minimum(idx + k, len(taken) - 1)] = True
+    taken = taken[1:-1]
+
+    blocks = []
+    last = -kBlockSpacing
+    for i in np.nonzero((strength >= threshold) & ~taken)[0]:
+        if i < kLeadInBeats or i - last < kBlockSpacing:
+            continue
+        lane = int(np.argmax(analysis.beat_bands[i])) + 1
+        units = min(1 + int(kMaxUnits * 2 * (rank[i] - 0.5)), kMaxUnits)
+        blocks.append((analysis.beat_times[i], analysis.bars[i], analysis.beats[i], lane, units))
+        last = i
+    return blocks
+
+# write analysis as charts: blocks and powerups for SongData.read_data(), and
+# (if beatspath isn't None) the beat grid for read_beats_file()
+def write_charts(analysis, blockpath, poweruppath, beatspath = None, end = 'trophy'):
+    powerups = make_powerups(analysis, end)
+    blocks = make_blocks(analysis, powerups)
+    with open(blockpath, 'w') as f:
+        for (time, bar, beat, lane, units) in blocks:
+            f.write('%.9f\t%d.%d %d %d\n' % (time, bar, beat, lane, units))
+    with open(poweruppath, 'w') as f:
+        for (time, bar, beat, lane, kind) in powerups:
+            f.write('%.9f\t%d.%d %d %s\n' % (time, bar, beat, lane, kind))
+    if beatspath:
+        with open(beatspath, 'w') as f:
+            for time, bar, beat in zip(analysis.beat_times, analysis.bars, analysis.beats):
+                f.write('%.9f\t%d.%d\n' % (time, bar, beat))
+    return blocks, powerups
+
+def _chart_job(job):
+    audio_file, blockpath, poweruppath, beatspath, end = job
+    analysis = analyze(audio_file)
+    blocks, powerups = write_charts(analysis, blockpath, poweruppath, beatspath, end)
+    return audio_file, analysis.bpm, len(analysis.beat_times), len(blocks), len(powerups)
+
+# chart several songs, spread over a pool of worker processes. jobs are
+# (audio file, block path, powerup path, beats path or None, end powerup).
+# Returns (audio file, bpm, beats, blocks, powerups) for each.
+def make_charts(jobs, max_workers = None):
+    if not jobs:
+        return []
+    with ProcessPoolExecutor(max_workers) as pool:
+        return list(pool.map(_chart_job, jobs))
+
+
+# the larger of x and the local mean of x, minus that mean
+def _above_local_mean(x, frame_rate):
+    width = max(int(kLocalMeanSecs * frame_rate), 1)
+    mean = np.convolve(x, np.ones(width) / width, mode='same')
+    return np.maximum(x - mean, 0)
+
+def _normalize(x):
+    peak = x.max() if len(x) else 0
+    return x / peak if peak > 0 else x
+
+# the largest value of x within radius of each index
+def _peak_near(x, indices, radius):
+    if len(indices) == 0:
+        return np.zeros(0, dtype=x.dtype)
+    idx = np.clip(np.asarray(indices)[:, None] + np.arange(-radius, radius + 1), 0, len(x) - 1)
+    return x[idx].max(axis=1)
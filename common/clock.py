@@ -10,7 +10,7 @@
 
 import time
 import numpy as np
-from .audio import Audio
+from .audio import Audio, generate_into, generate_from_into
 
 
 # Simple time keeper object. It starts at 0 and knows how to pause
@@ -56,7 +56,36 @@ class Clock(object):
 # For tempo maps - converting bpm to ticks
 kTicksPerQuarter = 480
 
-class SimpleTempoMap(object):
+# What tempo maps share. A tempo map has time_to_tick() and tick_to_time(),
+# which also take numpy arrays. On top of those: conversions of many values in
+# one call (like all of a chart's times), and finding beats.
+class BaseTempoMap(object):
+    def __init__(self):
+        super(BaseTempoMap, self).__init__()
+
+    # convert a whole array (or list) of times to ticks, as a numpy array
+    def times_to_ticks(self, times):
+        return self.time_to_tick(np.asarray(times, dtype=np.float64))
+
+    def ticks_to_times(self, ticks):
+        return self.tick_to_time(np.asarray(ticks, dtype=np.float64))
+
+    # time of the beat nearest to time
+    def get_nearest_beat(self, time):
+        tick = self.time_to_tick(time)
+        return self.tick_to_time(round(tick / kTicksPerQuarter) * kTicksPerQuarter)
+
+    # time of the first beat after time
+    def get_next_beat(self, time):
+        return self.tick_to_time(quantize_tick_up(self.time_to_tick(time), kTicksPerQuarter))
+
+    # length in seconds of the beat that time is in
+    def get_beat_length(self, time):
+        next_beat = quantize_tick_up(self.time_to_tick(time), kTicksPerQuarter)
+        return self.tick_to_time(next_beat) - self.tick_to_time(next_beat - kTicksPerQuarter)
+
+
+class SimpleTempoMap(BaseTempoMap):
 
     def __init__(self, bpm = 120) :
         super(SimpleTempoMap, self).__init__()
@@ -93,21 +122,25 @@ def tick_str(tick) :
 
 
 # data passed into tempo map is a list of points
-# where each point is (time, tick)
+# where each point is (time, tick), starting at time 0
 # optionally pass in filepath instead which will
 # read the file to create the list of (time, tick) points
-# TempoMap will linearly interpolate this graph
-class TempoMap(object):
+# TempoMap will linearly interpolate this graph. The points are kept as two
+# float arrays, so each conversion is one binary search (np.interp) with no
+# conversion of the points.
+class TempoMap(BaseTempoMap):
     def __init__(self, data = None, filepath = None):
         super(TempoMap, self).__init__()
 
         if data == None:
             data = self._read_tempo_data(filepath)
 
-        assert(data[0] == (0,0))
+        assert(data[0][0] == 0)
         assert(len(data) > 1)
 
-        self.times, self.ticks = list(zip(*data))
+        data = np.array(data, dtype=np.float64)
+        self.times = np.ascontiguousarray(data[:, 0])
+        self.ticks = np.ascontiguousarray(data[:, 1])
 
     def time_to_tick(self, time) :
         tick = np.interp(time, self.times, self.ticks)
@@ -131,12 +164,121 @@ class TempoMap(object):
         return data
 
 
+# past the last beat of a beats file, the tempo map keeps going at the last
+# tempo for this long
+kBeatsExtendSecs = 3600.
+
+# read a beat grid: one line per beat, with the time (in seconds) and the
+# beat's bar.beat (like 4.1, 4.2, ... with bars counted from 1). Returns
+# (time, tick) points for TempoMap, where tick 0 is beat 1 of bar 1, so the map
+# follows the song's real beats. Before the first beat and after the last one,
+# the tempo stays at that of the nearest beat.
+def read_beats_file(filepath):
+    beats = []
+    for line in open(filepath).readlines():
+        if line.strip():
+            (time, bar_beat) = line.strip().split('\t')
+            bar, beat = bar_beat.split('.')
+            beats.append((float(time), int(bar), int(beat)))
+    assert(len(beats) > 1)
+
+    beats_per_bar = max(beat for (time, bar, beat) in beats)
+    data = [(time, ((bar - 1) * beats_per_bar + beat - 1) * kTicksPerQuarter)
+            for (time, bar, beat) in beats]
+
+    def extend(p0, p1, time):
+        slope = (p1[1] - p0[1]) / (p1[0] - p0[0])
+        return (time, p1[1] + slope * (time - p1[0]))
+
+    end = data[-1][0] + kBeatsExtendSecs
+    return [extend(data[1], data[0], 0)] + data + [extend(data[-2], data[-1], end)]
+
+def make_beats_tempo_map(filepath):
+    return TempoMap(read_beats_file(filepath))
+
+
+# The commands of a scheduler, in a binary heap ordered by tick (and, for the
+# same tick, by when they were posted). Each command knows its place in the
+# heap, so it can be removed without searching: push and remove are O(log n).
+class CommandHeap(object):
+    def __init__(self):
+        super(CommandHeap, self).__init__()
+        self.heap = []
+        self.count = 0
+
+    def push(self, cmd):
+        cmd.seq = self.count
+        self.count += 1
+        cmd.index = len(self.heap)
+        self.heap.append(cmd)
+        self._up(cmd.index)
+
+    # the command due first, or None
+    def peek(self):
+        return self.heap[0] if self.heap else None
+
+    def pop(self):
+        cmd = self.heap[0]
+        self.remove(cmd)
+        return cmd
+
+    # does nothing if cmd is not in the heap
+    def remove(self, cmd):
+        idx = getattr(cmd, 'index', None)
+        if idx is None or idx >= len(self.heap) or self.heap[idx] is not cmd:
+            return
+        last = self.heap.pop()
+        cmd.index = None
+        if idx < len(self.heap):
+            self.heap[idx] = last
+            last.index = idx
+            self._up(idx)
+            self._down(last.index)
+
+    def __contains__(self, cmd):
+        idx = getattr(cmd, 'index', None)
+        return idx is not None and idx < len(self.heap) and self.heap[idx] is cmd
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _less(self, a, b):
+        return (a.tick, a.seq) < (b.tick, b.seq)
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        heap[i].index = i
+        heap[j].index = j
+
+    def _up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self._less(self.heap[i], self.heap[parent]):
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _down(self, i):
+        n = len(self.heap)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and self._less(self.heap[child + 1], self.heap[child]):
+                child += 1
+            if not self._less(self.heap[child], self.heap[i]):
+                break
+            self._swap(i, child)
+            i = child
+
+
 class Scheduler(object):
     def __init__(self, clock, tempo_map) :
         super(Scheduler, self).__init__()
         self.clock = clock
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandHeap()
 
     def get_time(self) :
         return self.clock.get_time()
@@ -146,22 +288,16 @@ class Scheduler(object):
         return self.tempo_map.time_to_tick(sec)
 
     # add a record for the function to call at the particular tick
-    # keep the list of commands sorted from lowest to hightest tick
-    # make sure tick is the first argument so sorting will work out
-    # properly
+    # the commands are kept in a heap, lowest tick first
     def post_at_tick(self, func, tick, arg = None) :
-        now_tick = self.get_tick()
-
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        if cmd:
+            self.commands.remove(cmd)
 
     # on_update should be called as often as possible.
     # the only trick here is to make sure we remove the command BEFORE
@@ -169,8 +305,8 @@ class Scheduler(object):
     def on_update(self):
         now_tick = self.get_tick()
         while self.commands:
-            if self.commands[0].tick <= now_tick:
-                command = self.commands.pop(0)
+            if self.commands.peek().tick <= now_tick:
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
@@ -186,11 +322,19 @@ class Scheduler(object):
 # AudioScheduler is a Scheduler and Clock built into one class.
 # It is ALSO a Generator. For it to work, it must be inserted into
 # and Audio generator chain.
+#
+# By default its time is the audio it has generated. Give it a song (anything
+# with get_frame() and get_speed(), like audio.Song) and its time is the song's
+# position instead, so with the song's beat map (see read_beats_file()) the
+# commands stay on the song's real beats, whatever its speed. Put the scheduler
+# before the song in a Mixer, so it sees where the song is at the start of
+# each block.
 class AudioScheduler(object):
-    def __init__(self, tempo_map) :
+    def __init__(self, tempo_map, song = None) :
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
-        self.commands = []
+        self.song = song
+        self.commands = CommandHeap()
 
         self.generator = None
         self.cur_frame = 0
@@ -198,42 +342,58 @@ class AudioScheduler(object):
     def set_generator(self, gen) :
         self.generator = gen
 
+    # follow another song (or, with None, our own frames), with its tempo map.
+    # The pending commands get their times on the new map.
+    def set_song(self, song, tempo_map) :
+        self.song = song
+        self.tempo_map = tempo_map
+        cmds = self.commands.heap
+        if cmds:
+            times = tempo_map.ticks_to_times([c.tick for c in cmds])
+            for cmd, time in zip(cmds, times.tolist()):
+                cmd.time = time
+
     def generate(self, num_frames, num_channels) :
-        output = np.empty(num_channels * num_frames, dtype = np.float32)
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, output, num_frames, num_channels) :
         o_idx = 0
 
-        # the current period of time goes from self.cur_frame to end_frame
+        # the current period of time goes from self.cur_frame to end_frame, in
+        # output frames. With a song, time moves at the song's speed from where
+        # the song is.
+        start_frame = self.cur_frame
         end_frame = self.cur_frame + num_frames
+        time0 = self.get_time()
+        speed = self.song.get_speed() if self.song else 1.0
 
         # advance time and fire off commands for this time frame
         while self.commands:
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
-            cmd_time = self.tempo_map.tick_to_time(cmd_tick)
-            cmd_frame = int(cmd_time * Audio.sample_rate)
+            cmd_time = self.commands.peek().time
+            cmd_frame = start_frame + max(int((cmd_time - time0) * Audio.sample_rate / speed), 0)
 
             if cmd_frame < end_frame:
                 o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
-                command = self.commands.pop(0)
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
 
         self._generate_until(end_frame, num_channels, output, o_idx)
 
-        return output, True
+        return True
 
-    # generate audio from self.cur_frame to to_frame
+    # generate audio from self.cur_frame to to_frame, directly into output
     def _generate_until(self, to_frame, num_channels, output, o_idx) :
         num_frames = to_frame - self.cur_frame
         if num_frames > 0:
+            next_o_idx = o_idx+(num_channels * num_frames)
             if self.generator:
-                data, cont = self.generator.generate(num_frames, num_channels)
+                generate_into(self.generator, output[o_idx : next_o_idx], num_frames, num_channels)
             else:
-                data = np.zeros(num_channels * num_frames, dtype=np.float32)
+                output[o_idx : next_o_idx] = 0
 
-            next_o_idx = o_idx+(num_channels * num_frames)
-            output[o_idx : next_o_idx] = data
             self.cur_frame += num_frames
             return next_o_idx
         else:
@@ -241,27 +401,25 @@ class AudioScheduler(object):
 
 
     def get_time(self) :
+        if self.song:
+            return self.song.get_frame() / float(Audio.sample_rate)
         return self.cur_frame / float(Audio.sample_rate)
 
     def get_tick(self) :
         return self.tempo_map.time_to_tick(self.get_time())
 
-    # add a record for the function to call at the particular tick
+    # add a record for the function to call at the particular tick. Its time is
+    # worked out once, here, not every block while it waits.
     def post_at_tick(self, func, tick, arg = None) :
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
-        # create a command to hold the function/arg and sort by tick
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        cmd.time = float(self.tempo_map.tick_to_time(cmd.tick))
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        if cmd:
+            self.commands.remove(cmd)
 
     def now_str(self):
         time = self.get_time()
@@ -278,6 +436,9 @@ class Command(object):
         self.func = func
         self.arg = arg
         self.did_it = False
+        self.seq = 0          # for CommandHeap
+        self.index = None
+        self.time = None      # for AudioScheduler: when it's due, in seconds
 
     def execute(self):
         # ensure that execute only gets called once.
@@ -0,0 +1,281 @@
+#####################################################################
+#
+# filters.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+from .audio import Audio, advance, generate_from_into
+from .profiler import profile_into
+
+# frames per sub-block of the vectorized recursion (see _BiquadKernel)
+kSubBlock = 64
+
+# frames to crossfade over when a filter's settings change
+kFadeFrames = 256
+
+# settings closer than this count as the same, and don't rebuild the filter:
+# frequency steps per octave, and decimals of q and gain
+kFreqStepsPerOctave = 12
+kParamDecimals = 2
+
+kBypass = (1., 0., 0., 0., 0.)
+
+
+# Biquad coefficients (b0, b1, b2, a1, a2), normalized so a0 = 1, from the RBJ
+# "Audio EQ Cookbook". f_type is one of 'lowpass', 'highpass', 'bandpass',
+# 'peak', 'lowshelf', 'highshelf', or None for a filter that does nothing.
+# gain_db only matters for 'peak' and the shelves.
+def biquad_coefs(f_type, freq, q = 0.7071, gain_db = 0.0, sr = None):
+    if f_type is None:
+        return kBypass
+
+    sr = sr or Audio.sample_rate
+    freq = min(max(freq, 1.), 0.49 * sr)
+    A = 10 ** (gain_db / 40.)
+    w0 = 2 * np.pi * freq / sr
+    cw = np.cos(w0)
+    alpha = np.sin(w0) / (2 * q)
+
+    if f_type == 'lowpass':
+        b = ((1 - cw) / 2, 1 - cw, (1 - cw) / 2)
+        a = (1 + alpha, -2 * cw, 1 - alpha)
+    elif f_type == 'highpass':
+        b = ((1 + cw) / 2, -(1 + cw), (1 + cw) / 2)
+        a = (1 + alpha, -2 * cw, 1 - alpha)
+    elif f_type == 'bandpass':
+        b = (alpha, 0., -alpha)
+        a = (1 + alpha, -2 * cw, 1 - alpha)
+    elif f_type == 'peak':
+        b = (1 + alpha * A, -2 * cw, 1 - alpha * A)
+        a = (1 + alpha / A, -2 * cw, 1 - alpha / A)
+    elif f_type == 'lowshelf':
+        sa = 2 * np.sqrt(A) * alpha
+        b = (A * ((A + 1) - (A - 1) * cw + sa), 2 * A * ((A - 1) - (A + 1) * cw), A * ((A + 1) - (A - 1) * cw - sa))
+        a = ((A + 1) + (A - 1) * cw + sa, -2 * ((A - 1) + (A + 1) * cw), (A + 1) + (A - 1) * cw - sa)
+    elif f_type == 'highshelf':
+        sa = 2 * np.sqrt(A) * alpha
+        b = (A * ((A + 1) + (A - 1) * cw + sa), -2 * A * ((A - 1) + (A + 1) * cw), A * ((A + 1) + (A - 1) * cw - sa))
+        a = ((A + 1) - (A - 1) * cw + sa, 2 * ((A - 1) - (A + 1) * cw), (A + 1) - (A - 1) * cw - sa)
+    else:
+        raise ValueError('unknown filter type: %s' % f_type)
+
+    return (b[0] / a[0], b[1] / a[0], b[2] / a[0], a[1] / a[0], a[2] / a[0])
+
+
+# One set of biquad coefficients, in the form the vectorized filter uses. The
+# stream is filtered kSubBlock frames at a time: within a sub-block,
+# y = T x + S (x[-2], x[-1], y[-2], y[-1]), where T is the (lower triangular)
+# matrix of the filter's impulse response and S is how the two previous inputs
+# and outputs ring into the sub-block. Only those four frames of state have to
+# be carried from one sub-block to the next. Working from the whole impulse
+# response, rather than the feed-forward and feedback halves separately, avoids
+# the feedback half's huge gain that the feed-forward half then cancels. Even
+# so, low cutoffs (like a 20 Hz highpass) put the poles so close to 1 that
+# float32 is off by up to 1e-3, so the kernel and the state are float64. Only
+# the output is float32.
+class _BiquadKernel(object):
+    def __init__(self, coefs):
+        super(_BiquadKernel, self).__init__()
+        self.coefs = coefs
+        self.bypass = coefs == kBypass
+        b0, b1, b2, a1, a2 = coefs
+
+        # columns: response to an impulse, and to a 1 in x[-2], x[-1], y[-2], y[-1]
+        L = kSubBlock
+        x = np.zeros((L + 2, 5))
+        y = np.zeros((L + 2, 5))
+        x[2, 0] = 1
+        x[0, 1] = 1
+        x[1, 2] = 1
+        y[0, 3] = 1
+        y[1, 4] = 1
+        for i in range(2, L + 2):
+            y[i] = b0 * x[i] + b1 * x[i - 1] + b2 * x[i - 2] - a1 * y[i - 1] - a2 * y[i - 2]
+
+        h = y[2:, 0]
+        d = np.arange(L)[:, np.newaxis] - np.arange(L)[np.newaxis, :]
+        self.T = np.where(d >= 0, h[np.clip(d, 0, None)], 0.)
+        self.S = y[2:, 1:].copy()
+
+
+# Stateful biquad filter for interleaved float32 blocks. All channels are
+# filtered at once, and the filter state is kept between blocks, so a stream
+# can be processed in blocks of any size. Changing settings crossfades from
+# the old filter to the new one over kFadeFrames, so sweeping a cutoff does
+# not click. Settings that change during a crossfade wait for it to finish
+# (only the latest wait), so one fade never cuts another short. Settings that
+# round to the current ones (see _quantize_params) are ignored, so a slow
+# sweep doesn't rebuild the filter every block.
+class Biquad(object):
+    def __init__(self, f_type = None, freq = 1000., q = 0.7071, gain_db = 0.0):
+        super(Biquad, self).__init__()
+        self.params = (f_type, freq, q, gain_db)
+        self.kernel = _BiquadKernel(biquad_coefs(*self.params))
+        self.old_kernel = None
+        self.pending = None
+        self.fade_pos = 0
+        self.num_channels = 0
+        self.work_len = 0
+        self.reset()
+
+    def set_params(self, f_type = None, freq = 1000., q = 0.7071, gain_db = 0.0):
+        params = (f_type, freq, q, gain_db)
+        if self.old_kernel is not None:
+            same = _quantize_params(params) == _quantize_params(self.params)
+            self.pending = None if same else params
+        elif _quantize_params(params) != _quantize_params(self.params):
+            self._start_fade(params)
+
+    # the settings asked for last (which may still be waiting for a crossfade)
+    def get_params(self):
+        return self.pending or self.params
+
+    def reset(self):
+        self.xhist = np.zeros((2, self.num_channels))
+        self.yhist = np.zeros((2, self.num_channels))
+        self.old_kernel = None
+        if self.pending:
+            self.params = self.pending
+            self.kernel = _BiquadKernel(biquad_coefs(*self.params))
+            self.pending = None
+
+    def _start_fade(self, params):
+        self.params = params
+
+        # the old filter keeps running (on its own copy of the state) until
+        # the crossfade is done
+        self.old_kernel = self.kernel
+        self.old_xhist = self.xhist.copy()
+        self.old_yhist = self.yhist.copy()
+        self.fade_pos = 0
+        self.kernel = _BiquadKernel(biquad_coefs(*params))
+
+    # true if the filter currently leaves the signal alone
+    def is_bypass(self):
+        return self.kernel.bypass and self.old_kernel is None
+
+    # filter num_frames of interleaved data in place
+    def process(self, data, num_frames, num_channels):
+        if num_channels != self.num_channels:
+            self.num_channels = num_channels
+            self.work_len = 0
+            self.reset()
+        if num_frames == 0:
+            return
+
+        frames = data[:num_frames * num_channels].reshape(num_frames, num_channels)
+        if self.is_bypass():
+            _push_history(self.xhist, frames)
+            _push_history(self.yhist, frames)
+            return
+
+        if self.old_kernel is None:
+            self._run(self.kernel, self.xhist, self.yhist, frames, frames)
+            return
+
+        old = self._reserve(num_frames)[2][:num_frames]
+        self._run(self.old_kernel, self.old_xhist, self.old_yhist, frames, old)
+        self._run(self.kernel, self.xhist, self.yhist, frames, frames)
+
+        fade = (self.fade_pos + np.arange(num_frames)) / float(kFadeFrames)
+        fade = np.clip(fade, 0, 1).astype(np.float32)[:, np.newaxis]
+        frames *= fade
+        frames += old * (1 - fade)
+
+        self.fade_pos += num_frames
+        if self.fade_pos >= kFadeFrames:
+            self.old_kernel = None
+            if self.pending:
+                params, self.pending = self.pending, None
+                self._start_fade(params)
+
+    # run one kernel over x (num_frames, num_channels) into out, which may be x.
+    # xhist / yhist are the last two inputs / outputs, and are updated.
+    def _run(self, kernel, xhist, yhist, x, out):
+        n = len(x)
+        num_sub = -(-n // kSubBlock)
+        xs, ys, _, state, corr = self._reserve(n)
+
+        xf = xs.reshape(-1, self.num_channels)
+        xf[:n] = x
+        xf[n:] = 0
+
+        # zero-state response of every sub-block at once, then chain the
+        # four-frame state through the sub-blocks
+        xs = xs[:num_sub]
+        ys = ys[:num_sub]
+        np.matmul(kernel.T, xs, out=ys)
+        state[:2] = xhist
+        state[2:] = yhist
+        for k in range(num_sub):
+            np.matmul(kernel.S, state, out=corr)
+            ys[k] += corr
+            state[:2] = xs[k, -2:]
+            state[2:] = ys[k, -2:]
+
+        _push_history(xhist, x)
+        yf = ys.reshape(-1, self.num_channels)
+        _push_history(yhist, yf[:n])
+        out[:] = yf[:n]
+
+    # work arrays big enough for num_frames: float64, except the old filter's
+    # float32 output during a crossfade
+    def _reserve(self, num_frames):
+        if num_frames > self.work_len:
+            num_sub = -(-num_frames // kSubBlock)
+            nc = self.num_channels
+            self.work = (np.zeros((num_sub, kSubBlock, nc)),
+                         np.zeros((num_sub, kSubBlock, nc)),
+                         np.zeros((num_sub * kSubBlock, nc), dtype=np.float32),
+                         np.zeros((4, nc)),
+                         np.zeros((kSubBlock, nc)))
+            self.work_len = num_sub * kSubBlock
+        return self.work
+
+
+# filter settings, rounded to what can be heard (see kFreqStepsPerOctave)
+def _quantize_params(params):
+    f_type, freq, q, gain_db = params
+    if f_type is None:
+        return (None,)
+    step = int(round(np.log2(max(freq, 1e-3)) * kFreqStepsPerOctave))
+    return (f_type, step, round(q, kParamDecimals), round(gain_db, kParamDecimals))
+
+# keep the last two frames of a stream in hist, given its newest frames
+def _push_history(hist, frames):
+    if len(frames) >= 2:
+        hist[:] = frames[-2:]
+    else:
+        hist[0] = hist[1]
+        hist[1] = frames[-1]
+
+
+# Filters the output of another generator. With no filter set (f_type None) the
+# generator's output passes through untouched.
+class FilterGenerator(object):
+    def __init__(self, generator, f_type = None, freq = 1000., q = 0.7071, gain_db = 0.0):
+        super(FilterGenerator, self).__init__()
+        self.generator = generator
+        self.biquad = Biquad(f_type, freq, q, gain_db)
+
+    def set_filter(self, f_type = None, freq = 1000., q = 0.7071, gain_db = 0.0):
+        self.biquad.set_params(f_type, freq, q, gain_db)
+
+    def get_filter(self):
+        return self.biquad.get_params()
+
+    def generate(self, num_frames, num_channels):
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
+        continue_flag = profile_into(self.generator, out, num_frames, num_channels)
+        self.biquad.process(out, num_frames, num_channels)
+        return continue_flag
+
+    # skipping input leaves the filter's history stale, so it starts over
+    def advance(self, num_frames, num_channels):
+        self.biquad.reset()
+        return advance(self.generator, num_frames, num_channels)
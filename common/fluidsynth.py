@@ -186,6 +186,23 @@ fluid_synth_write_s16 = cfunc('fluid_synth_write_s16', c_void_p,
                               ('roff', c_int, 1),
                               ('rincr', c_int, 1))
 
+fluid_synth_write_float = cfunc('fluid_synth_write_float', c_int,
+                                ('synth', c_void_p, 1),
+                                ('len', c_int, 1),
+                                ('lbuf', c_void_p, 1),
+                                ('loff', c_int, 1),
+                                ('lincr', c_int, 1),
+                                ('rbuf', c_void_p, 1),
+                                ('roff', c_int, 1),
+                                ('rincr', c_int, 1))
+
+# not in every version of the library
+try:
+    fluid_synth_get_active_voice_count = cfunc('fluid_synth_get_active_voice_count', c_int,
+                                               ('synth', c_void_p, 1))
+except AttributeError:
+    fluid_synth_get_active_voice_count = None
+
 # fluid audio driver
 new_fluid_audio_driver = cfunc('new_fluid_audio_driver', c_void_p,
                                ('settings', c_void_p, 1),
@@ -484,6 +501,16 @@ def fluid_synth_write_s16_stereo(synth, len):
     fluid_synth_write_s16(synth, len, buf, 0, 2, buf, 1, 2)
     return numpy.frombuffer(buf[:], dtype=numpy.int16)
 
+def fluid_synth_write_float_stereo_into(synth, len, out):
+    """Generate len frames of interleaved stereo float samples into out
+
+    out must be a contiguous float32 Numpy array of at least 2 * len samples.
+    No memory is allocated.
+
+    """
+    ptr = out.ctypes.data
+    fluid_synth_write_float(synth, len, ptr, 0, 2, ptr, 1, 2)
+
 
 # Object-oriented interface, simplifies access to functions
 
@@ -499,12 +526,12 @@ class Synth:
         added capability for passing arbitrary fluid settings using args
         """
         st = new_fluid_settings()
+        self.settings = st
         fluid_settings_setnum(st, b'synth.gain', gain)
         fluid_settings_setnum(st, b'synth.sample-rate', samplerate)
         fluid_settings_setint(st, b'synth.midi-channels', channels)
         for opt,val in kwargs.items():
             self.setting(opt, val)
-        self.settings = st
         self.synth = new_fluid_synth(st)
         self.audio_driver = None
         self.midi_driver = None
@@ -788,6 +815,20 @@ class Synth:
 
         """
         return fluid_synth_write_s16_stereo(self.synth, len)
+    def get_samples_into(self, out, len=1024):
+        """Generate audio samples into out
+
+        Like get_samples(), but writes float samples in [-1, 1] into the
+        float32 NumPy array out (size at least 2 * len) instead of
+        allocating a new array.
+
+        """
+        fluid_synth_write_float_stereo_into(self.synth, len, out)
+    def get_active_voice_count(self):
+        """Number of voices sounding, or None if the library can't say"""
+        if fluid_synth_get_active_voice_count is None:
+            return None
+        return fluid_synth_get_active_voice_count(self.synth)
 
 class Sequencer:
     def __init__(self, time_scale=1000, use_system_timer=True):
@@ -0,0 +1,79 @@
+#####################################################################
+#
+# latency.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import time
+
+# how often the controller looks at the stats, in seconds
+kCheckInterval = 0.25
+
+# grow when blocks take more than this fraction of the latency to render (p99)
+kGrowLoad = 0.5
+
+# shrink only after this many seconds without growing or underruns, and only if
+# blocks would still render in this fraction of the smaller latency
+kShrinkHold = 5.0
+kShrinkLoad = 0.25
+
+
+# Chooses how far ahead of the sound card Audio renders, from its AudioStats.
+# Audio keeps the output's buffer filled to get_target() frames instead of all
+# the way, so a small target is low latency, and a big one rides out slow
+# blocks and UI stalls.
+#
+# When the machine struggles (an underrun, or slow blocks) the target doubles
+# right away. It comes back down one block at a time, and only after things
+# have been calm for a while, so it doesn't flap between two sizes.
+class LatencyController(object):
+    def __init__(self, sample_rate, block_frames, min_frames, max_frames):
+        super(LatencyController, self).__init__()
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        self.min_frames = min_frames
+        self.max_frames = max(max_frames, min_frames)
+        self.target = min_frames
+        self.underruns = 0
+        self.blocks = 0
+        self.last_check = 0
+        self.last_change = time.time()
+
+    # frames to keep queued in the output
+    def get_target(self):
+        return self.target
+
+    def get_latency_ms(self):
+        return 1000. * self.target / self.sample_rate
+
+    # look at the stats (an AudioStats) and maybe change the target
+    def update(self, stats):
+        now = time.time()
+        if now - self.last_check < kCheckInterval:
+            return
+        self.last_check = now
+
+        # only the blocks since the last look
+        new_blocks = stats.blocks - self.blocks
+        new_underruns = stats.underruns > self.underruns
+        self.blocks, self.underruns = stats.blocks, stats.underruns
+        if new_blocks <= 0:
+            return
+        render_secs = stats.get_percentile(99, new_blocks) / 1000.
+        target_secs = self.target / float(self.sample_rate)
+
+        if new_underruns or render_secs > kGrowLoad * target_secs:
+            self._set_target(self.target * 2, now)
+        elif now - self.last_change > kShrinkHold:
+            smaller = self.target - self.block_frames
+            if render_secs < kShrinkLoad * smaller / float(self.sample_rate):
+                self._set_target(smaller, now)
+
+    def _set_target(self, frames, now):
+        frames = min(max(frames, self.min_frames), self.max_frames)
+        self.last_change = now
+        if frames != self.target:
+            self.target = frames
+            print('audio latency: %.1fms' % self.get_latency_ms())
@@ -9,49 +9,149 @@
 #####################################################################
 
 import numpy as np
+from .audio import generate_into, generate_from_into, advance
+from .automation import Automation
+from .profiler import profile_into
+
+# generators fade in / out over this many frames when added or removed
+kMixFadeFrames = 256
+
+# gain changes are smoothed over this many frames by default
+kGainRampFrames = 256
 
 
 class Mixer(object):
     def __init__(self):
         super(Mixer, self).__init__()
         self.generators = []
-        self.gain = 0.25
+        self.gain = Automation(0.25)
+        self.gains = {}            # generator -> Automation, only while it is not at 1
+        self.removing = set()      # generators fading out, removed once silent
+        self.scratch = np.zeros(0, dtype=np.float32)
+        self.env = np.zeros(0, dtype=np.float32)
 
-    def add(self, gen) :
-        if gen not in self.generators:
+    # add a generator, fading it in over fade_frames (0 for no fade)
+    def add(self, gen, fade_frames = kMixFadeFrames) :
+        if gen in self.removing:
+            self.removing.discard(gen)
+            self.ramp(gen, 1.0, fade_frames)
+        elif gen not in self.generators:
             self.generators.append(gen)
+            if fade_frames:
+                self.gains[gen] = Automation(0.0)
+                self.ramp(gen, 1.0, fade_frames)
+
+    # remove a generator, fading it out over fade_frames (0 to remove right away)
+    def remove(self, gen, fade_frames = kMixFadeFrames) :
+        if gen not in self.generators:
+            return
+        if fade_frames:
+            self.removing.add(gen)
+            self.ramp(gen, 0.0, fade_frames)
+        else:
+            self._drop(gen)
 
-    def remove(self, gen) :
-        if gen in self.generators:
-            self.generators.remove(gen)
+    # ramp one generator's level in this mix to gain over num_frames, starting
+    # delay frames from now
+    def ramp(self, gen, gain, num_frames, delay = 0) :
+        if gen not in self.gains:
+            self.gains[gen] = Automation(1.0)
+        self.gains[gen].ramp_to(gain, num_frames, delay)
 
-    def set_gain(self, gain) :
-        self.gain = np.clip(gain, 0, 1)
+    # ramp the mixer's gain to gain over num_frames, starting delay frames from now
+    def set_gain(self, gain, num_frames = kGainRampFrames, delay = 0) :
+        self.gain.ramp_to(float(np.clip(gain, 0, 1)), num_frames, delay)
 
+    # the gain the mixer is at, or is ramping to
     def get_gain(self) :
-        return self.gain
+        return self.gain.get_target()
 
     def get_num_generators(self) :
         return len(self.generators)
 
     def generate(self, num_frames, num_channels) :
-        output = np.zeros(num_frames * num_channels)
+        return generate_from_into(self, num_frames, num_channels)
 
-        # this calls generate() for each generator. generator must return:
-        # (signal, keep_going). If keep_going is True, it means the generator
+    # out is the mix bus: each generator renders into a scratch buffer that is
+    # kept between calls, and is summed into out in place.
+    def generate_into(self, out, num_frames, num_channels) :
+        # nothing to hear: just keep everything's place
+        if self.is_silent():
+            out.fill(0)
+            return self.advance(num_frames, num_channels)
+
+        num_samples = num_frames * num_channels
+        if len(self.scratch) < num_samples:
+            self.scratch = np.zeros(num_samples, dtype=np.float32)
+        if len(self.env) < num_frames:
+            self.env = np.zeros(num_frames, dtype=np.float32)
+        scratch = self.scratch[:num_samples]
+        out.fill(0)
+
+        # this calls generate_into() (or generate()) for each generator, through the
+        # profiler when profiling is on (see profiler.py). generator must
+        # return keep_going. If keep_going is True, it means the generator
         # has more to generate. False means generator is done and will be
-        # removed from the list. signal must be a numpay array of length
-        # num_frames * num_channels (or less)
+        # removed from the list. Generators faded all the way down are only
+        # advanced, which is much cheaper than rendering them.
         kill_list = []
         for g in self.generators:
-            (signal, keep_going) = g.generate(num_frames, num_channels)
-            output += signal
+            if self._is_muted(g):
+                self.gains[g].advance(num_frames)
+                if not advance(g, num_frames, num_channels) or g in self.removing:
+                    kill_list.append(g)
+                continue
+
+            keep_going = profile_into(g, scratch, num_frames, num_channels)
+            if g in self.gains:
+                self._apply_fade(g, scratch, num_frames, num_channels)
+                if g in self.removing and self.gains[g].is_static():
+                    keep_going = False
+            out += scratch
             if not keep_going:
                 kill_list.append(g)
 
         # remove generators that are done
         for g in kill_list:
-            self.generators.remove(g)
+            self._drop(g)
+
+        self.gain.apply(out, self.env, num_frames, num_channels)
+        return True
+
+    # move every generator (and all gains) ahead num_frames, rendering nothing
+    def advance(self, num_frames, num_channels) :
+        kill_list = []
+        for g in self.generators:
+            keep_going = advance(g, num_frames, num_channels)
+            if g in self.gains:
+                self.gains[g].advance(num_frames)
+                if g in self.removing and self.gains[g].is_static():
+                    keep_going = False
+            if not keep_going:
+                kill_list.append(g)
+
+        for g in kill_list:
+            self._drop(g)
+
+        self.gain.advance(num_frames)
+        return True
+
+    # true if the mixer's own gain is at 0 for now
+    def is_silent(self) :
+        return self.gain.is_static() and self.gain.value == 0
+
+    # true if gen is at 0 in this mix (and isn't about to ramp up)
+    def _is_muted(self, gen) :
+        gain = self.gains.get(gen)
+        return gain is not None and gain.is_static() and gain.value == 0
+
+    def _apply_fade(self, gen, data, num_frames, num_channels) :
+        gain = self.gains[gen]
+        gain.apply(data, self.env, num_frames, num_channels)
+        if gain.is_static() and gain.value == 1.0:
+            del self.gains[gen]
 
-        output *= self.gain
-        return (output, True)
+    def _drop(self, gen) :
+        self.generators.remove(gen)
+        self.gains.pop(gen, None)
+        self.removing.discard(gen)
@@ -9,7 +9,7 @@
 #####################################################################
 
 import numpy as np
-from .audio import Audio
+from .audio import Audio, generate_into, generate_from_into
 
 # Twelevth root of 2
 kTRT = pow(2.0, 1.0/12.0)
@@ -35,6 +35,9 @@ class NoteGenerator(object):
         self.harmonics = harmonics[1]
 
     def generate(self, num_frames, num_channels) :
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels) :
         # create time series from frame range
         time = np.arange(self.frame, self.frame + num_frames) / Audio.sample_rate 
 
@@ -42,19 +45,15 @@ class NoteGenerator(object):
         omega = (2.0 * np.pi) * self.freq
 
         # final output and gain
-        output = self.gain * self.make_waveform(omega * time)
+        output = self.make_waveform(omega * time)
 
         # advance frame counter
         self.frame += num_frames
 
-        # convert from mono to stereo
-        if num_channels == 2:
-            stereo = np.empty(num_frames * 2)
-            stereo[0::2] = output
-            stereo[1::2] = output
-            output = stereo
+        # write into every channel of out (mono to stereo)
+        np.multiply(output[:, np.newaxis], self.gain, out=out.reshape(num_frames, num_channels), casting='same_kind')
 
-        return (output, True)
+        return True
 
     def make_waveform(self, time) :
         # create fundamental frequency
@@ -86,8 +85,11 @@ class Envelope(object):
         self.frame = 0
 
     def generate(self, num_frames, num_channels) :
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels) :
         # get data from predecessor:
-        data, continue_flag = self.generator.generate(num_frames, num_channels)
+        continue_flag = generate_into(self.generator, out, num_frames, num_channels)
 
         # set up correct frame ranges:
         end_frame = self.frame + num_frames
@@ -114,13 +116,7 @@ class Envelope(object):
         # advance frame counter
         self.frame = end_frame
 
-        # make envelope work for stereo if needed
-        if num_channels == 2:
-            stereo = np.empty(num_frames * 2)
-            stereo[0::2] = env
-            stereo[1::2] = env
-            env = stereo
-            
-        output = env * data
-        return output, continue_flag
-
+        # apply the envelope to every channel of out, in place
+        frames_out = out.reshape(num_frames, num_channels)
+        np.multiply(frames_out, env[:, np.newaxis], out=frames_out, casting='same_kind')
+        return continue_flag
@@ -0,0 +1,43 @@
+#####################################################################
+#
+# prefetch.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import threading
+
+
+# Runs func(*args) on a background thread, starting right away. Use it to get
+# slow loading (decoding audio, parsing files) out of the frame that needs
+# the result. get() returns the result, waiting for the worker if it is not
+# done yet, and re-raises any exception the worker hit.
+class Prefetcher(object):
+    def __init__(self, func, *args):
+        super(Prefetcher, self).__init__()
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def is_ready(self):
+        return self.done.is_set()
+
+    def get(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+    def _run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
@@ -0,0 +1,170 @@
+#####################################################################
+#
+# profiler.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import time
+import tracemalloc
+from .audio import generate_into
+
+# Opt-in profiling of the generator graph. Mixer (and other generators that
+# own generators, like Song) render their children through profile_into(). When
+# profiling is on, each call is timed and counted, and (if asked for) the
+# memory it allocates is measured with tracemalloc. Numbers are aggregated by
+# (generator type, label). Label a generator with set_label(); otherwise it's
+# the label passed to profile_into(), or ''.
+#
+# Times and allocations are inclusive (with the generator's children) and self
+# (without them), so nested mixers don't count their children's work as their
+# own. Allocations are the peak temporary memory above what the call started
+# with, summed over calls.
+#
+#   enable_profiling()
+#   ... play ...
+#   print(get_profiler().get_text())
+
+gProfiler = None
+
+
+def enable_profiling(track_allocs = False):
+    global gProfiler
+    gProfiler = GenProfiler(track_allocs)
+    return gProfiler
+
+def disable_profiling():
+    global gProfiler
+    if gProfiler:
+        gProfiler.close()
+    gProfiler = None
+
+def get_profiler():
+    return gProfiler
+
+# name a generator for the profiler, like 'song' or 'riser'
+def set_label(gen, label):
+    gen.profile_label = label
+    return gen
+
+# generate_into(), profiled if profiling is on
+def profile_into(gen, out, num_frames, num_channels, label = ''):
+    profiler = gProfiler
+    if profiler is None:
+        return generate_into(gen, out, num_frames, num_channels)
+    return profiler.generate_into(gen, out, num_frames, num_channels, label)
+
+
+# one row of stats: calls, frames, inclusive and self time, inclusive and self
+# allocated bytes
+class GenStats(object):
+    def __init__(self, type_name, label):
+        super(GenStats, self).__init__()
+        self.type_name = type_name
+        self.label = label
+        self.calls = 0
+        self.frames = 0
+        self.total_time = 0.
+        self.self_time = 0.
+        self.max_time = 0.
+        self.alloc_bytes = 0
+        self.self_alloc_bytes = 0
+
+    def as_dict(self):
+        return {'type': self.type_name, 'label': self.label, 'calls': self.calls,
+                'frames': self.frames, 'total_ms': 1000 * self.total_time,
+                'self_ms': 1000 * self.self_time, 'max_ms': 1000 * self.max_time,
+                'alloc_bytes': self.alloc_bytes, 'self_alloc_bytes': self.self_alloc_bytes}
+
+
+class GenProfiler(object):
+    def __init__(self, track_allocs = False):
+        super(GenProfiler, self).__init__()
+        self.track_allocs = track_allocs
+        if track_allocs and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+        self.stats = {}          # (type name, label) -> GenStats
+        # the calls in progress: [child time, peak memory, memory at the start,
+        # memory the children kept, own peak allocation]
+        self.stack = []
+        self.start_time = time.time()
+
+    def close(self):
+        if self.track_allocs and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def generate_into(self, gen, out, num_frames, num_channels, label = ''):
+        type_name = type(gen).__name__
+        key = (type_name, getattr(gen, 'profile_label', label))
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = GenStats(*key)
+
+        frame = [0., 0, 0, 0, 0]
+        if self.track_allocs:
+            # our reset_peak() hides the caller's peak so far, so note it first
+            mem_start = tracemalloc.get_traced_memory()[0]
+            if self.stack:
+                self._note_own_peak(self.stack[-1])
+            frame[2] = mem_start
+            tracemalloc.reset_peak()
+        self.stack.append(frame)
+        t_start = time.perf_counter()
+
+        try:
+            return generate_into(gen, out, num_frames, num_channels)
+        finally:
+            dt = time.perf_counter() - t_start
+            self.stack.pop()
+            stats.calls += 1
+            stats.frames += num_frames
+            stats.total_time += dt
+            stats.self_time += dt - frame[0]
+            stats.max_time = max(stats.max_time, dt)
+
+            # a child's reset_peak() hides the peak before it, so children pass
+            # their peaks up
+            peak = 0
+            if self.track_allocs:
+                self._note_own_peak(frame)
+                peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+                stats.alloc_bytes += max(peak - mem_start, 0)
+                stats.self_alloc_bytes += frame[4]
+
+            if self.stack:
+                parent = self.stack[-1]
+                parent[0] += dt
+                parent[1] = max(parent[1], peak)
+                if self.track_allocs:
+                    # what we kept is the caller's baseline now, and its own
+                    # peak starts over from here
+                    parent[3] += tracemalloc.get_traced_memory()[0] - mem_start
+                    tracemalloc.reset_peak()
+
+    # the peak allocated by the call of frame itself since the last reset_peak(),
+    # not counting memory its children kept
+    def _note_own_peak(self, frame):
+        own = tracemalloc.get_traced_memory()[1] - frame[2] - frame[3]
+        frame[4] = max(frame[4], own)
+
+    # a list of stats dicts, the most expensive (by self time) first
+    def get_stats(self):
+        rows = [s.as_dict() for s in list(self.stats.values())]
+        return sorted(rows, key=lambda row: row['self_ms'], reverse=True)
+
+    def get_text(self):
+        elapsed = time.time() - self.start_time
+        lines = ['generator profile over %.1fs:' % elapsed,
+                 '{:<24} {:<12} {:>8} {:>10} {:>10} {:>8} {:>12} {:>12}'.format(
+                    'type', 'label', 'calls', 'total ms', 'self ms', 'max ms', 'total alloc', 'self alloc')]
+        for row in self.get_stats():
+            lines.append('{type:<24} {label:<12} {calls:>8} {total_ms:>10.1f} {self_ms:>10.1f} '
+                         '{max_ms:>8.2f} {alloc_bytes:>12} {self_alloc_bytes:>12}'.format(**row))
+        return '\n'.join(lines)
+
+    def dump(self):
+        print(self.get_text())
@@ -0,0 +1,294 @@
+#####################################################################
+#
+# resample.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+from .audio import generate_into, advance
+
+# windowed-sinc parameters (see SincResampler)
+kSincTaps = 16
+kSincPhases = 256
+kSincBeta = 8.0
+kSincRolloff = 0.95
+
+# input frames every resampler keeps behind its read head. Enough for the
+# widest kernel, so resamplers can take over from each other seamlessly.
+kHistoryFrames = kSincTaps // 2 - 1
+
+
+# Streaming resampler: pulls frames from a generator and plays them back at
+# any speed. The read head is fractional and is kept between blocks, along with
+# the input frames the next block still needs, so the output is continuous
+# across block boundaries no matter how the speed divides the block size.
+# All channels are interpolated at once.
+#
+# This base class interpolates linearly. Subclasses trade CPU for quality by
+# reading more input frames around the read head (taps_before / taps_after)
+# and overriding _kernel(). Use make_resampler() to get one by name.
+class Resampler(object):
+    quality = 'linear'
+
+    # number of input frames the interpolator reads before / after floor(read head)
+    taps_before = 0
+    taps_after = 1
+
+    def __init__(self):
+        super(Resampler, self).__init__()
+        self.num_channels = 0
+        self.ramp = None
+
+    # forget all history and start a new stream (preceded by silence)
+    def reset(self, num_channels):
+        self.num_channels = num_channels
+        self.buf = np.zeros((1024, num_channels), dtype=np.float32)
+        self.buf_len = kHistoryFrames
+        self.pos = float(kHistoryFrames)  # read head, in frames of self.buf
+        self.ramp = None
+
+    # continue the stream another Resampler was playing (ie, when switching quality),
+    # so that no input frames are lost or repeated.
+    def take_over(self, other):
+        if other.num_channels == 0:
+            return
+        self.reset(other.num_channels)
+        self._reserve_input(other.buf_len)
+        self.buf[:other.buf_len] = other.buf[:other.buf_len]
+        self.buf_len = other.buf_len
+        self.pos = other.pos
+
+    # make num_frames output frames from generator at the given speed, writing them
+    # (interleaved) into out. Returns the generator's continue_flag.
+    def process(self, generator, out, num_frames, num_channels, speed):
+        if num_channels != self.num_channels:
+            self.reset(num_channels)
+
+        # pull the input frames needed to reach the last output frame of this block
+        continue_flag = True
+        last_pos = self.pos + (num_frames - 1) * speed
+        need = int(last_pos) + self.taps_after + 1
+        if need > self.buf_len:
+            self._reserve_input(need)
+            fetch = self.buf[self.buf_len:need].reshape(-1)
+            continue_flag = generate_into(generator, fetch, need - self.buf_len, num_channels)
+            self.buf_len = need
+
+        out_frames = out.reshape(num_frames, num_channels)
+        start = int(self.pos)
+        if speed == 1.0 and start == self.pos:
+            # aligned and unity speed: no interpolation needed
+            out_frames[:] = self.buf[start:start + num_frames]
+        else:
+            self._reserve_work(num_frames)
+            self._positions(num_frames, speed)
+            self._kernel(out_frames, num_frames, speed)
+
+        # advance the read head, then slide the frames still needed to the front
+        self.pos += num_frames * speed
+        drop = min(int(self.pos) - kHistoryFrames, self.buf_len)
+        if drop > 0:
+            keep = self.buf_len - drop
+            self.buf[:keep] = self.buf[drop:self.buf_len]
+            self.buf_len = keep
+            self.pos -= drop
+
+        return continue_flag
+
+    # like process(), but without making any output: the read head moves on as
+    # if num_frames had been made. Input the read head skips entirely is skipped
+    # in the generator too (with advance()), so nothing is rendered for it.
+    # Returns the generator's continue_flag.
+    def advance(self, generator, num_frames, num_channels, speed):
+        if num_channels != self.num_channels:
+            self.reset(num_channels)
+
+        continue_flag = True
+        self.pos += num_frames * speed
+        skip = int(self.pos) - kHistoryFrames - self.buf_len
+        if skip > 0:
+            # drop the whole buffer and skip ahead to the history the read head
+            # needs. It is fetched for real by the next process().
+            continue_flag = advance(generator, skip, num_channels)
+            self.pos -= self.buf_len + skip
+            self.buf_len = 0
+        else:
+            drop = int(self.pos) - kHistoryFrames
+            if drop > 0:
+                keep = self.buf_len - drop
+                self.buf[:keep] = self.buf[drop:self.buf_len]
+                self.buf_len = keep
+                self.pos -= drop
+        return continue_flag
+
+    # find each output frame's read position: integer part in work_idx, fractional
+    # part in work_frac (spread to all channels, since broadcasting in a ufunc
+    # allocates). Everything is written into preallocated work arrays.
+    def _positions(self, num_frames, speed):
+        pos = self.work_pos[:num_frames]
+        floor = self.work_floor[:num_frames]
+
+        np.multiply(self.ramp[:num_frames], speed, out=pos)
+        pos += self.pos
+        np.floor(pos, out=floor)
+        np.copyto(self.work_idx[:num_frames], floor, casting='unsafe')
+        pos -= floor
+        np.copyto(self.work_frac[:num_frames], pos[:, np.newaxis], casting='same_kind')
+
+    # gather input frame floor(pos) + offset for each output frame into dest.
+    # mode='clip' keeps np.take from buffering out (indices are always in range)
+    def _gather(self, dest, num_frames, offset):
+        idx = self.work_idx[:num_frames]
+        if offset:
+            idx += offset
+        np.take(self.buf, idx, axis=0, out=dest, mode='clip')
+        if offset:
+            idx -= offset
+
+    # linear interpolation between the two input frames around each read position
+    def _kernel(self, out_frames, num_frames, speed):
+        frac = self.work_frac[:num_frames]
+        a = self.work_a[:num_frames]
+        b = self.work_b[:num_frames]
+
+        self._gather(a, num_frames, 0)
+        self._gather(b, num_frames, 1)
+        b -= a
+        b *= frac
+        np.add(a, b, out=out_frames)
+
+    # grow the input buffer so it can hold num_frames
+    def _reserve_input(self, num_frames):
+        if num_frames > len(self.buf):
+            buf = np.zeros((max(num_frames, 2 * len(self.buf)), self.num_channels), dtype=np.float32)
+            buf[:self.buf_len] = self.buf[:self.buf_len]
+            self.buf = buf
+
+    # grow the per-block work arrays so they can hold num_frames
+    def _reserve_work(self, num_frames):
+        if self.ramp is None or num_frames > len(self.ramp):
+            self._alloc_work(num_frames)
+
+    def _alloc_work(self, n):
+        self.ramp = np.arange(n, dtype=np.float64)
+        self.work_pos = np.zeros(n, dtype=np.float64)
+        self.work_floor = np.zeros(n, dtype=np.float64)
+        self.work_idx = np.zeros(n, dtype=np.intp)
+        self.work_frac = np.zeros((n, self.num_channels), dtype=np.float32)
+        self.work_a = np.zeros((n, self.num_channels), dtype=np.float32)
+        self.work_b = np.zeros((n, self.num_channels), dtype=np.float32)
+
+
+# 4-point cubic (Catmull-Rom) interpolation. Much less high-frequency loss and
+# imaging than linear for about twice the cost.
+class CubicResampler(Resampler):
+    quality = 'cubic'
+    taps_before = 1
+    taps_after = 2
+
+    def _kernel(self, out_frames, num_frames, speed):
+        frac = self.work_frac[:num_frames]
+        p0, p1, p2, p3 = [w[:num_frames] for w in self.work_p]
+        t = self.work_a[:num_frames]
+        u = self.work_b[:num_frames]
+
+        for offset, p in zip((-1, 0, 1, 2), (p0, p1, p2, p3)):
+            self._gather(p, num_frames, offset)
+
+        # p1 + f/2 * (p2 - p0 + f * (2p0 - 5p1 + 4p2 - p3 + f * (3(p1 - p2) + p3 - p0)))
+        np.subtract(p1, p2, out=t)
+        t *= 3
+        t += p3
+        t -= p0
+        t *= frac
+        np.multiply(p0, 2, out=u)
+        t += u
+        np.multiply(p2, 4, out=u)
+        t += u
+        np.multiply(p1, 5, out=u)
+        t -= u
+        t -= p3
+        t *= frac
+        t += p2
+        t -= p0
+        t *= frac
+        t *= 0.5
+        np.add(p1, t, out=out_frames)
+
+    def _alloc_work(self, n):
+        super(CubicResampler, self)._alloc_work(n)
+        self.work_p = [np.zeros((n, self.num_channels), dtype=np.float32) for i in range(4)]
+
+
+# Kaiser-windowed sinc interpolation through a precomputed polyphase filter bank.
+# Each output frame picks the bank row (phase) nearest its fractional position and
+# takes a dot product with kSincTaps input frames. When speeding up, the cutoff
+# drops to the new Nyquist frequency, so the resampler also acts as the
+# anti-aliasing filter. Banks are built once per cutoff and shared.
+gSincBanks = {}
+def get_sinc_bank(cutoff):
+    cutoff = round(cutoff, 4)
+    if cutoff not in gSincBanks:
+        half = kSincTaps // 2
+        # distance from the read position to each tap, for each phase
+        frac = np.arange(kSincPhases + 1)[:, np.newaxis] / float(kSincPhases)
+        dist = np.arange(-half + 1, half + 1)[np.newaxis, :] - frac
+        window = np.i0(kSincBeta * np.sqrt(np.clip(1 - (dist / half) ** 2, 0, 1))) / np.i0(kSincBeta)
+        bank = cutoff * np.sinc(cutoff * dist) * window
+
+        # unity gain at DC for every phase
+        bank /= bank.sum(axis=1, keepdims=True)
+        gSincBanks[cutoff] = bank.astype(np.float32)
+    return gSincBanks[cutoff]
+
+class SincResampler(Resampler):
+    quality = 'sinc'
+    taps_before = kSincTaps // 2 - 1
+    taps_after = kSincTaps // 2
+
+    def _kernel(self, out_frames, num_frames, speed):
+        bank = get_sinc_bank(kSincRolloff * min(1.0, 1.0 / speed))
+        idx = self.work_idx[:num_frames]
+        taps_idx = self.work_taps_idx[:num_frames]
+        phase = self.work_phase[:num_frames]
+        coefs = self.work_coefs[:num_frames]
+        window = self.work_window[:num_frames]
+
+        # nearest phase for each output frame, and its row of coefficients
+        np.multiply(self.work_pos[:num_frames], kSincPhases, out=self.work_floor[:num_frames])
+        np.rint(self.work_floor[:num_frames], out=self.work_floor[:num_frames])
+        np.copyto(phase, self.work_floor[:num_frames], casting='unsafe')
+        np.take(bank, phase, axis=0, out=coefs, mode='clip')
+
+        # the input frames under the filter, for each output frame: (frames, taps, channels)
+        np.add(idx[:, np.newaxis], self.tap_offsets, out=taps_idx)
+        np.take(self.buf, taps_idx, axis=0, out=window, mode='clip')
+        np.einsum('nt,ntc->nc', coefs, window, out=out_frames)
+
+    def _alloc_work(self, n):
+        super(SincResampler, self)._alloc_work(n)
+        self.tap_offsets = np.arange(-self.taps_before, self.taps_after + 1, dtype=np.intp)
+        self.work_taps_idx = np.zeros((n, kSincTaps), dtype=np.intp)
+        self.work_phase = np.zeros(n, dtype=np.intp)
+        self.work_coefs = np.zeros((n, kSincTaps), dtype=np.float32)
+        self.work_window = np.zeros((n, kSincTaps, self.num_channels), dtype=np.float32)
+
+
+kResamplers = {'linear': Resampler, 'cubic': CubicResampler, 'sinc': SincResampler}
+
+# quality used by make_resampler() when none is given. The Audio class sets this
+# from the 'resampler' entry of the audio config file.
+gDefaultQuality = 'linear'
+
+def set_default_quality(quality):
+    global gDefaultQuality
+    assert quality in kResamplers, 'unknown resampler quality: ' + str(quality)
+    gDefaultQuality = quality
+
+def get_default_quality():
+    return gDefaultQuality
+
+def make_resampler(quality = None):
+    return kResamplers[quality or gDefaultQuality]()
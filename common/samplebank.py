@@ -0,0 +1,228 @@
+#####################################################################
+#
+# samplebank.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import os
+import os.path
+import numpy as np
+
+from .audio import Audio, generate_from_into
+from .automation import Automation
+from .wavesrc import get_wave_cache
+
+# A game that only plays a few fixed notes doesn't need a whole soundfont in a
+# live synth. render_samples() plays each note through fluidsynth once and
+# saves it as a small wave file; a SampleBank then plays those files back with
+# the same program() / noteon() / noteoff() calls as Synth.
+
+kRenderVelocity = 100    # notes are rendered at this velocity, and scaled for others
+kHoldSecs = 2.0          # notes are held this long before their note off...
+kMaxTailSecs = 4.0       # ...and rendered at most this long after
+kSilence = 1e-4          # trailing samples below this are trimmed
+kReleaseFrames = 512     # a note off fades the sample out over this many frames
+kClearSecs = 1.0         # between notes, render at most this long to let reverb die out
+kNumVoices = 8           # samples that can play at once
+
+
+# file holding the rendering of one note, as (bank, preset, key)
+def sample_path(folder, note):
+    return os.path.join(folder, 'b%03d_p%03d_k%03d.wav' % note)
+
+# true if every note has a sample rendered after the soundfont last changed
+# (or at all, if the soundfont isn't here)
+def have_samples(soundfont, notes, folder):
+    sf_time = os.path.getmtime(soundfont) if os.path.exists(soundfont) else 0
+    for note in notes:
+        path = sample_path(folder, note)
+        if not os.path.exists(path) or os.path.getmtime(path) < sf_time:
+            return False
+    return True
+
+# render each note, a (bank, preset, key), from soundfont into folder. Needs
+# fluidsynth. The soundfont is loaded once, into one synth that's cleared
+# between notes. Returns the paths written.
+def render_samples(soundfont, notes, folder, force = False):
+    # imported here: playing samples must work without fluidsynth
+    from .synth import Synth
+    from .writer import WaveWriter
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    synth = None
+    written = []
+    for note in notes:
+        path = sample_path(folder, note)
+        if not force and have_samples(soundfont, [note], folder):
+            continue
+        if synth is None:
+            synth = Synth(soundfont, channels=16, polyphony=32)
+        else:
+            clear_synth(synth)
+        data = render_note(synth, *note)
+        writer = WaveWriter(path + '.tmp', 2)
+        writer.write(data)
+        writer.close()
+        os.replace(path + '.tmp', path)
+        written.append(path)
+    return written
+
+# play one note on synth and return its interleaved stereo audio, trimmed
+def render_note(synth, bank, preset, key):
+    block = 1024
+    hold_blocks = int(kHoldSecs * Audio.sample_rate) // block
+    max_blocks = hold_blocks + int(kMaxTailSecs * Audio.sample_rate) // block
+
+    synth.program(0, bank, preset)
+    synth.noteon(0, key, kRenderVelocity)
+    blocks = []
+    for i in range(max_blocks):
+        if i == hold_blocks:
+            synth.noteoff(0, key)
+        out = np.zeros(block * 2, dtype=np.float32)
+        synth.get_samples_into(out, block)
+        blocks.append(out)
+        if i > hold_blocks and synth.get_active_voice_count() == 0:
+            break
+
+    data = np.concatenate(blocks)
+    loud = np.nonzero(np.abs(data) >= kSilence)[0]
+    end = (loud[-1] // 2 + 1) * 2 if len(loud) else 0
+    return data[:end]
+
+
+# silence synth after a note: all notes and sounds off, then render (and throw
+# away) until the effects' tails have died out
+def clear_synth(synth):
+    synth.cc(0, 123, 0)     # all notes off
+    synth.cc(0, 120, 0)     # all sound off
+    block = 1024
+    out = np.zeros(block * 2, dtype=np.float32)
+    for i in range(int(kClearSecs * Audio.sample_rate) // block):
+        synth.get_samples_into(out, block)
+        if np.abs(out).max() < kSilence:
+            break
+
+
+# one sample playing: its data, where it is, and its gain (which fades it out
+# after a note off)
+class SampleVoice(object):
+    def __init__(self):
+        super(SampleVoice, self).__init__()
+        self.data = None
+        self.frame = 0
+        self.chan, self.key = None, None
+        self.gain = Automation(1.0)
+
+    def start(self, data, chan, key, gain):
+        self.data = data
+        self.frame = 0
+        self.chan, self.key = chan, key
+        self.gain = Automation(gain)
+
+    def release(self):
+        self.gain.ramp_to(0.0, kReleaseFrames)
+
+    def is_active(self):
+        return self.data is not None
+
+    def stop(self):
+        self.data = None
+
+
+# Plays pre-rendered notes (see render_samples()) from folder, with a fixed
+# pool of voices: when all are busy, a new note takes over the oldest. Samples
+# are loaded through the wave cache, so banks share them. Notes without a
+# sample are ignored.
+class SampleBank(object):
+    def __init__(self, folder, num_voices = kNumVoices):
+        super(SampleBank, self).__init__()
+        self.folder = folder
+        self.programs = {}       # chan -> (bank, preset)
+        self.samples = {}        # (bank, preset, key) -> interleaved stereo data, or None
+        self.voices = [SampleVoice() for i in range(num_voices)]
+        self.scratch = np.zeros(0, dtype=np.float32)
+        self.env = np.zeros(0, dtype=np.float32)
+
+    # load the samples for these notes now, instead of at their first noteon()
+    def load(self, notes):
+        for note in notes:
+            self._get_sample(note)
+
+    def program(self, chan, bank, preset):
+        self.programs[chan] = (bank, preset)
+
+    def noteon(self, chan, key, vel):
+        data = self._get_sample(self.programs.get(chan, (0, 0)) + (key,))
+        if data is None:
+            return
+        voice = self._get_free_voice()
+        voice.start(data, chan, key, vel / float(kRenderVelocity))
+
+    def noteoff(self, chan, key):
+        for v in self.voices:
+            if v.is_active() and v.chan == chan and v.key == key:
+                v.release()
+
+    def is_idle(self):
+        return not any(v.is_active() for v in self.voices)
+
+    def generate(self, num_frames, num_channels):
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
+        assert(num_channels == 2)
+        out.fill(0)
+        if self.is_idle():
+            return True
+
+        num_samples = num_frames * 2
+        if len(self.scratch) < num_samples:
+            self.scratch = np.zeros(num_samples, dtype=np.float32)
+            self.env = np.zeros(num_frames, dtype=np.float32)
+        scratch = self.scratch[:num_samples]
+
+        for v in self.voices:
+            if not v.is_active():
+                continue
+            data = v.data[v.frame * 2 : (v.frame + num_frames) * 2]
+            scratch[:len(data)] = data
+            scratch[len(data):] = 0
+            v.gain.apply(scratch, self.env, num_frames, 2)
+            out += scratch
+            self._move_voice(v, num_frames)
+        return True
+
+    def advance(self, num_frames, num_channels):
+        for v in self.voices:
+            if v.is_active():
+                v.gain.advance(num_frames)
+                self._move_voice(v, num_frames)
+        return True
+
+    # move a voice ahead, and stop it at the end of its sample or release
+    def _move_voice(self, voice, num_frames):
+        voice.frame += num_frames
+        faded = voice.gain.is_static() and voice.gain.value == 0
+        if faded or voice.frame * 2 >= len(voice.data):
+            voice.stop()
+
+    def _get_free_voice(self):
+        for v in self.voices:
+            if not v.is_active():
+                return v
+        return max(self.voices, key=lambda v: v.frame)
+
+    def _get_sample(self, note):
+        if note not in self.samples:
+            path = sample_path(self.folder, note)
+            data = None
+            if os.path.exists(path):
+                data, num_channels = get_wave_cache().get(path)
+                assert(num_channels == 2)
+            self.samples[note] = data
+        return self.samples[note]
@@ -0,0 +1,105 @@
+#####################################################################
+#
+# shmring.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import numpy as np
+from multiprocessing import shared_memory
+
+# header slots (int64): total frames ever written / read
+kWritePos = 0
+kReadPos = 1
+kHeaderSlots = 2
+
+
+# A ring buffer of float32 audio frames in shared memory, for handing audio
+# from one process to another. There must be one writer and one reader. The
+# write and read positions only ever grow (they count frames, not wrap), and
+# each side only moves its own, after it is done with the data, so no lock is
+# needed. A few float64 status slots ride along for the writer to publish
+# whatever the reader should know.
+#
+# One side creates the ring (name=None), the other attaches to it by name.
+class SharedRing(object):
+    def __init__(self, capacity, num_channels, num_status = 0, name = None):
+        super(SharedRing, self).__init__()
+        self.capacity = capacity
+        self.num_channels = num_channels
+        self.owner = name is None
+
+        header_bytes = 8 * kHeaderSlots
+        status_bytes = 8 * num_status
+        data_bytes = 4 * capacity * num_channels
+        size = header_bytes + status_bytes + data_bytes
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        buf = self.shm.buf
+        self.header = np.ndarray(kHeaderSlots, dtype=np.int64, buffer=buf)
+        self.status = np.ndarray(num_status, dtype=np.float64, buffer=buf, offset=header_bytes)
+        self.data = np.ndarray((capacity, num_channels), dtype=np.float32, buffer=buf,
+                               offset=header_bytes + status_bytes)
+        if self.owner:
+            self.header[:] = 0
+            self.status[:] = 0
+
+    def get_name(self):
+        return self.shm.name
+
+    def get_write_pos(self):
+        return int(self.header[kWritePos])
+
+    def get_read_pos(self):
+        return int(self.header[kReadPos])
+
+    # frames written but not read yet
+    def get_fill(self):
+        return self.get_write_pos() - self.get_read_pos()
+
+    def get_space(self):
+        return self.capacity - self.get_fill()
+
+    # writer: append interleaved frames. Returns the number of frames written,
+    # which is less than asked for if the ring is full.
+    def write(self, data, num_frames):
+        num_frames = min(num_frames, self.get_space())
+        pos = self.get_write_pos()
+        frames = data[:num_frames * self.num_channels].reshape(num_frames, self.num_channels)
+        self._copy(pos, num_frames, frames, to_ring=True)
+        self.header[kWritePos] = pos + num_frames
+        return num_frames
+
+    # reader: take up to num_frames into out (interleaved). Returns the number
+    # of frames read.
+    def read_into(self, out, num_frames):
+        num_frames = min(num_frames, self.get_fill())
+        pos = self.get_read_pos()
+        frames = out[:num_frames * self.num_channels].reshape(num_frames, self.num_channels)
+        self._copy(pos, num_frames, frames, to_ring=False)
+        self.header[kReadPos] = pos + num_frames
+        return num_frames
+
+    # copy num_frames between frames and the ring starting at position pos,
+    # in at most two pieces (before and after the wrap)
+    def _copy(self, pos, num_frames, frames, to_ring):
+        start = pos % self.capacity
+        first = min(num_frames, self.capacity - start)
+        pieces = ((self.data[start:start + first], frames[:first]),
+                  (self.data[:num_frames - first], frames[first:]))
+        for ring_part, frames_part in pieces:
+            if to_ring:
+                ring_part[:] = frames_part
+            else:
+                frames_part[:] = ring_part
+
+    # stop using the ring. The side that created it also frees it.
+    def close(self):
+        self.header = self.status = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
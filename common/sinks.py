@@ -0,0 +1,166 @@
+#####################################################################
+#
+# sinks.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import time
+import numpy as np
+
+# pyaudio is only needed for the PyAudioSink. Without it, audio can still be
+# rendered into the other sinks (say, on a headless build machine).
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+# Where Audio sends the audio it renders. A sink supports:
+#   get_write_available(): how many frames it can take right now
+#   get_capacity():        how many frames its buffer holds, or None if not known
+#   write(data):           take interleaved float32 frames. May block until there is room.
+#   get_read_available(), read(num_frames): for input. Sinks with no input return 0.
+#   close()
+
+
+# the sound card, through PyAudio. With callback, PyAudio pulls audio by calling
+# callback(in_data, frame_count, time_info, status) on its own thread.
+class PyAudioSink(object):
+    def __init__(self, num_channels, sample_rate, buffer_size, out_dev = None, in_dev = None,
+                 input = False, callback = None):
+        super(PyAudioSink, self).__init__()
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format = pyaudio.paFloat32,
+                                      channels = num_channels,
+                                      frames_per_buffer = buffer_size,
+                                      rate = sample_rate,
+                                      output = True,
+                                      input = input,
+                                      output_device_index = out_dev,
+                                      input_device_index = in_dev,
+                                      stream_callback = callback)
+        self.sample_rate = sample_rate
+
+    def get_write_available(self):
+        return self.stream.get_write_available()
+
+    # PortAudio doesn't say how big its buffer is, but its output latency is close
+    def get_capacity(self):
+        return int(self.stream.get_output_latency() * self.sample_rate) or None
+
+    def write(self, data):
+        self.stream.write(data.tobytes())
+
+    def get_read_available(self):
+        return self.stream.get_read_available()
+
+    def read(self, num_frames):
+        return np.frombuffer(self.stream.read(num_frames, False), dtype=np.float32)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+
+
+# A clock that only moves when told to, for deterministic pacing: a test can
+# advance() it by exactly one frame's worth of time and check what was rendered.
+class VirtualClock(object):
+    def __init__(self):
+        super(VirtualClock, self).__init__()
+        self.time = 0.
+
+    def advance(self, secs):
+        self.time += secs
+
+    def get_time(self):
+        return self.time
+
+
+# Throws the audio away. With a clock (a function returning seconds, like
+# time.time or VirtualClock().get_time) it takes frames at the sample rate of
+# that clock, like a sound card would. Without one it is free-running: it takes
+# buffer_size frames whenever asked, and never blocks, so rendering goes as fast
+# as the CPU allows.
+class NullSink(object):
+    def __init__(self, num_channels, sample_rate, buffer_size, clock = None):
+        super(NullSink, self).__init__()
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.clock = clock
+        self.start_time = clock() if clock else 0
+        self.frames_written = 0
+
+    # frames the clock says have been played, but that weren't written yet
+    def get_write_available(self):
+        if not self.clock:
+            return self.buffer_size
+        played = int((self.clock() - self.start_time) * self.sample_rate)
+        return max(min(played - self.frames_written + self.buffer_size, self.get_capacity()), 0)
+
+    def get_capacity(self):
+        return 4 * self.buffer_size if self.clock else None
+
+    def get_frames_written(self):
+        return self.frames_written
+
+    def write(self, data):
+        # like a blocking stream write: wait (on a real clock) until there is room
+        if self.clock is time.time:
+            while self.get_write_available() < len(data) // self.num_channels:
+                time.sleep(0.001)
+        self.frames_written += len(data) // self.num_channels
+
+    def get_read_available(self):
+        return 0
+
+    def read(self, num_frames):
+        return np.zeros(num_frames * self.num_channels, dtype=np.float32)
+
+    def close(self):
+        pass
+
+
+# A NullSink that also saves everything written to it, as a .wav file or (for
+# bit-exact comparisons) a .npy file of float32 samples.
+class FileSink(NullSink):
+    def __init__(self, filename, num_channels, sample_rate, buffer_size, clock = None):
+        super(FileSink, self).__init__(num_channels, sample_rate, buffer_size, clock)
+        self.filename = filename
+        self.is_npy = filename.endswith('.npy')
+        self.buffers = []
+        self.writer = None
+        if not self.is_npy:
+            # imported here: writer.py builds on audio.py, which uses this module
+            from .writer import WaveWriter
+            self.writer = WaveWriter(filename, num_channels, sample_rate)
+
+    def write(self, data):
+        super(FileSink, self).write(data)
+        if self.writer:
+            self.writer.write(data)
+        else:
+            self.buffers.append(data.copy())
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        else:
+            data = np.concatenate(self.buffers) if self.buffers else np.zeros(0, dtype=np.float32)
+            np.save(self.filename, data.reshape(-1, self.num_channels))
+
+
+# make the sink named in the audio config: 'pyaudio', 'null' (paced by the
+# real clock), 'free' (free-running null), or a .wav / .npy filename
+def make_sink(name, num_channels, sample_rate, buffer_size, **pyaudio_args):
+    if name == 'pyaudio':
+        return PyAudioSink(num_channels, sample_rate, buffer_size, **pyaudio_args)
+    if name == 'null':
+        return NullSink(num_channels, sample_rate, buffer_size, time.time)
+    if name == 'free':
+        return NullSink(num_channels, sample_rate, buffer_size)
+    if name.endswith('.wav') or name.endswith('.npy'):
+        return FileSink(name, num_channels, sample_rate, buffer_size)
+    raise ValueError('unknown audio sink: %s' % name)
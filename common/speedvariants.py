@@ -0,0 +1,227 @@
+#####################################################################
+#
+# speedvariants.py
+#
+# Released under the MIT License (http://opensource.org/licenses/MIT)
+#
+#####################################################################
+
+import os
+import os.path
+import glob
+import math
+import re
+import wave
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from .wavesrc import WaveFile, WaveSlice
+from .wavegen import WaveGenerator, SpeedModulator
+from .resample import make_resampler
+
+# Speed effects move in semitone steps, so a song only ever plays at a few
+# speed ratios. These can be rendered ahead of time (with the best resampler)
+# into "speed variants": wave files stored in a subdirectory next to the
+# original. Playing a variant at its own speed needs no resampling at all.
+
+kVariantDir = 'variants'     # subdirectory (next to the original) holding variants
+kVariantQuality = 'sinc'     # resampler used to render variants
+kRenderBlock = 16384         # frames per block when rendering
+kSwitchFadeFrames = 256      # crossfade length when switching between variants
+
+
+# playback speed for a pitch shift of k semitones
+def semitone_speed(k):
+    return 2 ** (k / 12.)
+
+# k if speed is a whole number of semitones (within rounding), otherwise None
+def speed_semitones(speed):
+    k = int(round(12 * math.log2(speed)))
+    if abs(semitone_speed(k) - speed) < 1e-6:
+        return k
+    return None
+
+def variant_path(filepath, k):
+    folder, name = os.path.split(filepath)
+    return os.path.join(folder, kVariantDir, '%s_st%+d.wav' % (os.path.splitext(name)[0], k))
+
+# a variant is usable if it was rendered after the original was last changed
+def is_variant_fresh(filepath, k):
+    path = variant_path(filepath, k)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filepath)
+
+
+# render the k-semitone variant of a wave file. Writes to a temporary file first,
+# so a half-written variant never looks fresh. Returns the variant's path.
+def render_variant(filepath, k):
+    source = WaveGenerator(WaveFile(filepath))
+    num_channels = source.source.get_num_channels()
+    speed = semitone_speed(k)
+    num_frames = int(math.ceil(source.get_length() / speed))
+
+    path = variant_path(filepath, k)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+
+    writer = wave.open(tmp_path, 'wb')
+    writer.setnchannels(num_channels)
+    writer.setsampwidth(2)
+    writer.setframerate(source.source.sr)
+
+    resampler = make_resampler(kVariantQuality)
+    block = np.zeros(kRenderBlock * num_channels, dtype=np.float32)
+    done = 0
+    while done < num_frames:
+        n = min(kRenderBlock, num_frames - done)
+        data = block[:n * num_channels]
+        resampler.process(source, data, n, num_channels, speed)
+        writer.writeframes(np.clip(data * 32768, -32768, 32767).astype('<i2').tobytes())
+        done += n
+    writer.close()
+
+    os.replace(tmp_path, path)
+    return path
+
+def _render_job(job):
+    return render_variant(*job)
+
+# render every missing or stale variant of filepaths at the given semitone steps,
+# spread over a pool of worker processes. Returns the paths rendered.
+def render_variants(filepaths, semitones, max_workers = None, force = False):
+    jobs = [(f, k) for f in filepaths for k in semitones
+            if k != 0 and (force or not is_variant_fresh(f, k))]
+    if not jobs:
+        return []
+    with ProcessPoolExecutor(max_workers) as pool:
+        return list(pool.map(_render_job, jobs))
+
+
+# the fresh variants of a file on disk, as { k: WaveFile }. Looked up once per file.
+gVariants = {}
+gVariantsLock = threading.Lock()
+def get_variants(filepath):
+    key = os.path.normpath(filepath)
+    with gVariantsLock:
+        if key in gVariants:
+            return gVariants[key]
+
+    variants = {}
+    pattern = re.compile(r'_st([+-]\d+)\.wav$')
+    for path in glob.glob(variant_path(filepath, 0).replace('_st+0.wav', '_st*.wav')):
+        mo = pattern.search(path)
+        if mo and int(mo.group(1)) != 0 and is_variant_fresh(filepath, int(mo.group(1))):
+            variants[int(mo.group(1))] = WaveFile(path)
+
+    with gVariantsLock:
+        gVariants[key] = variants
+    return variants
+
+# the part of each variant that corresponds to num_frames of the original,
+# starting at start_frame.
+def slice_variants(variants, start_frame, num_frames):
+    out = {}
+    for k, source in variants.items():
+        speed = semitone_speed(k)
+        out[k] = WaveSlice(source, int(round(start_frame / speed)), int(round(num_frames / speed)))
+    return out
+
+
+# A SpeedModulator that plays a pre-rendered variant whenever one exists for the
+# current speed, and resamples the original otherwise. variants is { k: WaveSource },
+# where frame f of variant k lines up with frame f * semitone_speed(k) of the
+# original. Switching sources jumps to the equivalent position with a short
+# crossfade. get_frame() is always in frames of the original.
+class VariantSpeedModulator(SpeedModulator):
+    def __init__(self, generator, variants, speed = 1.0, gain = None, quality = None):
+        self.original = generator
+        self.variants = variants
+        self.semitones = 0        # variant that self.generator is playing. 0 is the original
+        self.source_speed = 1.0   # speed the current source was rendered at
+        self.rate = 1.0           # speed the resampler plays the current source at
+        self.fade = None          # (generator, resampler, rate) being faded out
+        self.fade_frame = 0
+        self.pending = None       # speed waiting for the crossfade to finish
+        self.scratch = np.zeros(0, dtype=np.float32)
+        super(VariantSpeedModulator, self).__init__(generator, 1.0, gain, quality)
+        self.set_speed(speed)
+
+    def set_speed(self, speed):
+        self.speed = speed
+        k = speed_semitones(speed)
+        if k not in self.variants:
+            k = 0
+        if k != self.semitones:
+            # switching again mid-crossfade would cut off the source fading out:
+            # wait for the fade to finish
+            if self.fade:
+                self.pending = speed
+                return
+            self._switch(k)
+        self.pending = None
+
+        # a variant plays at exactly its own speed, so rounding in speed doesn't
+        # turn the resampler back on
+        self.rate = 1.0 if self.semitones else speed
+
+    def get_frame(self):
+        return int(self.generator.frame * self.source_speed)
+
+    def get_length(self):
+        return self.original.get_length()
+
+    def generate_into(self, out, num_frames, num_channels):
+        continue_flag = self.resampler.process(self.generator, out, num_frames, num_channels, self.rate)
+        if self.fade:
+            self._fade_out(out, num_frames, num_channels)
+        return continue_flag and self.continue_flag
+
+    # nobody hears the crossfade while we're silent, so it is simply dropped
+    def advance(self, num_frames, num_channels):
+        continue_flag = self.resampler.advance(self.generator, num_frames, num_channels, self.rate)
+        self._end_fade()
+        return continue_flag and self.continue_flag
+
+    # start playing variant k from the equivalent position of what is playing now
+    def _switch(self, k):
+        orig_frame = self.get_frame()
+        source = self.variants[k] if k else self.original.source
+        source_speed = semitone_speed(k)
+
+        gen = WaveGenerator(source, loop=self.generator.loop)
+        gen.set_gain(self.generator.get_gain())
+        gen.frame = int(round(orig_frame / source_speed))
+        if gen.loop:
+            gen.frame %= max(source.get_length(), 1)
+
+        self.fade = (self.generator, self.resampler, self.rate)
+        self.fade_frame = 0
+        self.generator = gen
+        self.resampler = make_resampler(self.resampler.quality)
+        self.semitones = k
+        self.source_speed = source_speed
+
+    # mix in the tail of the previous source, fading it out over kSwitchFadeFrames
+    def _fade_out(self, out, num_frames, num_channels):
+        generator, resampler, rate = self.fade
+        if len(self.scratch) < num_frames * num_channels:
+            self.scratch = np.zeros(num_frames * num_channels, dtype=np.float32)
+        old = self.scratch[:num_frames * num_channels]
+        resampler.process(generator, old, num_frames, num_channels, rate)
+
+        fade = 1 - (self.fade_frame + np.arange(num_frames)) / float(kSwitchFadeFrames)
+        fade = np.clip(fade, 0, 1).astype(np.float32)[:, np.newaxis]
+        out_frames = out.reshape(num_frames, num_channels)
+        out_frames *= 1 - fade
+        out_frames += old.reshape(num_frames, num_channels) * fade
+
+        self.fade_frame += num_frames
+        if self.fade_frame >= kSwitchFadeFrames:
+            self._end_fade()
+
+    # drop the faded-out source, and move on to the speed asked for meanwhile
+    def _end_fade(self):
+        self.fade = None
+        if self.pending is not None:
+            speed, self.pending = self.pending, None
+            self.set_speed(speed)
@@ -10,25 +10,75 @@
 
 import numpy as np
 from . import fluidsynth
-from .audio import Audio
+from .audio import Audio, generate_from_into
+
+# after the last voice stops, keep rendering this long for reverb and chorus tails
+kTailSecs = 1.0
 
 # create another kind of generator that generates audio based on the fluid
-# synth synthesizer
+# synth synthesizer.
+# channels is the number of MIDI channels (fluidsynth wants a multiple of 16),
+# and polyphony the most voices that can sound at once (None for fluidsynth's
+# default). Lower both when only a few programs are used.
+#
+# Most of the time nothing is playing, so the synth notices when it goes quiet
+# (from fluidsynth's voice count, or from the notes turned on and off, if the
+# library can't count voices) and then skips rendering.
 class Synth(fluidsynth.Synth, object):
-    def __init__(self, filepath, gain = 0.8):
-        super(Synth, self).__init__(gain, samplerate=Audio.sample_rate)
+    def __init__(self, filepath, gain = 0.8, channels = 256, polyphony = None):
+        settings = {}
+        if polyphony:
+            settings['synth.polyphony'] = polyphony
+        super(Synth, self).__init__(gain, samplerate=Audio.sample_rate, channels=channels, **settings)
         self.sfid = self.sfload(filepath)
         if self.sfid == -1:
             raise Exception('Error in fluidsynth.sfload(): cannot open ' + filepath)
         self.program(0, 0, 0)
 
+        self.held = set()          # (chan, key) of notes on
+        self.tail_frames = int(kTailSecs * Audio.sample_rate)
+        self.quiet_frames = self.tail_frames   # frames rendered since the last voice stopped
+        self.scratch = np.zeros(0, dtype=np.float32)
+
     def program(self, chan, bank, preset):
         self.program_select(chan, self.sfid, bank, preset)
 
+    def noteon(self, chan, key, vel):
+        self.held.add((chan, key))
+        self.quiet_frames = 0
+        return super(Synth, self).noteon(chan, key, vel)
+
+    def noteoff(self, chan, key):
+        self.held.discard((chan, key))
+        return super(Synth, self).noteoff(chan, key)
+
+    # true if nothing is sounding, tails included
+    def is_idle(self):
+        return self.quiet_frames >= self.tail_frames
+
     def generate(self, num_frames, num_channels):
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels):
         assert(num_channels == 2)
-        # get_samples() returns interleaved stereo, so all we have to do is scale
-        # the data to [-1, 1].
-        samples = self.get_samples(num_frames).astype(np.float32)
-        samples *= (1.0/32768.0)
-        return (samples, True)
+        if self.is_idle():
+            out.fill(0)
+            return True
+
+        # fluidsynth writes interleaved float stereo in [-1, 1] straight into out
+        self.get_samples_into(out, num_frames)
+        self._update_quiet(num_frames)
+        return True
+
+    def advance(self, num_frames, num_channels):
+        if not self.is_idle():
+            if len(self.scratch) < num_frames * 2:
+                self.scratch = np.zeros(num_frames * 2, dtype=np.float32)
+            self.get_samples_into(self.scratch, num_frames)
+            self._update_quiet(num_frames)
+        return True
+
+    def _update_quiet(self, num_frames):
+        voices = self.get_active_voice_count()
+        sounding = voices > 0 if voices is not None else len(self.held) > 0
+        self.quiet_frames = 0 if sounding else self.quiet_frames + num_frames
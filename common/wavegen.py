@@ -10,6 +10,8 @@
 
 
 import numpy as np
+from .audio import generate_into, generate_from_into, advance
+from .resample import make_resampler
 
 
 # generates audio data by asking an audio-source (ie, WaveFile) for that data.
@@ -49,74 +51,110 @@ class WaveGenerator(object):
         return self.gain
 
     def generate(self, num_frames, num_channels) :
+        return generate_from_into(self, num_frames, num_channels)
+
+    def generate_into(self, out, num_frames, num_channels) :
         if self.paused:
-            output = np.zeros(num_frames * num_channels)
-            return (output, True)
+            out.fill(0)
+            return True
 
-        else:
-            # get data based on our position and requested # of frames
-            output = self.source.get_frames(self.frame, self.frame + num_frames)
+        # get data based on our position and requested # of frames
+        actual_num_frames = self.source.get_frames_into(self.frame, self.frame + num_frames, out)
 
-            # check for end-of-buffer condition:
-            actual_num_frames = len(output) // num_channels
-            continue_flag = actual_num_frames == num_frames
+        # check for end-of-buffer condition:
+        continue_flag = actual_num_frames == num_frames
 
-            # advance current-frame
-            self.frame += actual_num_frames
+        # advance current-frame
+        self.frame += actual_num_frames
 
-            # looping. If we got to the end of the buffer, don't actually end.
-            # Instead, read some more from the beginning
-            if self.loop and not continue_flag:
-                continue_flag = True
+        # looping. If we got to the end of the buffer, don't actually end.
+        # Instead, keep reading from the beginning until the block is full
+        if self.loop and not continue_flag:
+            continue_flag = True
+            while actual_num_frames < num_frames:
                 remainder = num_frames - actual_num_frames
-                output = np.append(output, self.source.get_frames(0, remainder))
-                self.frame = remainder
+                got = self.source.get_frames_into(0, remainder, out[actual_num_frames * num_channels:])
+                if got == 0:
+                    break
+                actual_num_frames += got
+                self.frame = got
 
-            if self._release:
-                continue_flag = False
+        if self._release:
+            continue_flag = False
+
+        # zero-pad if output is too short (may happen if not looping / end of buffer)
+        filled = actual_num_frames * num_channels
+        out[filled:] = 0
+        out[:filled] *= self.gain
 
-            # zero-pad if output is too short (may happen if not looping / end of buffer)
-            shortfall = num_frames * num_channels - len(output)
-            if shortfall > 0:
-                output = np.append(output, np.zeros(shortfall))
+        return continue_flag
 
-            # return
-            return (output * self.gain, continue_flag)
+    # move ahead num_frames like generate_into(), without reading any audio
+    def advance(self, num_frames, num_channels) :
+        if self.paused:
+            return True
+
+        length = self.source.get_length()
+        self.frame += num_frames
+        continue_flag = True
+        if self.frame > length:
+            if self.loop and length:
+                self.frame %= length
+            else:
+                self.frame = length
+                continue_flag = False
+        return continue_flag and not self._release
 
 
 
+# plays a generator back faster or slower (changing pitch along with speed).
+# Resampling is done by a Resampler, which keeps a fractional read position and
+# the needed input history between blocks, so speed changes and odd
+# speed / block-size ratios don't click. quality is 'linear', 'cubic' or 'sinc'
+# (None means the default from common/resample.py).
 class SpeedModulator(object):
-    def __init__(self, generator, speed = 1.0):
+    def __init__(self, generator, speed = 1.0, gain = None, quality = None):
         super(SpeedModulator, self).__init__()
         self.generator = generator
         self.speed = speed
+        self.continue_flag = True
+        self.resampler = make_resampler(quality)
+
+        if gain is not None:
+            self.set_gain(gain)
+
+    # gain is passed through to the generator being modulated
+    def set_gain(self, new_gain):
+        self.generator.set_gain(new_gain)
+
+    def get_gain(self):
+        return self.generator.get_gain()
 
     def set_speed(self, speed) :
         self.speed = speed
 
-    def generate(self, num_frames, num_channels) :
-        # optimization if speed is 1.0
-        if self.speed == 1.0:
-            return self.generator.generate(num_frames, num_channels)
+    def get_speed(self):
+        return self.speed
 
-        # otherwise, we need to ask self.generator for a number of frames that is
-        # larger or smaller than num_frames, depending on self.speed
-        adj_frames = int(round(num_frames * self.speed))
+    # switch resampler quality while playing, without losing our place
+    def set_quality(self, quality):
+        resampler = make_resampler(quality)
+        resampler.take_over(self.resampler)
+        self.resampler = resampler
 
-        # get data from generator
-        data, continue_flag = self.generator.generate(adj_frames, num_channels)
+    def get_quality(self):
+        return self.resampler.quality
 
-        # split into multi-channels:
-        data_chans = [ data[n::num_channels] for n in range(num_channels) ]
+    def release(self):
+        self.continue_flag = False
 
-        # stretch or squash data to fit exactly into num_frames
-        from_range = np.arange(adj_frames)
-        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
-        resampled = [ np.interp(to_range, from_range, data_chans[n]) for n in range(num_channels) ]
+    def generate(self, num_frames, num_channels) :
+        return generate_from_into(self, num_frames, num_channels)
 
-        # convert back by interleaving into a single buffer
-        output = np.empty(num_channels * num_frames, dtype=np.float32)
-        for n in range(num_channels) :
-            output[n::num_channels] = resampled[n]
+    def generate_into(self, out, num_frames, num_channels) :
+        continue_flag = self.resampler.process(self.generator, out, num_frames, num_channels, self.speed)
+        return continue_flag and self.continue_flag
 
-        return (output, continue_flag)
+    def advance(self, num_frames, num_channels) :
+        continue_flag = self.resampler.advance(self.generator, num_frames, num_channels, self.speed)
+        return continue_flag and self.continue_flag
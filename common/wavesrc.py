@@ -10,36 +10,72 @@
 
 import numpy as np
 import wave
+import struct
+import os.path
+import threading
+from collections import OrderedDict
 from .audio import Audio
 
+# find the byte offset of the PCM payload (the 'data' chunk) of a RIFF/WAVE file
+def _find_data_offset(filepath):
+    with open(filepath, 'rb') as f:
+        riff, riff_size, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError('not a RIFF/WAVE file: ' + filepath)
+
+        # walk the chunk list. chunks are word-aligned, so odd sizes get a pad byte
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('no data chunk in ' + filepath)
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                return f.tell()
+            f.seek(chunk_size + (chunk_size & 1), 1)
+
+
 # Interface for reading data from a wave file. Does not store this data locally.
-# Simple call to get_frames() to get data in format we like (numpy array, float32)
+# The PCM payload is memory-mapped once, so reading is just slicing: get_raw_frames()
+# hands out int16 views into the file and get_frames_into() converts into a
+# caller-supplied float32 buffer. get_frames() still returns a new float32 array.
 class WaveFile(object):
     def __init__(self, filepath) :
         super(WaveFile, self).__init__()
 
-        self.wave = wave.open(filepath)
+        wave_file = wave.open(filepath)
         self.num_channels, self.sampwidth, self.sr, self.end, \
-           comptype, compname = self.wave.getparams()
+           comptype, compname = wave_file.getparams()
+        wave_file.close()
 
         # for now, we will only accept 16 bit files and the sample rate must match
         assert(self.sampwidth == 2)
         assert(self.sr == Audio.sample_rate)
 
-    # read an arbitrary chunk of data from the file
-    def get_frames(self, start_frame, end_frame) :
-        # get the raw data from wave file as a byte string. If asking for more than is available, it just
-        # returns what it can
-        self.wave.setpos(start_frame)
-        raw_bytes = self.wave.readframes(end_frame - start_frame)
+        # map the int16 samples directly. np.memmap can't map an empty region.
+        num_samples = self.end * self.num_channels
+        if num_samples:
+            self.samples = np.memmap(filepath, dtype='<i2', mode='r',
+                                     offset=_find_data_offset(filepath), shape=(num_samples,))
+        else:
+            self.samples = np.zeros(0, dtype=np.int16)
 
-        # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+    # int16 samples from start_frame to end_frame, as a view into the mapped file.
+    # If asking for more than is available, it just returns what it can
+    def get_raw_frames(self, start_frame, end_frame) :
+        return self.samples[start_frame * self.num_channels : end_frame * self.num_channels]
 
-        # convert from integer type to floating point, and scale to [-1, 1]
-        samples = samples.astype(np.float32)
-        samples *= (1 / 32768.0)
+    # convert a chunk of data to float32 in [-1, 1], writing into out.
+    # returns the number of frames written (may be fewer than asked at end-of-file)
+    def get_frames_into(self, start_frame, end_frame, out) :
+        raw = self.get_raw_frames(start_frame, end_frame)
+        num_samples = len(raw)
+        np.multiply(raw, np.float32(1 / 32768.0), out=out[:num_samples], dtype=np.float32)
+        return num_samples // self.num_channels
 
+    # read an arbitrary chunk of data from the file
+    def get_frames(self, start_frame, end_frame) :
+        samples = np.empty(len(self.get_raw_frames(start_frame, end_frame)), dtype=np.float32)
+        self.get_frames_into(start_frame, end_frame, samples)
         return samples
 
     def get_num_channels(self):
@@ -48,46 +84,230 @@ class WaveFile(object):
     def get_length(self):
         return self.end
 
+# default memory budget for decoded audio held in the WaveCache (in bytes)
+kWaveCacheBytes = 512 * 1024 * 1024
+
+# files up to this long are decoded and kept. Longer ones (songs and their
+# stems) play straight from their memory map.
+kDecodeMaxSecs = 30.
+
+# bytes per page, for reading a memory map in ahead of time
+kPageBytes = 4096
+
+
+# whole decoded file, as a WaveSource
+class DecodedWave(object):
+    def __init__(self, data, num_channels):
+        super(DecodedWave, self).__init__()
+        self.data = data
+        self.num_channels = num_channels
+
+    def get_frames(self, start_frame, end_frame) :
+        return self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+
+    def get_frames_into(self, start_frame, end_frame, out) :
+        data = self.get_frames(start_frame, end_frame)
+        out[:len(data)] = data
+        return len(data) // self.num_channels
+
+    def get_num_channels(self):
+        return self.num_channels
+
+    def get_length(self):
+        return len(self.data) // self.num_channels
+
+
+# Process-wide cache of wave files, keyed by file path. The same few files
+# (songs, their _high/_low stems, risers, sound effects) get opened over and
+# over. Short files are decoded to float32 once and slices of them handed out;
+# the cache holds at most max_bytes of those, evicting the least recently used
+# file first. Cached arrays are read-only, since everyone shares them.
+#
+# Long files aren't decoded: decoded float32 takes twice the memory of the
+# int16 file. get_source() hands out their (memory-mapped) WaveFile instead,
+# which decodes just the frames asked for.
+class WaveCache(object):
+    def __init__(self, max_bytes = kWaveCacheBytes, decode_max_secs = kDecodeMaxSecs):
+        super(WaveCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.decode_max_frames = int(decode_max_secs * Audio.sample_rate)
+        self.num_bytes = 0
+        self.entries = OrderedDict() # path -> (data, num_channels), oldest first
+        self.mapped = {}             # path -> WaveFile, for long files
+        self.lock = threading.Lock()
+
+    # a WaveSource for the whole file: decoded and cached if it's short, the
+    # file's memory map if it's long. Only opens the file the first time.
+    def get_source(self, filepath):
+        key = os.path.normpath(filepath)
+        with self.lock:
+            if key in self.mapped:
+                return self.mapped[key]
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return DecodedWave(*self.entries[key])
+
+        wave_file = WaveFile(filepath)
+        if wave_file.get_length() > self.decode_max_frames:
+            with self.lock:
+                return self.mapped.setdefault(key, wave_file)
+        return DecodedWave(*self._decode(key, wave_file))
+
+    # return (data, num_channels) for the whole file, decoding it on a miss.
+    # For short files (like samples): long ones should go through get_source().
+    def get(self, filepath):
+        key = os.path.normpath(filepath)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        return self._decode(key, WaveFile(filepath))
+
+    # decode an opened file, and keep it if it fits
+    def _decode(self, key, wave_file):
+        # decode outside the lock so other threads can keep hitting the cache
+        data = wave_file.get_frames(0, wave_file.get_length())
+        data.flags.writeable = False
+        entry = (data, wave_file.get_num_channels())
+
+        with self.lock:
+            # another thread may have decoded the same file in the meantime
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            # files bigger than the whole budget are handed out, but not kept
+            if data.nbytes <= self.max_bytes:
+                self.entries[key] = entry
+                self.num_bytes += data.nbytes
+                self._evict()
+        return entry
+
+    # load a list of files ahead of time: decode the short ones, and read the
+    # long ones' pages in, so playing them doesn't wait on the disk
+    def preload(self, filepaths):
+        for f in filepaths:
+            source = self.get_source(f)
+            if isinstance(source, WaveFile) and len(source.samples):
+                step = kPageBytes // source.samples.itemsize
+                np.add.reduce(source.samples[::step], dtype=np.int64)
+
+    def contains(self, filepath):
+        key = os.path.normpath(filepath)
+        with self.lock:
+            return key in self.entries or key in self.mapped
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get_num_bytes(self):
+        return self.num_bytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.mapped.clear()
+            self.num_bytes = 0
+
+    # drop least recently used entries until we fit in the budget. Buffers already
+    # handed out keep their data alive until they go away.
+    def _evict(self):
+        while self.num_bytes > self.max_bytes and self.entries:
+            key, (data, num_channels) = self.entries.popitem(last=False)
+            self.num_bytes -= data.nbytes
+
+
+gWaveCache = None
+def get_wave_cache():
+    global gWaveCache
+    if gWaveCache is None:
+        gWaveCache = WaveCache()
+    return gWaveCache
+
+
 # We can generalize the thing that WaveFile does - it provides arbitrary wave
 # data. We can define a "wave data providing interface" (called WaveSource)
 # if it can support the function:
 #
 # get_frames(self, start_frame, end_frame)
+# get_frames_into(self, start_frame, end_frame, out)
+#
+# where get_frames_into() writes float32 samples into out and returns the number
+# of frames written.
 #
 # Now create WaveBuffer. Same WaveSource interface, but can take a subset of
-# audio data from a wave file and holds all that data in memory.
+# audio data from a wave file. It reads from the WaveCache, so making a
+# WaveBuffer does not copy or decode anything once the file is cached: short
+# files are slices of their decoded data, and long ones read straight from the
+# file's memory map. num_frames = None means "until the end of the file".
 class WaveBuffer(object):
-    def __init__(self, filepath, start_frame, num_frames):
+    def __init__(self, filepath, start_frame = 0, num_frames = None):
         super(WaveBuffer, self).__init__()
 
-        # get a local copy of the audio data from WaveFile
-        wr = WaveFile(filepath)
-        self.full_data = wr.get_frames(start_frame, start_frame + num_frames)
-        self.data = self.full_data
-        self.start = start_frame
-        self.num_channels = wr.get_num_channels()
+        self.source = get_wave_cache().get_source(filepath)
+        self.num_channels = self.source.get_num_channels()
+        length = self.source.get_length()
+        self.start = min(start_frame, length)
+        self.full_end = length if num_frames is None else min(start_frame + num_frames, length)
+        self.full_start = self.start
+        self.end = self.full_end
+
+    def _clip(self, start_frame, end_frame):
+        return min(self.start + start_frame, self.end), min(self.start + end_frame, self.end)
 
-    # start and end args are in units of frames,
-    # so take into account num_channels when accessing sample data
+    # start and end args are in units of frames
     def get_frames(self, start_frame, end_frame) :
-        start_sample = start_frame * self.num_channels
-        end_sample = end_frame * self.num_channels
-        return self.data[start_sample : end_sample]
+        return self.source.get_frames(*self._clip(start_frame, end_frame))
 
-    # Change the number of frames played from the wave file to the number of frames requested by num * len(full_data).
-    # Assert num <= 1. then cut the sample [0:num * len(full_data)]
+    def get_frames_into(self, start_frame, end_frame, out) :
+        start, end = self._clip(start_frame, end_frame)
+        return self.source.get_frames_into(start, end, out)
+
+    # play only frames start_frame to end_frame (of the whole buffer)
     def change_frames(self, start_frame, end_frame):
         assert end_frame - start_frame > 0
-        self.data = self.full_data[start_frame:end_frame]
+        length = self.full_end - self.full_start
+        self.start = self.full_start + min(start_frame, length)
+        self.end = self.full_start + min(end_frame, length)
 
     def reset_frames(self):
-        self.data = self.full_data
+        self.start, self.end = self.full_start, self.full_end
 
     def get_num_channels(self):
         return self.num_channels
 
+    # length in frames, same as WaveFile
+    def get_length(self):
+        return max(self.end - self.start, 0)
+
+
+
+# A WaveSource that plays a range of frames of another WaveSource, without copying
+# anything. Frame 0 of the slice is start_frame of the source.
+class WaveSlice(object):
+    def __init__(self, source, start_frame, num_frames):
+        super(WaveSlice, self).__init__()
+        self.source = source
+        self.start = start_frame
+        self.end = min(start_frame + num_frames, source.get_length())
+
+    def _clip(self, start_frame, end_frame):
+        return min(self.start + start_frame, self.end), min(self.start + end_frame, self.end)
+
+    def get_frames(self, start_frame, end_frame) :
+        return self.source.get_frames(*self._clip(start_frame, end_frame))
+
+    def get_frames_into(self, start_frame, end_frame, out) :
+        start, end = self._clip(start_frame, end_frame)
+        return self.source.get_frames_into(start, end, out)
+
+    def get_num_channels(self):
+        return self.source.get_num_channels()
+
     def get_length(self):
-        return len(self.data)
+        return max(self.end - self.start, 0)
 
 
 
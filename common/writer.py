@@ -73,9 +73,35 @@ def write_wave_file(buf, num_channels, name):
     f.setnchannels(num_channels)
     f.setsampwidth(2)
     f.setframerate(Audio.sample_rate)
-    buf = buf * (2**15)
-    buf = buf.astype(np.int16)
-    f.writeframes(buf.tostring())
+    f.writeframes(to_int16(buf).tobytes())
+    f.close()
+
+# float samples (-1 to 1) to 16 bit, clipping anything out of range
+def to_int16(buf):
+    return np.clip(buf * (2**15), -2**15, 2**15 - 1).astype(np.int16)
+
+
+# Writes a wave file a block at a time, so long renders never have to be held
+# in memory. data is interleaved float32, as generators produce it.
+class WaveWriter(object):
+    def __init__(self, filename, num_channels, sample_rate = None):
+        super(WaveWriter, self).__init__()
+        self.num_channels = num_channels
+        self.num_frames = 0
+        self.file = wave.open(filename, 'w')
+        self.file.setnchannels(num_channels)
+        self.file.setsampwidth(2)
+        self.file.setframerate(sample_rate or Audio.sample_rate)
+
+    def write(self, data):
+        self.file.writeframes(to_int16(data).tobytes())
+        self.num_frames += len(data) // self.num_channels
+
+    def get_num_frames(self):
+        return self.num_frames
+
+    def close(self):
+        self.file.close()
 
 # create single buffer from an array of buffers:
 def combine_buffers(buffers):
@@ -7,6 +7,7 @@ from common.wavegen import *
 from common.wavesrc import *
 from common.gfxutil import *
 from common.writer import *
+from chart import ChartCursor
 from kivy.core.window import Window
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
@@ -1056,8 +1057,8 @@ class GameDisplay(InstructionGroup):
         """
         Object handling all of the visual elements of a game instance.
         Arguments:
-            block_data (list): specifies time and location of blocks
-            powerup_data (list): specifies time and location of powerups
+            block_data (Chart): specifies time and location of blocks
+            powerup_data (Chart): specifies time and location of powerups
             audio_manager (AudioManager): Object handling all audio aspects
             label (string): label to display on first progress bar
         """
@@ -1085,8 +1086,8 @@ class GameDisplay(InstructionGroup):
         self.add(self.ground)        
 
         self.current_frame = 0  # current frame in song
-        self.current_block = 0  # current block ind to add from song_data
-        self.current_powerup = 0  # current powerup ind to add from powerup_data
+        self.block_cursor = ChartCursor(self.block_data)  # next blocks to add from song_data
+        self.powerup_cursor = ChartCursor(self.powerup_data)  # next powerups to add from powerup_data
 
         self.blocks = set()  # on-screen blocks
         self.powerups = set()  # on-screen powerups
@@ -1135,7 +1136,6 @@ class GameDisplay(InstructionGroup):
         """
         Play or pause the game.
         """
-        print(self.current_block)
         self.paused = not self.paused
 
     def on_jump(self):
@@ -1221,18 +1221,13 @@ class GameDisplay(InstructionGroup):
 
             # add new blocks and powerups
             # COMPARE ANNOTATION NOTES TO CURRENT FRAME AND ADD NEW OBJECTS ACCORDINGLY
-            block_valid = self.current_block < len(self.block_data)
-            block_onscreen = block_valid and self.current_frame / Audio.sample_rate > self.block_data[self.current_block][0] - SECONDS_FROM_RIGHT_TO_PLAYER
-            if block_onscreen:
-                self.add_block(self.current_block)
-                self.current_block += 1
+            # (everything due by now, found by binary search in the time-sorted charts)
+            onscreen_time = self.current_frame / Audio.sample_rate + SECONDS_FROM_RIGHT_TO_PLAYER
+            for block in self.block_cursor.take_until(onscreen_time):
+                self.add_block(block)
 
-            powerup_valid = self.current_powerup < len(self.powerup_data)
-            powerup_onscreen = powerup_valid and self.current_frame / Audio.sample_rate > self.powerup_data[self.current_powerup][0] - SECONDS_FROM_RIGHT_TO_PLAYER
-            
-            if powerup_onscreen:
-                self.add_powerup(self.current_powerup)
-                self.current_powerup += 1
+            for powerup in self.powerup_cursor.take_until(onscreen_time):
+                self.add_powerup(powerup)
 
         return True
 
@@ -1276,7 +1271,7 @@ class GameDisplay(InstructionGroup):
         self.blocks, self.powerups = set(), set()
         self.block_data, self.powerup_data = new_blocks, new_powerups
 
-        self.current_block, self.current_powerup = 0, 0
+        self.block_cursor, self.powerup_cursor = ChartCursor(new_blocks), ChartCursor(new_powerups)
 
     def update_frame(self, frame):
         """
@@ -0,0 +1,64 @@
+# Chart levels automatically from their songs (see common/beattrack.py). Run
+# from the repo root:
+#   python make_charts.py [--force] [--jobs N] [song.wav ...]
+# With no songs, charts every level (in transition.py's AUDIO_FILES) whose
+# blocks file is missing or empty, or with --force, every level. A song given
+# by name gets song_blocks.txt, song_powerups.txt and song_beats.txt next to it.
+#
+# Charts that already have something in them are never overwritten: the new
+# chart goes next to it instead, as name_auto.txt, to compare and merge by hand.
+
+import os.path
+import sys
+import time
+
+from common.beattrack import make_charts
+from transition import AUDIO_FILES, SONG_DATA_FILES, BEATS_FILES
+
+
+def needs_chart(blockpath):
+    return not os.path.exists(blockpath) or os.path.getsize(blockpath) == 0
+
+# where to write a chart meant for path: path itself if it's missing or empty,
+# otherwise a side file
+def output_path(path):
+    if path is None or needs_chart(path):
+        return path
+    return path[:-4] + '_auto.txt'
+
+def with_output_paths(job):
+    audio_file, blockpath, poweruppath, beatspath, end = job
+    return (audio_file, output_path(blockpath), output_path(poweruppath), output_path(beatspath), end)
+
+def level_jobs(force):
+    jobs = []
+    for i, (audio_file, (blockpath, poweruppath)) in enumerate(zip(AUDIO_FILES, SONG_DATA_FILES)):
+        if not os.path.exists(audio_file):
+            print('%s: missing, skipped' % audio_file)
+            continue
+        if force or needs_chart(blockpath):
+            # every level but the last ends by moving on to the next one
+            end = 'trophy' if i == len(AUDIO_FILES) - 1 else 'transition'
+            jobs.append((audio_file, blockpath, poweruppath, BEATS_FILES[i], end))
+    return jobs
+
+def song_jobs(audio_files):
+    return [(f, f[:-4] + '_blocks.txt', f[:-4] + '_powerups.txt', f[:-4] + '_beats.txt', 'trophy')
+            for f in audio_files]
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    force = '--force' in args
+    jobs = None
+    if '--jobs' in args:
+        jobs = int(args[args.index('--jobs') + 1])
+        del args[args.index('--jobs'):args.index('--jobs') + 2]
+    songs = [a for a in args if not a.startswith('--')]
+
+    start = time.time()
+    chart_jobs = [with_output_paths(job) for job in (song_jobs(songs) if songs else level_jobs(force))]
+    results = make_charts(chart_jobs, jobs)
+    for job, (audio_file, bpm, beats, blocks, powerups) in zip(chart_jobs, results):
+        print('%s: %.1f bpm, %d beats, %d blocks, %d powerups -> %s' %
+              (audio_file, bpm, beats, blocks, powerups, ', '.join(p for p in job[1:4] if p)))
+    print('done in %.1fs' % (time.time() - start))
@@ -0,0 +1,97 @@
+# Render a level's audio to a wave file, offline and as fast as the CPU allows,
+# with the game's real AudioManager graph. Powerups from the level's chart are
+# fired as the song reaches them, as if the player collected every one.
+# Run from the repo root:
+#   python render_level.py <level> [out.wav] [--quality linear|cubic|sinc] [--no-powerups] [--profile]
+# Good for golden-output regression checks and for profiling the audio path
+# without a UI. --profile prints where the time went, generator by generator.
+
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from common.audio import Audio, generate_into, load_audio_config
+from common.writer import WaveWriter
+from common.profiler import enable_profiling, get_profiler
+from audio import AudioManager, DirectAudio
+from transition import AUDIO_FILES, SONG_DATA_FILES, load_song_data
+
+kNumChannels = 2
+
+# powerups that are plain AudioManager calls
+kSimpleEvents = ['speedup', 'slowdown', 'reset_speed', 'lower_volume', 'raise_volume',
+                 'reset_sample', 'reset_filter', 'riser', 'bass_boost', 'vocals_boost', 'reset']
+
+
+# (seconds, powerup type) for every powerup in a chart, in time order
+def load_powerup_events(blockpath, poweruppath):
+    song_data = load_song_data(blockpath, poweruppath)
+    return deque(sorted((t, p_type) for (t, lane, p_type) in song_data.powerups))
+
+# do what collecting a powerup does to the audio. Returns False for the end of the level.
+def fire_event(manager, p_type):
+    if p_type in kSimpleEvents:
+        getattr(manager, p_type)()
+    elif p_type == 'reg_to_high':
+        manager.reg_to_high_boost()
+    elif p_type in ('sample_on', 'sample_off'):
+        getattr(manager, p_type)(manager.get_current_frame())
+    elif p_type == 'trophy':
+        return False
+    # transition tokens and danger blocks don't change the audio by themselves
+    return True
+
+
+# render level (an index into AUDIO_FILES) to filename. Returns (seconds of
+# audio, seconds it took).
+def render_level(level, filename, powerups = True, quality = None):
+    # rendered a quantum at a time, with powerups fired between quanta, like the game
+    Audio.quantum = load_audio_config()['quantum']
+    audio = DirectAudio()
+    next_level = min(level + 1, len(AUDIO_FILES) - 1)
+    manager = AudioManager(audio, AUDIO_FILES[level], AUDIO_FILES[next_level])
+    if quality:
+        manager.set_resample_quality(quality)
+    manager.set_as_audio(audio)
+    manager.toggle()
+
+    events = load_powerup_events(*SONG_DATA_FILES[level]) if powerups else deque()
+    writer = WaveWriter(filename, kNumChannels)
+    buf = np.zeros(Audio.quantum * kNumChannels, dtype=np.float32)
+
+    # stop at the end of the song, at a trophy, or if the song stops moving for a second
+    length = manager.get_current_length()
+    stuck_frames = 0
+    t_start = time.time()
+    while True:
+        frame = manager.get_current_frame()
+        if frame >= length or stuck_frames > Audio.sample_rate:
+            break
+        if events and events[0][0] * Audio.sample_rate <= frame:
+            if not fire_event(manager, events.popleft()[1]):
+                break
+            continue
+
+        generate_into(audio.generator, buf, Audio.quantum, kNumChannels)
+        writer.write(buf)
+        stuck_frames = stuck_frames + Audio.quantum if manager.get_current_frame() == frame else 0
+
+    elapsed = time.time() - t_start
+    writer.close()
+    return writer.get_num_frames() / float(Audio.sample_rate), elapsed
+
+
+if __name__ == "__main__":
+    quality = sys.argv[sys.argv.index('--quality') + 1] if '--quality' in sys.argv else None
+    args = [a for a in sys.argv[1:] if not a.startswith('--') and a != quality]
+    level = int(args[0]) if args else 0
+    filename = args[1] if len(args) > 1 else 'level%d.wav' % level
+
+    if '--profile' in sys.argv:
+        enable_profiling(track_allocs=True)
+    secs, elapsed = render_level(level, filename, '--no-powerups' not in sys.argv, quality)
+    print('%s: %.1fs of audio in %.2fs (%.1fx real time)' % (filename, secs, elapsed, secs / max(elapsed, 1e-9)))
+    if get_profiler():
+        get_profiler().dump()
@@ -0,0 +1,17 @@
+# Pre-render the game's sound effects from the General MIDI soundfont, one
+# small wave file per note. Needs fluidsynth. Run from the repo root after
+# changing the soundfont or the notes in audio.py:
+#   python render_sfx.py [--force]
+# Samples go in data/sfx/. Without them, the game loads the soundfont into
+# fluidsynth instead.
+
+import sys
+import time
+
+from common.samplebank import render_samples
+from audio import kSoundFont, kSfxDir, kSfxNotes
+
+if __name__ == "__main__":
+    start = time.time()
+    written = render_samples(kSoundFont, kSfxNotes, kSfxDir, force='--force' in sys.argv)
+    print('%d of %d notes rendered in %.1fs' % (len(written), len(kSfxNotes), time.time() - start))
@@ -0,0 +1,31 @@
+# Pre-render the speed variants (one wave file per semitone step) of every
+# level's song and filter stems. Run from the repo root after changing audio:
+#   python render_variants.py [--force] [--jobs N]
+# Variants go in data/variants/. Songs play fine without them; speed
+# effects then resample live instead.
+
+import os.path
+import sys
+import time
+
+from common.speedvariants import render_variants
+from transition import AUDIO_FILES, SONG_DATA_FILES, reachable_semitones
+
+
+def level_files(audio_file):
+    stems = [audio_file[:-4] + "_high.wav", audio_file[:-4] + "_low.wav"]
+    return [f for f in [audio_file] + stems if os.path.exists(f)]
+
+if __name__ == "__main__":
+    force = '--force' in sys.argv
+    jobs = int(sys.argv[sys.argv.index('--jobs') + 1]) if '--jobs' in sys.argv else None
+
+    for audio_file, (blockpath, poweruppath) in zip(AUDIO_FILES, SONG_DATA_FILES):
+        files = level_files(audio_file)
+        if not files:
+            print('%s: missing, skipped' % audio_file)
+            continue
+        semitones = reachable_semitones(blockpath, poweruppath)
+        start = time.time()
+        rendered = render_variants(files, semitones, max_workers=jobs, force=force)
+        print('%s: %d variants rendered in %.1fs (steps %s)' % (audio_file, len(rendered), time.time() - start, semitones))
@@ -1,7 +1,11 @@
+from chart import load_chart
+
 AUDIO_FILES = ["data/babyshark.wav", "data/closerremix_98bpm.wav", "data/migente_short.wav"]
 SONG_DATA_FILES = [("data/babyshark_blocks.txt", "data/babyshark_powerups.txt"),
                     ("data/closer_blocks.txt", "data/closer_powerups.txt"),
                     ("data/migente_blocks.txt", "data/migente_powerups.txt")]
+# beat grids (time, bar.beat per line), for levels that have one
+BEATS_FILES = [None, "data/closer_beats.txt", "data/migente_beats.txt"]
 
 PLAYER_IMAGES = [["img/shark.png", "img/shark_jump.png","img/shark_fall.png"],["img/dinosaur.png","img/dinosaur_jump.png","img/dinosaur_fall.png"], ["img/bird.png","img/bird_jump.png","img/bird_fall.png"]]
 BLOCK_IMAGES = ["img/wav.png", "img/forest_block.png", "img/cloud.png"]
@@ -16,6 +20,7 @@ SONG_NAMES = ["Baby Shark","Closer (Shaun \nFrank Remix)", "Mi Gente"]
 # To add a new level, just
 #  - add the audio path to AUDIO_FILES
 #  - add the blocks and powerup paths in tuple form to SONG_DATA_FILES
+#  - add its beat grid path (or None) to BEATS_FILES
 #  - add a new player image to PLAYER_IMAGES
 #  - add a new block image to BLOCK_IMAGES
 #  - add a new ground image to GROUND_IMAGES
@@ -31,6 +36,7 @@ class GameData(object):
         self.block_image = BLOCK_IMAGES[self.level]
         self.ground_image = GROUND_IMAGES[self.level]
         self.next_song_name = AUDIO_FILES[self.level + 1]
+        self.next_song_data_files = SONG_DATA_FILES[self.level + 1]
         self.bg_image = BACKGROUND_IMAGES[self.level]
         self.song_name = SONG_NAMES[self.level]
 
@@ -40,6 +46,9 @@ class GameData(object):
     def get_next_song(self):
         return self.next_song_name
 
+    def get_next_song_data_files(self):
+        return self.next_song_data_files
+
     def transition(self):
         self.level += 1
         self.audio_file_name = AUDIO_FILES[self.level]
@@ -49,8 +58,52 @@ class GameData(object):
         self.ground_image = GROUND_IMAGES[self.level]
         if self.level < len(AUDIO_FILES) - 1:
             self.next_song_name = AUDIO_FILES[self.level + 1 ]
+            self.next_song_data_files = SONG_DATA_FILES[self.level + 1]
         else:
             self.next_song_name = AUDIO_FILES[self.level]
+            self.next_song_data_files = SONG_DATA_FILES[self.level]
 
         self.bg_image = BACKGROUND_IMAGES[self.level]
         self.song_name = SONG_NAMES[self.level]
+
+
+# holds data for blocks and powerups, as Charts (see chart.py) sorted by time.
+class SongData(object):
+    def __init__(self):
+        super(SongData, self).__init__()
+        self.blocks = []  # (seconds, lane, units) of each block
+        self.powerups = []  # (seconds, lane, type) of each powerup
+
+    # from lab 2
+    def lines_from_file(self, filename):
+        f = open(filename)
+        g = f.readlines()
+        f.close()
+        return g
+
+    # read the blocks and powerup data. Each text file is compiled the first
+    # time it's read (or changed), and loaded compiled after that.
+    def read_data(self, blockpath, poweruppath):
+        self.blocks = load_chart(blockpath)
+        self.powerups = load_chart(poweruppath, powerups=True)
+
+
+# make a SongData and read a level's chart into it. Can run on a worker thread.
+def load_song_data(blockpath, poweruppath):
+    song_data = SongData()
+    song_data.read_data(blockpath, poweruppath)
+    return song_data
+
+
+# the semitone speed steps a level's speedup / slowdown powerups can reach, starting
+# from normal speed. Any powerup may or may not be collected, so this is every
+# reachable step, clamped to +-limit. Used to decide which speed variants to render.
+def reachable_semitones(blockpath, poweruppath, limit=6):
+    song_data = load_song_data(blockpath, poweruppath)
+    reachable = set([0])
+    for (time, lane, p_type) in sorted(song_data.powerups):
+        if p_type == "speedup":
+            reachable |= set([min(k + 1, limit) for k in reachable])
+        elif p_type == "slowdown":
+            reachable |= set([max(k - 1, -limit) for k in reachable])
+    return sorted(reachable)